@@ -0,0 +1,97 @@
+"""
+Benchmark of bulk payouts against one payment per request.
+
+Creates a throwaway test database, one paying account and a set of receiving accounts in two currencies, then
+measures how many payouts per second are made by:
+- single: one Transfer.execute and notification per payout, as send_payment does
+- bulk: execute_payouts with batches of the given sizes
+
+Timestamps come from the local clock so the Thrift server does not need to be running.
+
+Usage:
+    python -m benchmarks.bulk_payouts [--payouts 2000] [--receivers 200] [--batch-sizes 10 100 1000]
+"""
+import argparse
+import os
+import time
+from decimal import Decimal
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webapps2024.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection, transaction  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+
+from payapp.models import Account, Transfer  # noqa: E402
+from payapp.outbox import publish_notification  # noqa: E402
+from payapp.payouts import execute_payouts  # noqa: E402
+from thrift_timestamp.sources import LocalClockTimestampSource, set_timestamp_source  # noqa: E402
+
+
+def create_accounts(receivers):
+    """Create the paying account and the receiving accounts, half of them in another currency."""
+    payer = Account.objects.create(user=User.objects.create_user(username='payer'), balance=10 ** 7)
+    usernames = []
+    for i in range(receivers):
+        username = f'receiver{i}'
+        Account.objects.create(user=User.objects.create_user(username=username), balance=0,
+                               currency='usd' if i % 2 else 'gbp')
+        usernames.append(username)
+    return Account.objects.select_related('user').get(pk=payer.pk), usernames
+
+
+def pay_singly(payer, payouts):
+    """Make each payout in its own transaction, as send_payment does."""
+    for username, amount in payouts:
+        with transaction.atomic():
+            transfer = Transfer(sender=payer, receiver=Account.objects.select_related('user').get(
+                user__username=username), amount=amount)
+            transfer.execute(amount)
+            publish_notification(transfer.receiver, payer, 'payment_sent',
+                                 f"You have received {amount} from {payer.user.username}", transfer.created_at,
+                                 key=f'payment_sent:{transfer.pk}')
+
+
+def pay_in_batches(payer, payouts, batch_size):
+    """Make the payouts with execute_payouts, batch_size at a time."""
+    for start in range(0, len(payouts), batch_size):
+        execute_payouts(payer, payouts[start:start + batch_size])
+
+
+def measure(function, *args):
+    """Run the function and return how long it took in seconds."""
+    began = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - began
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payouts', type=int, default=2000, help="Payouts made by each method")
+    parser.add_argument('--receivers', type=int, default=200, help="Receiving accounts the payouts cycle through")
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    set_timestamp_source(LocalClockTimestampSource())
+    try:
+        payer, usernames = create_accounts(args.receivers)
+        payouts = [(usernames[i % len(usernames)], Decimal('1.25')) for i in range(args.payouts)]
+
+        print(f"{'method':<16} {'payouts/s':>12}")
+        elapsed = measure(pay_singly, payer, payouts)
+        print(f"{'single':<16} {args.payouts / elapsed:>12.0f}")
+        for batch_size in args.batch_sizes:
+            elapsed = measure(pay_in_batches, payer, payouts, batch_size)
+            print(f"{f'bulk ({batch_size})':<16} {args.payouts / elapsed:>12.0f}")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
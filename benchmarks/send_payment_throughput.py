@@ -0,0 +1,121 @@
+"""
+Benchmark of send_payment throughput under concurrent payments on the configured database profile.
+
+Creates a throwaway database with a set of funded accounts, then has --threads clients, each logged in as a
+different account, post payments to random other accounts through the send_payment view as fast as they can. Reports
+payments per second and the number of payments which failed, e.g. with "database is locked".
+
+The database is chosen by the DATABASE_PROFILE environment variable, as in the settings:
+- sqlite: the test database is a file, so the locking is that of a deployment. It is measured twice, as Django opens
+  SQLite by default (rollback journal, full syncs, deferred transactions) and with the OPTIONS of the settings
+- postgres: a test database is created on the POSTGRES_* server and measured once
+
+Usage:
+    python -m benchmarks.send_payment_throughput [--threads 8] [--payments 100] [--accounts 20]
+    DATABASE_PROFILE=postgres python -m benchmarks.send_payment_throughput
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webapps2024.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import override_settings, setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+
+from payapp.models import Account, Transfer  # noqa: E402
+from thrift_timestamp.sources import LocalClockTimestampSource, set_timestamp_source  # noqa: E402
+
+# SQLite as Django's own backend opens it: a rollback journal, a sync on every commit, the 5 second busy timeout of
+# Python's sqlite3 module and deferred transactions
+SQLITE_DEFAULTS = {'pragmas': {'journal_mode': 'DELETE'}}
+
+
+def create_accounts(count):
+    """Create count funded accounts, returning their usernames."""
+    usernames = [f'payer{i}' for i in range(count)]
+    for username in usernames:
+        Account.objects.create(user=User.objects.create_user(username=username, password='password'), balance=10 ** 6)
+    return usernames
+
+
+def log_in(username):
+    """Return a test client logged in as username, which reports server errors as responses."""
+    client = Client(raise_request_exception=False)
+    client.login(username=username, password='password')
+    return client
+
+
+def pay(client, others, payments, results):
+    """Send payments from the client's account to random other accounts, adding the status codes to results."""
+    statuses = []
+    for _ in range(payments):
+        statuses.append(client.post(reverse('payapp:send_payment'),
+                                    {'amount': '1.00', 'receiver': random.choice(others)}).status_code)
+    results.extend(statuses)
+    connection.close()
+
+
+def measure(threads, payments, accounts):
+    """
+    Run the clients on a new test database and return the payments per second and the number which failed.
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        usernames = create_accounts(max(accounts, threads))
+        results = []
+        workers = [threading.Thread(target=pay, args=(log_in(username), [other for other in usernames
+                                                                         if other != username], payments, results))
+                   for username in usernames[:threads]]
+        began = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - began
+        return Transfer.objects.count() / elapsed, len(results) - results.count(302)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8, help="Clients paying at the same time")
+    parser.add_argument('--payments', type=int, default=100, help="Payments sent by each client")
+    parser.add_argument('--accounts', type=int, default=20, help="Accounts the payments are sent between")
+    args = parser.parse_args()
+
+    setup_test_environment(debug=False)
+    set_timestamp_source(LocalClockTimestampSource())
+    options = connection.settings_dict['OPTIONS']
+    if connection.vendor == 'sqlite':
+        # A file rather than SQLite's in-memory test database, which has no journal to tune
+        directory = tempfile.TemporaryDirectory()
+        connection.settings_dict['TEST']['NAME'] = os.path.join(directory.name, 'benchmark.db')
+        profiles = [('sqlite (defaults)', SQLITE_DEFAULTS), ('sqlite (tuned)', options)]
+    else:
+        profiles = [(connection.vendor, options)]
+
+    print(f"{'database':<20} {'payments/s':>12} {'failed':>8}")
+    # A fast hasher, so logging the clients in does not dominate the setup
+    with override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']):
+        for name, profile_options in profiles:
+            # Every connection the clients open reads the options from this shared dict
+            connection.settings_dict['OPTIONS'] = profile_options
+            rate, failed = measure(args.threads, args.payments, args.accounts)
+            print(f"{name:<20} {rate:>12.0f} {failed:>8}")
+    connection.settings_dict['OPTIONS'] = options
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark of the Thrift timestamp server modes.
+
+Starts the server in a separate process for each mode and measures how many timestamps per second it serves to 1, 16
+and 128 concurrent clients, each holding a persistent connection. The simple mode is left out by default as it only
+serves a single connection at a time.
+
+Usage:
+    python -m benchmarks.thrift_timestamp_server [--modes threaded nonblocking forking] [--clients 1 16 128]
+"""
+import argparse
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from thrift_timestamp.client import PooledConnection
+
+
+def get_free_port():
+    """Ask the OS for a port that is not currently in use."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, port, workers, backlog):
+    """Start the timestamp server in a child process and wait until it accepts connections."""
+    process = subprocess.Popen([sys.executable, '-m', 'thrift_timestamp.server', '--mode', mode, '--host', 'localhost',
+                                '--port', str(port), '--workers', str(workers), '--backlog', str(backlog)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port), timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"The {mode} server did not start")
+
+
+def run_clients(port, clients, duration, framed):
+    """
+    Run the given number of client threads against the server for duration seconds.
+
+    :return: The number of timestamps fetched per second
+    """
+    counts = [0] * clients
+    errors = [0] * clients
+    start = threading.Barrier(clients + 1)
+    stop = threading.Event()
+
+    def client_loop(index):
+        connection = PooledConnection('localhost', port, 10000, framed)
+        start.wait()
+        while not stop.is_set():
+            try:
+                connection.client.getCurrentTimestamp()
+                counts[index] += 1
+            except Exception:
+                errors[index] += 1
+                connection.close()
+                connection = PooledConnection('localhost', port, 10000, framed)
+        connection.close()
+
+    threads = [threading.Thread(target=client_loop, args=(i,), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    return sum(counts) / elapsed, sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['threaded', 'nonblocking', 'forking'])
+    parser.add_argument('--clients', nargs='+', type=int, default=[1, 16, 128])
+    parser.add_argument('--duration', type=float, default=5, help="Seconds to run each measurement for")
+    parser.add_argument('--workers', type=int, default=128,
+                        help="Server worker threads; threaded mode needs one per concurrent client")
+    parser.add_argument('--backlog', type=int, default=256)
+    args = parser.parse_args()
+
+    print(f"{'mode':<12} {'clients':>8} {'timestamps/s':>14} {'errors':>8}")
+    for mode in args.modes:
+        for clients in args.clients:
+            port = get_free_port()
+            process = start_server(mode, port, args.workers, args.backlog)
+            try:
+                rate, errors = run_clients(port, clients, args.duration, framed=mode == 'nonblocking')
+            finally:
+                process.terminate()
+                process.wait()
+            print(f"{mode:<12} {clients:>8} {rate:>14.0f} {errors:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Benchmark of the read-heavy pages served through Django's WSGI handler against its ASGI handler.
+
+Creates a throwaway test database with a logged-in account that has a page of transfers, requests and notifications,
+then sends the same requests to each handler in this process, without a network server in between:
+- wsgi: each request runs on a pool of --threads worker threads, as a threaded WSGI server such as gunicorn's gthread
+  worker would
+- asgi: every request runs on one event loop, as a single uvicorn or daphne worker would
+
+--concurrency clients keep one request each in flight until --requests have been made, and the latency of a request
+includes any time it waited for a free worker thread. With --timestamp-latency the home page asks a simulated Thrift
+server, which takes that many milliseconds to answer, for the time on every request.
+
+Usage:
+    python -m benchmarks.wsgi_vs_asgi [--requests 2000] [--concurrency 200] [--threads 16] [--timestamp-latency 0]
+"""
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webapps2024.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.handlers.asgi import ASGIHandler  # noqa: E402
+from django.core.handlers.wsgi import WSGIHandler  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+
+from payapp.models import Account, Notification, Request, Transfer  # noqa: E402
+from thrift_timestamp.sources import LocalClockTimestampSource, ThriftTimestampSource, set_timestamp_source  # noqa: E402
+
+PAGES = ('home', 'payapp:transfers', 'payapp:requests', 'payapp:notifications')
+
+
+class SlowTimestampClient:
+    """Stands in for the Thrift client with a server taking latency seconds to answer."""
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get_current_datetime(self):
+        time.sleep(self.latency)
+        return datetime.now(timezone.utc)
+
+
+def create_data(rows):
+    """Create the account the requests are made as, with rows transfers, requests and notifications."""
+    account = Account.objects.create(user=User.objects.create_user(username='reader', password='readerpassword'),
+                                     balance=10 ** 6)
+    other = Account.objects.create(user=User.objects.create_user(username='other'), balance=10 ** 6)
+    for i in range(rows):
+        Transfer(sender=account, receiver=other, amount=Decimal('1.00')).execute(Decimal('1.00'))
+        Request.objects.create(sender=other, receiver=account, amount=Decimal('1.00'))
+        Notification.objects.create(to_user=account, from_user=other, message=f'Notification {i}')
+    client = Client()
+    client.login(username='reader', password='readerpassword')
+    return f"sessionid={client.cookies['sessionid'].value}"
+
+
+def wsgi_request(handler, path, cookie):
+    """Make a GET request through the WSGI handler, returning the status code."""
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'SCRIPT_NAME': '', 'QUERY_STRING': '',
+        'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': 'testserver',
+        'HTTP_COOKIE': cookie, 'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'http',
+    }
+    statuses = []
+    response = handler(environ, lambda status, headers: statuses.append(status))
+    try:
+        b''.join(response)
+    finally:
+        response.close()
+    return int(statuses[0].split()[0])
+
+
+async def asgi_request(handler, path, cookie):
+    """Make a GET request through the ASGI handler, returning the status code."""
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+        'headers': [(b'host', b'testserver'), (b'cookie', cookie.encode())],
+        'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+    }
+    messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    statuses = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # The client stays connected until the handler has sent the response
+        await asyncio.Future()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    await handler(scope, receive, send)
+    return statuses[0]
+
+
+async def run_clients(request, paths, total, concurrency):
+    """
+    Make total requests from concurrency clients, each waiting for its response before sending the next.
+
+    :param request: Coroutine function taking the path and returning the status code
+    :return: Tuple of the elapsed seconds, the sorted latencies in seconds and the number of errors
+    """
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def client():
+        nonlocal errors
+        for i in remaining:
+            began = time.perf_counter()
+            status = await request(paths[i % len(paths)])
+            latencies.append(time.perf_counter() - began)
+            errors += status != 200
+
+    began = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return time.perf_counter() - began, sorted(latencies), errors
+
+
+def percentile(latencies, share):
+    """Return the latency below which the given share of the sorted latencies fall."""
+    return latencies[min(len(latencies) - 1, int(len(latencies) * share))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000, help="Requests made through each handler")
+    parser.add_argument('--concurrency', type=int, default=200, help="Requests in flight at once")
+    parser.add_argument('--threads', type=int, default=16, help="Worker threads of the WSGI server")
+    parser.add_argument('--rows', type=int, default=25, help="Transfers, requests and notifications of the account")
+    parser.add_argument('--timestamp-latency', type=float, default=0,
+                        help="Milliseconds the simulated Thrift server takes to answer, 0 for the local clock")
+    args = parser.parse_args()
+
+    setup_test_environment(debug=False)
+    old_name = connection.creation.create_test_db(verbosity=0)
+    set_timestamp_source(LocalClockTimestampSource())
+    try:
+        cookie = create_data(args.rows)
+        if args.timestamp_latency:
+            set_timestamp_source(ThriftTimestampSource(SlowTimestampClient(args.timestamp_latency / 1000)))
+        paths = [reverse(name) for name in PAGES]
+
+        wsgi_handler, asgi_handler = WSGIHandler(), ASGIHandler()
+        pool = ThreadPoolExecutor(max_workers=args.threads)
+
+        async def wsgi(path):
+            return await asyncio.get_running_loop().run_in_executor(pool, wsgi_request, wsgi_handler, path, cookie)
+
+        async def asgi(path):
+            return await asgi_request(asgi_handler, path, cookie)
+
+        print(f"{'handler':<8} {'requests/s':>12} {'p50 ms':>10} {'p99 ms':>10} {'errors':>8}")
+        for name, request in (('wsgi', wsgi), ('asgi', asgi)):
+            # Warm up the caches and connections before measuring
+            asyncio.run(run_clients(request, paths, len(paths), 1))
+            elapsed, latencies, errors = asyncio.run(run_clients(request, paths, args.requests, args.concurrency))
+            print(f"{name:<8} {args.requests / elapsed:>12.0f} {percentile(latencies, 0.5) * 1000:>10.1f} "
+                  f"{percentile(latencies, 0.99) * 1000:>10.1f} {errors:>8}")
+        pool.shutdown()
+    finally:
+        set_timestamp_source(LocalClockTimestampSource())
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,7 @@
 from django.contrib import admin
 
+from conversion.models import Currency, ExchangeRate
+
 # Register your models here.
+admin.site.register(Currency)
+admin.site.register(ExchangeRate)
@@ -1,6 +1,25 @@
 from django.apps import AppConfig
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+
+def invalidate_rates_on_commit(sender, **kwargs):
+    """Invalidates the cached rate matrix once the change to a currency or exchange rate is committed."""
+    from conversion.rates import invalidate_rates
+    transaction.on_commit(invalidate_rates)
 
 
 class ConversionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'conversion'
+
+    def ready(self):
+        """
+        Method to connect the signals which keep the cached rate matrix up to date when the app is ready.
+        :param self:
+        :return:
+        """
+        from conversion.models import Currency, ExchangeRate
+        for model in (Currency, ExchangeRate):
+            post_save.connect(invalidate_rates_on_commit, sender=model)
+            post_delete.connect(invalidate_rates_on_commit, sender=model)
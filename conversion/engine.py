@@ -0,0 +1,118 @@
+from collections import defaultdict
+from decimal import Context, Decimal, InvalidOperation, ROUND_HALF_UP
+from itertools import repeat
+
+from conversion.rates import get_rate_table
+
+# Converted amounts are rounded to the nearest penny/cent
+CENT = Decimal('0.01')
+# Context of the batch conversions, rounding half up as convert does
+BATCH_CONTEXT = Context(rounding=ROUND_HALF_UP)
+
+
+class UnsupportedCurrencyError(Exception):
+    """Exception raised when there is no exchange rate between two currencies."""
+
+    def __init__(self, message="Unsupported currency", pair=None):
+        self.message = message
+        # The (from, to) currency codes which could not be converted, if known
+        self.pair = pair
+        super().__init__(self.message)
+
+
+def get_rate(from_currency, to_currency):
+    """
+    Look up the exchange rate from one currency to another.
+
+    :param from_currency: The currency to convert from
+    :param to_currency: The currency to convert to
+    :return: Decimal - The amount of to_currency one unit of from_currency buys
+    :raises UnsupportedCurrencyError: if either currency is not supported
+    """
+    from_currency = from_currency.upper()
+    to_currency = to_currency.upper()
+    if from_currency == to_currency:
+        return Decimal(1)
+    # Rates come from the cached rate matrix, so the lookup does not query the database
+    try:
+        return get_rate_table().rates[(from_currency, to_currency)]
+    except KeyError:
+        raise UnsupportedCurrencyError(pair=(from_currency, to_currency))
+
+
+def to_decimal(amount):
+    """Convert an int, float, string or Decimal amount to a Decimal without picking up float representation error."""
+    if isinstance(amount, Decimal):
+        return amount
+    # bool is an int, but True is not an amount
+    if isinstance(amount, bool):
+        raise ValueError(f"Invalid amount '{amount}'")
+    try:
+        value = Decimal(str(amount))
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount '{amount}'")
+    # Decimal also parses 'NaN' and 'Infinity'
+    if not value.is_finite():
+        raise ValueError(f"Invalid amount '{amount}'")
+    return value
+
+
+def convert(from_currency, to_currency, amount):
+    """
+    Convert an amount of one currency to another in process, without any network I/O. Amounts in the same currency
+    are returned unchanged, converted amounts are rounded half up to two decimal places.
+
+    :param from_currency: The currency to convert from
+    :param to_currency: The currency to convert to
+    :param amount: The amount of from_currency to convert
+    :return: Decimal - The amount of to_currency after conversion
+    :raises UnsupportedCurrencyError: if either currency is not supported
+    """
+    amount = to_decimal(amount)
+    if from_currency.upper() == to_currency.upper():
+        return amount
+    return (amount * get_rate(from_currency, to_currency)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def convert_many(from_currency, to_currency, amounts):
+    """
+    Convert a column of amounts from one currency to another, looking the rate up once and converting the whole
+    column in one multiply pass and one rounding pass. Each pass maps a method of BATCH_CONTEXT over the column, so no
+    Python expression or rounding keyword is evaluated per amount. NumPy is not used: float arrays would not keep the
+    amounts exact, and object arrays would apply the same Decimal operations one amount at a time.
+
+    :param from_currency: The currency to convert from
+    :param to_currency: The currency to convert to
+    :param amounts: Iterable of amounts of from_currency
+    :return: List of Decimals - The amounts of to_currency, in the same order
+    :raises UnsupportedCurrencyError: if either currency is not supported
+    :raises ValueError: if an amount is not a number
+    """
+    amounts = list(map(to_decimal, amounts))
+    if from_currency.upper() == to_currency.upper():
+        return amounts
+    rate = get_rate(from_currency, to_currency)
+    products = map(BATCH_CONTEXT.multiply, amounts, repeat(rate))
+    return list(map(BATCH_CONTEXT.quantize, products, repeat(CENT)))
+
+
+def convert_batch(items):
+    """
+    Convert a batch of amounts between any currency pairs. Items are grouped by pair so each group is converted as
+    one column with convert_many, with one rate lookup and one multiply pass per pair.
+
+    :param items: Sequence of (from_currency, to_currency, amount) tuples
+    :return: List of Decimals - The converted amounts, in the same order as items
+    :raises UnsupportedCurrencyError: if any pair is not supported
+    :raises ValueError: if an amount is not a number
+    """
+    groups = defaultdict(list)
+    for index, (from_currency, to_currency, _) in enumerate(items):
+        groups[(from_currency.upper(), to_currency.upper())].append(index)
+
+    results = [None] * len(items)
+    for (from_currency, to_currency), indexes in groups.items():
+        converted = convert_many(from_currency, to_currency, [items[index][2] for index in indexes])
+        for index, amount in zip(indexes, converted):
+            results[index] = amount
+    return results
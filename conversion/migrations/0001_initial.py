@@ -0,0 +1,49 @@
+# Generated by Django 5.0.2 on 2026-10-17 22:48
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Currency',
+            fields=[
+                ('code', models.CharField(max_length=3, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=50)),
+                ('symbol', models.CharField(max_length=5)),
+            ],
+            options={
+                'verbose_name': 'Currency',
+                'verbose_name_plural': 'Currencies',
+                'db_table': 'currency',
+                'ordering': ['code'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rate', models.DecimalField(decimal_places=8, max_digits=18)),
+                ('effective_from', models.DateTimeField(default=django.utils.timezone.now)),
+                ('from_currency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rates_from', to='conversion.currency')),
+                ('to_currency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rates_to', to='conversion.currency')),
+            ],
+            options={
+                'verbose_name': 'Exchange Rate',
+                'verbose_name_plural': 'Exchange Rates',
+                'db_table': 'exchange_rate',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='exchangerate',
+            constraint=models.UniqueConstraint(fields=('from_currency', 'to_currency', 'effective_from'), name='unique_exchange_rate_effective_from'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from django.db import migrations
+
+CURRENCIES = [
+    ('EUR', 'Euro', '€'),
+    ('GBP', 'Pound sterling', '£'),
+    ('USD', 'US dollar', '$'),
+]
+
+# The rates previously hard-coded in the conversion API
+RATES = [
+    ('USD', 'EUR', '0.85'),
+    ('USD', 'GBP', '0.75'),
+    ('EUR', 'USD', '1.18'),
+    ('EUR', 'GBP', '0.89'),
+    ('GBP', 'USD', '1.33'),
+    ('GBP', 'EUR', '1.12'),
+]
+
+EFFECTIVE_FROM = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def seed_currencies_and_rates(apps, schema_editor):
+    Currency = apps.get_model('conversion', 'Currency')
+    ExchangeRate = apps.get_model('conversion', 'ExchangeRate')
+    for code, name, symbol in CURRENCIES:
+        Currency.objects.update_or_create(code=code, defaults={'name': name, 'symbol': symbol})
+    for from_code, to_code, rate in RATES:
+        ExchangeRate.objects.get_or_create(from_currency_id=from_code, to_currency_id=to_code,
+                                           effective_from=EFFECTIVE_FROM, defaults={'rate': Decimal(rate)})
+
+
+def remove_currencies_and_rates(apps, schema_editor):
+    Currency = apps.get_model('conversion', 'Currency')
+    Currency.objects.filter(code__in=[code for code, _, _ in CURRENCIES]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversion', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_currencies_and_rates, remove_currencies_and_rates),
+    ]
@@ -1,3 +1,66 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class Currency(models.Model):
+    """
+    Currency model for storing the currencies accounts can hold and conversions support.
+
+    Attributes:
+    - code: CharField storing the upper case ISO 4217 code, e.g. 'GBP'
+    - name: CharField storing the name of the currency
+    - symbol: CharField storing the symbol shown before amounts, e.g. '£'
+    """
+
+    class Meta:
+        db_table = 'currency'
+        verbose_name = 'Currency'
+        verbose_name_plural = 'Currencies'
+        ordering = ['code']
+
+    code = models.CharField(max_length=3, primary_key=True)
+    name = models.CharField(max_length=50)
+    symbol = models.CharField(max_length=5)
+
+    def __str__(self):
+        """
+        Returns the code of the currency.
+
+        :return: str: The currency code
+        """
+        return self.code
+
+
+class ExchangeRate(models.Model):
+    """
+    ExchangeRate model for storing the rate from one currency to another. Rates are never edited in place: a new rate
+    is added with the time it takes effect from, and the latest rate already in effect is used.
+
+    Attributes:
+    - from_currency: ForeignKey to the Currency converted from
+    - to_currency: ForeignKey to the Currency converted to
+    - rate: DecimalField storing the amount of to_currency one unit of from_currency buys
+    - effective_from: DateTimeField storing when the rate takes effect
+    """
+
+    class Meta:
+        db_table = 'exchange_rate'
+        verbose_name = 'Exchange Rate'
+        verbose_name_plural = 'Exchange Rates'
+        constraints = [
+            models.UniqueConstraint(fields=['from_currency', 'to_currency', 'effective_from'],
+                                    name='unique_exchange_rate_effective_from'),
+        ]
+
+    from_currency = models.ForeignKey(Currency, on_delete=models.CASCADE, related_name='rates_from')
+    to_currency = models.ForeignKey(Currency, on_delete=models.CASCADE, related_name='rates_to')
+    rate = models.DecimalField(max_digits=18, decimal_places=8)
+    effective_from = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        """
+        Returns the pair, rate and effective time.
+
+        :return: str: Description of the exchange rate
+        """
+        return f"{self.from_currency_id}/{self.to_currency_id} {self.rate} from {self.effective_from}"
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import Min
+from django.utils import timezone
+
+# Snapshot of the exchange-rate matrix: rates maps (from code, to code) to the Decimal rate in effect, currencies maps
+# each code to its Currency in code order, and version is the cache version the snapshot was loaded at
+RateTable = namedtuple('RateTable', ['rates', 'currencies', 'version'])
+
+
+class RateCache:
+    """
+    Process-local cache of the full exchange-rate matrix, loaded with two queries so that rate, currency and symbol
+    lookups never hit the database on the hot path.
+
+    A snapshot is reloaded when it is older than ttl seconds, when a future-dated rate takes effect, or when
+    invalidate() bumps the version, which the signals in ConversionConfig do whenever a currency or rate is committed
+    in this process. Other processes see the change within ttl seconds.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._table = None
+        self._expires_at = 0
+        self._version = 0
+        self._lock = threading.Lock()
+        # Number of times the matrix has been loaded from the database
+        self.loads = 0
+
+    def _is_fresh(self, table):
+        return table is not None and table.version == self._version and time.monotonic() < self._expires_at
+
+    def get(self):
+        """Return the current RateTable, loading it if the cached one is stale."""
+        table = self._table
+        if self._is_fresh(table):
+            return table
+        with self._lock:
+            if self._is_fresh(self._table):
+                return self._table
+            return self._load()
+
+    async def aget(self):
+        """Async get, loading a stale table in a thread so the event loop is not blocked by the queries."""
+        table = self._table
+        if self._is_fresh(table):
+            return table
+        return await sync_to_async(self.get)()
+
+    def _load(self):
+        """Load the currencies and the latest rate in effect for every pair. Lock must be held."""
+        from conversion.models import Currency, ExchangeRate
+        # A version bumped while loading leaves this snapshot stale, so the change is picked up by the next call
+        version = self._version
+        now = timezone.now()
+        try:
+            currencies = {currency.code: currency for currency in Currency.objects.all()}
+            rates = {}
+            # Later rates overwrite earlier ones, leaving the one in effect for each pair
+            for from_code, to_code, rate in (ExchangeRate.objects.filter(effective_from__lte=now)
+                                             .order_by('effective_from', 'id')
+                                             .values_list('from_currency_id', 'to_currency_id', 'rate')):
+                rates[(from_code, to_code)] = rate
+            next_change = (ExchangeRate.objects.filter(effective_from__gt=now)
+                           .aggregate(next_change=Min('effective_from'))['next_change'])
+        except DatabaseError:
+            # The tables do not exist before the first migrate, e.g. when the system checks evaluate the choices
+            return RateTable({}, {}, version)
+
+        expires_at = time.monotonic() + self.ttl
+        if next_change is not None:
+            expires_at = min(expires_at, time.monotonic() + (next_change - now).total_seconds())
+        self._table = RateTable(rates, currencies, version)
+        self._expires_at = expires_at
+        self.loads += 1
+        return self._table
+
+    def invalidate(self):
+        """Make the next lookup reload the matrix."""
+        with self._lock:
+            self._version += 1
+
+
+# Process-wide rate cache
+rate_cache = RateCache(ttl=getattr(settings, 'CONVERSION_RATES_TTL', 300))
+
+
+def get_rate_table():
+    """Return the cached exchange-rate matrix."""
+    return rate_cache.get()
+
+
+async def aget_rate_table():
+    """Return the cached exchange-rate matrix without blocking the event loop."""
+    return await rate_cache.aget()
+
+
+def invalidate_rates():
+    """Drop the cached exchange-rate matrix so the next lookup reloads it."""
+    rate_cache.invalidate()
+
+
+def currency_choices():
+    """
+    Return the choices for an account currency, one per currency in the database, e.g. ('gbp', 'GBP').
+
+    :return: List of tuples of the lower case and upper case currency codes
+    """
+    return [(code.lower(), code) for code in get_rate_table().currencies]
+
+
+def get_currency_symbol(code):
+    """
+    Return the symbol of a currency, or the code itself if the currency is unknown.
+
+    :param code: The currency code in any case
+    :return: str
+    """
+    currency = get_rate_table().currencies.get(code.upper())
+    return currency.symbol if currency is not None else code
@@ -0,0 +1,255 @@
+import random
+import threading
+import time
+from bisect import bisect_left
+from decimal import Decimal, InvalidOperation
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from conversion.engine import to_decimal, UnsupportedCurrencyError
+
+# Default remote conversion configuration, overridden by the CONVERSION_REMOTE setting
+DEFAULT_REMOTE_OPTIONS = {
+    'BASE_URL': 'https://localhost:8000',
+    'CONNECT_TIMEOUT': 1,  # Seconds to wait for the TCP/TLS connection
+    'READ_TIMEOUT': 2,  # Seconds to wait for the response once connected
+    'RETRIES': 2,  # Extra attempts after a connection error, timeout or 5xx response
+    'BACKOFF': 0.1,  # Base delay in seconds; attempt n waits a random time up to BACKOFF * 2**n
+    'FAILURE_THRESHOLD': 5,  # Consecutive failed calls before the circuit opens
+    'RESET_TIMEOUT': 30,  # Seconds the circuit stays open before a trial call is let through
+    'POOL_SIZE': 10,  # Keep-alive connections kept open to the conversion service
+    'VERIFY': True,  # TLS verification, or the path of a CA bundle for a self-signed certificate
+}
+
+# Upper bounds in milliseconds of the latency histogram buckets; slower calls fall in a final unbounded bucket
+DEFAULT_LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class RemoteConversionError(Exception):
+    """Exception raised when the remote conversion service cannot convert an amount."""
+
+    def __init__(self, message="The currency conversion service is unavailable"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class CircuitOpenError(RemoteConversionError):
+    """Exception raised without calling the conversion service while its circuit breaker is open."""
+
+    def __init__(self, message="The currency conversion service is failing, try again later"):
+        super().__init__(message)
+
+
+class LatencyHistogram:
+    """Thread-safe histogram of call latencies in milliseconds."""
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._total = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, milliseconds):
+        """Count one call that took the given number of milliseconds."""
+        with self._lock:
+            self._counts[bisect_left(self.buckets, milliseconds)] += 1
+            self._total += milliseconds
+
+    def snapshot(self):
+        """
+        Return the histogram as a dictionary.
+
+        :return: Dictionary with the number of calls, their total milliseconds, and the number of calls per bucket
+                 keyed by the bucket's upper bound in milliseconds (None for the unbounded bucket)
+        """
+        with self._lock:
+            return {
+                'count': sum(self._counts),
+                'sum_ms': self._total,
+                'buckets': dict(zip(self.buckets + (None,), self._counts)),
+            }
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker which opens after failure_threshold consecutive failed calls, failing every call fast for
+    reset_timeout seconds. It then lets a single trial call through: success closes the circuit again, failure
+    reopens it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow(self):
+        """Return True if a call may be made now, letting only one trial call through once the timeout has passed."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class RemoteConversionClient:
+    """
+    Client for a conversion service running as a separate deployment. Calls share a pooled keep-alive session, are
+    bounded by connect and read timeouts, are retried with jittered exponential backoff on connection errors,
+    timeouts and 5xx responses, and fail fast while the circuit breaker is open. The latency of every attempt is
+    recorded in a histogram per outcome.
+    """
+
+    def __init__(self, base_url, connect_timeout=1, read_timeout=2, retries=2, backoff=0.1, failure_threshold=5,
+                 reset_timeout=30, pool_size=10, verify=True, session=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.verify = verify
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        # Latency of every attempt, keyed by its outcome
+        self.latency = {'success': LatencyHistogram(), 'error': LatencyHistogram()}
+        self._counters = {'retries': 0, 'rejected': 0}
+        self._counters_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._counters_lock:
+            self._counters[name] += 1
+
+    def get_metrics(self):
+        """Return the latency histograms, the circuit state and the number of retries and rejected calls."""
+        with self._counters_lock:
+            counters = dict(self._counters)
+        return {
+            'latency': {outcome: histogram.snapshot() for outcome, histogram in self.latency.items()},
+            'circuit': self.breaker.state,
+            **counters,
+        }
+
+    def _get(self, url):
+        """
+        Make the request, retrying failures which may succeed on another attempt.
+
+        :return: The response, or None if every attempt failed
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count('retries')
+                # Full jitter keeps callers that failed together from retrying together
+                time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, timeout=self.timeout, verify=self.verify)
+            except requests.exceptions.RequestException as e:
+                self.latency['error'].record((time.perf_counter() - started) * 1000)
+                print('Error calling the currency conversion service:', e)
+                continue
+            elapsed = (time.perf_counter() - started) * 1000
+            if response.status_code >= 500:
+                self.latency['error'].record(elapsed)
+                print('Error in currency conversion, response status: ' + str(response.status_code))
+                continue
+            self.latency['success'].record(elapsed)
+            return response
+        return None
+
+    def convert(self, from_currency, to_currency, amount):
+        """
+        Convert an amount using the remote conversion service.
+
+        :param from_currency: The currency to convert from
+        :param to_currency: The currency to convert to
+        :param amount: The amount of from_currency to convert
+        :return: Decimal - The amount of to_currency after conversion
+        :raises UnsupportedCurrencyError: if the service does not support either currency
+        :raises RemoteConversionError: if the service could not be reached or gave an invalid response
+        """
+        from_currency = from_currency.upper()
+        to_currency = to_currency.upper()
+        amount = to_decimal(amount)
+        if from_currency == to_currency:
+            return amount
+        if not self.breaker.allow():
+            self._count('rejected')
+            raise CircuitOpenError
+
+        response = self._get(f'{self.base_url}/webapps2024/conversion/{from_currency}/{to_currency}/{amount}/')
+        if response is None:
+            self.breaker.record_failure()
+            raise RemoteConversionError
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        # A body which is not a JSON object means the service is misbehaving, so it counts against the circuit
+        if not isinstance(data, dict):
+            self.breaker.record_failure()
+            raise RemoteConversionError('Invalid response format from currency conversion service')
+        # A 4xx response means the service is up, so it does not count against the circuit
+        self.breaker.record_success()
+
+        if response.status_code != 200:
+            if data.get('error') == 'Unsupported currency':
+                raise UnsupportedCurrencyError
+            raise RemoteConversionError('Error in currency conversion, response status: ' + str(response.status_code))
+        try:
+            # Convert to string to avoid float precision issues
+            return Decimal(str(data['converted_amount']))
+        except (KeyError, InvalidOperation):
+            raise RemoteConversionError('Invalid response format from currency conversion service')
+
+
+# Process-wide remote client, so every call shares its session, circuit breaker and histograms
+_remote_client = None
+_remote_client_lock = threading.Lock()
+
+
+def get_remote_client():
+    """Return the process-wide remote conversion client, building it on first use from the CONVERSION_REMOTE setting."""
+    global _remote_client
+    if _remote_client is None:
+        with _remote_client_lock:
+            if _remote_client is None:
+                options = {**DEFAULT_REMOTE_OPTIONS, **getattr(settings, 'CONVERSION_REMOTE', {})}
+                _remote_client = RemoteConversionClient(options['BASE_URL'],
+                                                        connect_timeout=options['CONNECT_TIMEOUT'],
+                                                        read_timeout=options['READ_TIMEOUT'],
+                                                        retries=options['RETRIES'],
+                                                        backoff=options['BACKOFF'],
+                                                        failure_threshold=options['FAILURE_THRESHOLD'],
+                                                        reset_timeout=options['RESET_TIMEOUT'],
+                                                        pool_size=options['POOL_SIZE'],
+                                                        verify=options['VERIFY'])
+    return _remote_client
@@ -1,6 +1,27 @@
-from django.test import TestCase, Client
-from django.urls import reverse
 import json
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+import requests
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.template import Context, Template
+from django.test import SimpleTestCase, TestCase, Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.throttling import ScopedRateThrottle
+
+from conversion.engine import convert, convert_batch, convert_many, get_rate, UnsupportedCurrencyError
+from conversion.models import Currency, ExchangeRate
+from conversion.rates import currency_choices, get_currency_symbol, get_rate_table, invalidate_rates, RateCache
+from conversion.remote import CircuitBreaker, CircuitOpenError, LatencyHistogram, RemoteConversionClient, \
+    RemoteConversionError
+from payapp.custom_exceptions import CurrencyConversionError
+from payapp.models import Account
+from payapp.utils import convert_currency
+
 
 class TestConversion(TestCase):
     def setUp(self):
@@ -101,3 +122,303 @@ class TestConversion(TestCase):
         response = self.client.post(url)
         self.assertEqual(response.status_code, 405)
         self.assertEqual(response.content.decode(), '{"detail":"Method \\"POST\\" not allowed."}')
+
+
+class TestConversionEngine(TestCase):
+    def test_convert_returns_rounded_decimal(self):
+        """
+        Test that conversions are exact Decimals rounded half up to two places
+        """
+        self.assertEqual(convert('GBP', 'USD', Decimal('100')), Decimal('133.00'))
+        self.assertEqual(convert('usd', 'eur', '4.20'), Decimal('3.57'))
+        self.assertEqual(convert('EUR', 'GBP', Decimal('0.50')), Decimal('0.45'))
+
+    def test_convert_many_matches_convert(self):
+        """
+        Test that a converted column rounds each amount exactly as converting it alone does
+        """
+        amounts = [Decimal(i) / 1000 for i in range(0, 20000, 7)] + ['4.20', 100, '0.005']
+        for from_currency, to_currency in (('USD', 'EUR'), ('EUR', 'GBP'), ('gbp', 'GBP')):
+            self.assertEqual(convert_many(from_currency, to_currency, amounts),
+                             [convert(from_currency, to_currency, amount) for amount in amounts])
+        self.assertEqual(convert_batch([('GBP', 'USD', 100), ('USD', 'EUR', '4.20'), ('GBP', 'usd', '1')]),
+                         [Decimal('133.00'), Decimal('3.57'), Decimal('1.33')])
+
+    def test_same_currency_is_unchanged(self):
+        self.assertEqual(convert('GBP', 'gbp', Decimal('12.345')), Decimal('12.345'))
+        self.assertEqual(get_rate('EUR', 'EUR'), 1)
+
+    def test_unsupported_currency(self):
+        with self.assertRaises(UnsupportedCurrencyError):
+            convert('GBP', 'JPY', 100)
+
+    def test_convert_currency_does_no_network_io(self):
+        """
+        Test that convert_currency uses the engine rather than calling the conversion endpoint
+        """
+        with patch('socket.socket.connect', side_effect=AssertionError("network used")):
+            self.assertEqual(convert_currency('GBP', 'EUR', Decimal('10')), Decimal('11.20'))
+
+    def test_convert_currency_errors(self):
+        with self.assertRaises(CurrencyConversionError):
+            convert_currency('GBP', 'JPY', 100)
+        with self.assertRaises(CurrencyConversionError):
+            convert_currency('GBP', 'USD', 'invalid')
+
+
+
+class TestExchangeRates(TestCase):
+    def setUp(self):
+        # Changes rolled back at the end of a test never reach the commit hook, so drop them from the cache here
+        self.addCleanup(invalidate_rates)
+
+    def add_currency(self, code, name, symbol, rates):
+        """Adds a currency and its rates to and from GBP, committing them so the cache is invalidated."""
+        with self.captureOnCommitCallbacks(execute=True):
+            currency = Currency.objects.create(code=code, name=name, symbol=symbol)
+            for from_code, to_code, rate in rates:
+                ExchangeRate.objects.create(from_currency_id=from_code, to_currency_id=to_code, rate=Decimal(rate))
+        return currency
+
+    def test_seeded_rates(self):
+        self.assertEqual(get_rate('GBP', 'USD'), Decimal('1.33'))
+        self.assertEqual([code for code, _ in currency_choices()], ['eur', 'gbp', 'usd'])
+
+    def test_lookups_do_not_query_the_database(self):
+        """
+        Test that once loaded, rate, choice and symbol lookups are served from the cache
+        """
+        get_rate_table()
+        with self.assertNumQueries(0):
+            convert('GBP', 'EUR', 10)
+            currency_choices()
+            get_currency_symbol('usd')
+
+    def test_new_currency_needs_no_code_change(self):
+        """
+        Test that a currency added to the database is used by conversions, account choices and the symbol filter
+        """
+        self.add_currency('JPY', 'Japanese yen', '¥', [('GBP', 'JPY', '190.5'), ('JPY', 'GBP', '0.0052')])
+        self.assertEqual(convert('GBP', 'JPY', 2), Decimal('381.00'))
+        self.assertIn(('jpy', 'JPY'), currency_choices())
+        self.assertIn(('jpy', 'JPY'), list(Account._meta.get_field('currency').choices))
+        rendered = Template('{% load currency_filters %}{{ code|currency_symbol }}').render(Context({'code': 'jpy'}))
+        self.assertEqual(rendered, '¥')
+        response = self.client.get(reverse('conversion:conversion', args=['GBP', 'JPY', 2]))
+        self.assertEqual(json.loads(response.content)['converted_amount'], 381.0)
+
+    def test_latest_effective_rate_is_used(self):
+        """
+        Test that a new rate replaces the old one only once it is in effect
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            ExchangeRate.objects.create(from_currency_id='GBP', to_currency_id='USD', rate=Decimal('1.25'))
+            ExchangeRate.objects.create(from_currency_id='GBP', to_currency_id='EUR', rate=Decimal('2'),
+                                        effective_from=timezone.now() + timedelta(hours=1))
+        self.assertEqual(get_rate('GBP', 'USD'), Decimal('1.25'))
+        self.assertEqual(get_rate('GBP', 'EUR'), Decimal('1.12'))
+
+    def test_future_rate_expires_the_cache(self):
+        """
+        Test that the cache reloads when a future-dated rate takes effect, even within the TTL
+        """
+        cache = RateCache(ttl=3600)
+        ExchangeRate.objects.create(from_currency_id='GBP', to_currency_id='EUR', rate=Decimal('2'),
+                                    effective_from=timezone.now() + timedelta(milliseconds=200))
+        self.assertEqual(cache.get().rates[('GBP', 'EUR')], Decimal('1.12'))
+        self.assertIs(cache.get(), cache.get())
+        time.sleep(0.25)
+        self.assertEqual(cache.get().rates[('GBP', 'EUR')], Decimal('2'))
+        self.assertEqual(cache.loads, 2)
+
+    def test_invalidation_bumps_version(self):
+        cache = RateCache(ttl=3600)
+        table = cache.get()
+        cache.invalidate()
+        self.assertEqual(cache.get().version, table.version + 1)
+        self.assertEqual(cache.loads, 2)
+
+
+
+class TestBatchConversion(TestCase):
+    def setUp(self):
+        User.objects.create_user(username='user', password='userpassword')
+        self.client.login(username='user', password='userpassword')
+        # The throttle counts requests in the cache, which outlives each test
+        cache.clear()
+
+    def post(self, data):
+        return self.client.post(reverse('conversion:conversion_batch'), data, content_type='application/json')
+
+    def test_items_with_different_pairs(self):
+        response = self.post({'items': [{'from': 'GBP', 'to': 'USD', 'amount': 100},
+                                        {'from': 'usd', 'to': 'eur', 'amount': '4.20'},
+                                        {'from': 'EUR', 'to': 'EUR', 'amount': '1.5'},
+                                        {'from': 'GBP', 'to': 'USD', 'amount': 0.5}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'converted_amounts': ['133.00', '3.57', '1.5', '0.67']})
+
+    def test_column_for_one_pair(self):
+        """
+        Test converting a whole column of amounts, as when revaluing every balance, in one request
+        """
+        amounts = [str(i) for i in range(100000)]
+        response = self.post({'from': 'USD', 'to': 'GBP', 'amounts': amounts})
+        self.assertEqual(response.status_code, 200)
+        converted = response.json()['converted_amounts']
+        self.assertEqual(len(converted), 100000)
+        self.assertEqual(converted[:3], ['0.00', '0.75', '1.50'])
+
+    @override_settings(CONVERSION_BATCH_MAX_ITEMS=2)
+    def test_item_limit(self):
+        response = self.post({'from': 'USD', 'to': 'GBP', 'amounts': [1, 2, 3]})
+        self.assertEqual(response.status_code, 413)
+
+    def test_login_required(self):
+        self.client.logout()
+        self.assertEqual(self.post({'from': 'USD', 'to': 'GBP', 'amounts': [1]}).status_code, 403)
+
+    @patch.object(ScopedRateThrottle, 'THROTTLE_RATES', {'conversion_batch': '2/minute'})
+    def test_requests_are_throttled(self):
+        statuses = [self.post({'from': 'USD', 'to': 'GBP', 'amounts': [1]}).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    def test_unsupported_pair(self):
+        response = self.post({'items': [{'from': 'GBP', 'to': 'USD', 'amount': 1},
+                                        {'from': 'GBP', 'to': 'INV', 'amount': 1}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Unsupported currency', 'pair': 'GBP/INV'})
+
+    def test_invalid_requests(self):
+        for data in ({'amounts': 'many'}, {'items': [{'from': 'GBP', 'amount': 1}]},
+                     {'from': 'GBP', 'to': 'USD', 'amounts': ['1', 'invalid']},
+                     {'from': 'GBP', 'to': 'USD', 'amounts': ['NaN']},
+                     {'from': 'GBP', 'to': 'USD', 'amounts': [-1]},
+                     {'from': 1, 'to': 'USD', 'amounts': [1]}):
+            with self.subTest(data=data):
+                self.assertEqual(self.post(data).status_code, 400)
+
+
+class FakeResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    """Stands in for requests.Session, replying with the scripted responses or raising the scripted errors."""
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = []
+
+    def get(self, url, timeout=None, verify=None):
+        self.calls.append((url, timeout))
+        reply = self.replies.pop(0) if len(self.replies) > 1 else self.replies[0]
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+@patch('conversion.remote.time.sleep')
+class TestRemoteConversionClient(SimpleTestCase):
+    def make_client(self, *replies, **kwargs):
+        options = {'retries': 2, 'failure_threshold': 2, 'reset_timeout': 60}
+        options.update(kwargs)
+        return RemoteConversionClient('https://conversion.test/', session=FakeSession(*replies), **options)
+
+    def test_successful_conversion(self, sleep):
+        """
+        Test that a conversion calls the service once with both timeouts and records its latency
+        """
+        client = self.make_client(FakeResponse(200, {'converted_amount': 133.0}), connect_timeout=1, read_timeout=3)
+        self.assertEqual(client.convert('gbp', 'usd', 100), Decimal('133.0'))
+        self.assertEqual(client.session.calls,
+                         [('https://conversion.test/webapps2024/conversion/GBP/USD/100/', (1, 3))])
+        metrics = client.get_metrics()
+        self.assertEqual(metrics['latency']['success']['count'], 1)
+        self.assertEqual(metrics['latency']['error']['count'], 0)
+        sleep.assert_not_called()
+
+    def test_retries_with_jittered_backoff(self, sleep):
+        """
+        Test that timeouts and 5xx responses are retried with bounded random delays
+        """
+        client = self.make_client(requests.exceptions.ReadTimeout(), FakeResponse(503, {}),
+                                  FakeResponse(200, {'converted_amount': 11.2}), backoff=0.1)
+        self.assertEqual(client.convert('GBP', 'EUR', 10), Decimal('11.2'))
+        self.assertEqual(len(client.session.calls), 3)
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertTrue(0 <= delays[0] <= 0.1 and 0 <= delays[1] <= 0.2)
+        metrics = client.get_metrics()
+        self.assertEqual((metrics['retries'], metrics['latency']['error']['count']), (2, 2))
+
+    def test_gives_up_after_retries(self, sleep):
+        client = self.make_client(requests.exceptions.ConnectionError())
+        with self.assertRaises(RemoteConversionError):
+            client.convert('GBP', 'EUR', 10)
+        self.assertEqual(len(client.session.calls), 3)
+
+    def test_circuit_opens_and_fails_fast(self, sleep):
+        """
+        Test that once the failure threshold is reached calls fail without touching the service
+        """
+        client = self.make_client(requests.exceptions.ConnectionError(), retries=0)
+        for _ in range(2):
+            with self.assertRaises(RemoteConversionError):
+                client.convert('GBP', 'EUR', 10)
+        with self.assertRaises(CircuitOpenError):
+            client.convert('GBP', 'EUR', 10)
+        self.assertEqual(len(client.session.calls), 2)
+        self.assertEqual(client.get_metrics()['circuit'], 'open')
+        self.assertEqual(client.get_metrics()['rejected'], 1)
+
+    def test_circuit_closes_after_successful_trial(self, sleep):
+        client = self.make_client(requests.exceptions.ConnectionError(), requests.exceptions.ConnectionError(),
+                                  FakeResponse(200, {'converted_amount': 11.2}), retries=0, reset_timeout=0)
+        for _ in range(2):
+            with self.assertRaises(RemoteConversionError):
+                client.convert('GBP', 'EUR', 10)
+        self.assertEqual(client.convert('GBP', 'EUR', 10), Decimal('11.2'))
+        self.assertEqual(client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_unsupported_currency_does_not_trip_circuit(self, sleep):
+        client = self.make_client(FakeResponse(400, {'error': 'Unsupported currency'}), failure_threshold=1)
+        with self.assertRaises(UnsupportedCurrencyError):
+            client.convert('GBP', 'JPY', 10)
+        self.assertEqual(client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_non_object_bodies_are_failures(self, sleep):
+        """
+        Test that a JSON body which is not an object raises RemoteConversionError and counts against the circuit
+        """
+        for body in ([133.0], '133.0', None):
+            client = self.make_client(FakeResponse(400, body), failure_threshold=1)
+            with self.assertRaises(RemoteConversionError):
+                client.convert('GBP', 'USD', 100)
+            self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+
+    def test_same_currency_is_not_sent(self, sleep):
+        client = self.make_client(requests.exceptions.ConnectionError())
+        self.assertEqual(client.convert('GBP', 'GBP', 10), Decimal(10))
+        self.assertEqual(client.session.calls, [])
+
+    def test_convert_currency_uses_remote_backend(self, sleep):
+        client = self.make_client(requests.exceptions.ConnectionError(), retries=0)
+        with override_settings(CONVERSION_BACKEND='remote'), patch('payapp.utils.get_remote_client',
+                                                                    return_value=client):
+            with self.assertRaises(CurrencyConversionError):
+                convert_currency('GBP', 'USD', 10)
+        self.assertEqual(len(client.session.calls), 1)
+
+
+class TestLatencyHistogram(SimpleTestCase):
+    def test_buckets(self):
+        histogram = LatencyHistogram(buckets=(10, 100))
+        for milliseconds in (1, 10, 50, 1000):
+            histogram.record(milliseconds)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['buckets'], {10: 2, 100: 1, None: 1})
+        self.assertEqual((snapshot['count'], snapshot['sum_ms']), (4, 1061))
@@ -1,6 +1,7 @@
 from django.urls import path
-from .views import ConversionAPI
+from .views import ConversionAPI, ConversionBatchAPI
 
 urlpatterns = [
+    path('batch/', ConversionBatchAPI.as_view(), name='conversion_batch'),
     path('<str:from_currency>/<str:to_currency>/<str:amount>/', ConversionAPI.as_view(), name='conversion'),
 ]
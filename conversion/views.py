@@ -1,6 +1,10 @@
+from django.conf import settings
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.throttling import ScopedRateThrottle
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from .engine import convert, convert_batch, convert_many, to_decimal, UnsupportedCurrencyError
 from .serializers import ConversionSerializer
 
 
@@ -13,7 +17,8 @@ class ConversionAPI(APIView):
     - to_currency: The currency to convert to
     - amount: The amount to convert
 
-    The API returns the converted amount in the 'converted_amount' field of the response
+    The API returns the converted amount in the 'converted_amount' field of the response. It is a thin wrapper around
+    conversion.engine.convert, which the rest of the application calls directly.
     """
     def get(self, request, from_currency, to_currency, amount):
         # Data preparation for serialization
@@ -40,18 +45,76 @@ class ConversionAPI(APIView):
             to_currency = valid_data['to_currency'].upper()
             amount = valid_data['amount']
 
-            # Dictionary of exchange rates
-            exchange_rates = {
-                'USD': {'EUR': 0.85, 'GBP': 0.75},
-                'EUR': {'USD': 1.18, 'GBP': 0.89},
-                'GBP': {'USD': 1.33, 'EUR': 1.12}
-            }
-
-            if from_currency in exchange_rates and to_currency in exchange_rates[from_currency]:
-                rate = exchange_rates[from_currency][to_currency]
-                converted_amount = round(amount * rate, 2)
-                return Response({'converted_amount': converted_amount})
-            else:
+            # The conversion itself is done in process by the conversion engine
+            try:
+                converted_amount = convert(from_currency, to_currency, amount)
+            except UnsupportedCurrencyError:
                 return Response({'error': 'Unsupported currency'}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({'converted_amount': float(converted_amount)})
+
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class ConversionBatchAPI(APIView):
+    """
+    API to convert many amounts in a single request
+
+    The API expects a POSTed JSON object holding either a list of items, each with its own currency pair:
+    - items: [{"from": "GBP", "to": "USD", "amount": "10.50"}, ...]
+    or a column of amounts for one currency pair:
+    - from: The currency to convert from
+    - to: The currency to convert to
+    - amounts: ["10.50", 20, ...]
+
+    Amounts may be numbers or strings and must not be negative. The API returns the converted amounts as strings, so
+    their exact decimal value is kept, in the 'converted_amounts' field in the same order as the request. A request
+    may hold at most CONVERSION_BATCH_MAX_ITEMS amounts, and is only served to logged-in users, at the
+    'conversion_batch' rate in REST_FRAMEWORK's DEFAULT_THROTTLE_RATES.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [ScopedRateThrottle]
+    throttle_scope = 'conversion_batch'
+
+    def post(self, request):
+        data = request.data
+        max_items = getattr(settings, 'CONVERSION_BATCH_MAX_ITEMS', 100000)
+        if not isinstance(data, dict) or not isinstance(data.get('items', data.get('amounts')), list):
+            return Response({'error': "Expected a list of 'items' or a list of 'amounts'"},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+        values = data['items'] if 'items' in data else data['amounts']
+        if len(values) > max_items:
+            return Response({'error': f'Too many items, at most {max_items} can be converted per request'},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        # The amounts are parsed in one pass rather than through a serializer field each, which would dominate the
+        # time taken by large batches
+        try:
+            if 'items' in data:
+                items = [(item['from'], item['to'], to_decimal(item['amount'])) for item in values]
+                pairs_valid = all(isinstance(f, str) and isinstance(t, str) for f, t, _ in items)
+                amounts = [amount for _, _, amount in items]
+            else:
+                amounts = [to_decimal(amount) for amount in values]
+                pairs_valid = isinstance(data.get('from'), str) and isinstance(data.get('to'), str)
+        except (KeyError, TypeError):
+            return Response({'error': "Each item needs a 'from', 'to' and 'amount'"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        except ValueError:
+            return Response({'error': 'Invalid amount format'}, status=status.HTTP_400_BAD_REQUEST)
+        if not pairs_valid:
+            return Response({'error': "Currencies must be given as 'from' and 'to' codes"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if any(amount < 0 for amount in amounts):
+            return Response({'error': 'Amounts must be greater than or equal to 0'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            if 'items' in data:
+                converted = convert_batch(items)
+            else:
+                converted = convert_many(data['from'], data['to'], amounts)
+        except UnsupportedCurrencyError as e:
+            return Response({'error': 'Unsupported currency', 'pair': '/'.join(e.pair)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({'converted_amounts': [str(amount) for amount in converted]})
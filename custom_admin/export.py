@@ -0,0 +1,168 @@
+import csv
+import json
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+
+from payapp.models import Notification, Request, Transfer
+
+# Columns of each export as (header, model field path) pairs, read with values_list so no model instances are built
+EXPORT_COLUMNS = {
+    'transfers': (Transfer, [
+        ('id', 'id'),
+        ('created_at', 'created_at'),
+        ('sender', 'sender__user__username'),
+        ('receiver', 'receiver__user__username'),
+        ('currency', 'sender__currency'),
+        ('amount', 'amount'),
+        ('type', 'type'),
+    ]),
+    'requests': (Request, [
+        ('id', 'id'),
+        ('created_at', 'created_at'),
+        ('sender', 'sender__user__username'),
+        ('receiver', 'receiver__user__username'),
+        ('currency', 'sender__currency'),
+        ('amount', 'amount'),
+        ('status', 'status'),
+    ]),
+    'notifications': (Notification, [
+        ('id', 'id'),
+        ('created_at', 'created_at'),
+        ('from_user', 'from_user__user__username'),
+        ('to_user', 'to_user__user__username'),
+        ('notification_type', 'notification_type'),
+        ('request', 'request_id'),
+        ('message', 'message'),
+        ('read', 'read'),
+    ]),
+}
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class Echo:
+    """Pseudo-buffer whose write() returns the value written, so csv.writer can format one row at a time."""
+    def write(self, value):
+        return value
+
+
+def export_queryset(kind):
+    """
+    Returns the queryset an export of the given kind reads from, in id order
+    :param kind: One of EXPORT_COLUMNS
+    :return: QuerySet
+    """
+    model, _ = EXPORT_COLUMNS[kind]
+    return model.objects.order_by('id')
+
+
+def export_rows(queryset, kind, chunk_size):
+    """
+    Yields the export columns of every row of the queryset as tuples. The rows are read from a server-side cursor
+    chunk_size at a time, so memory use does not grow with the number of rows.
+    :param queryset: QuerySet from export_queryset, possibly filtered
+    :param kind: One of EXPORT_COLUMNS
+    :param chunk_size: Number of rows fetched from the database at a time
+    :return: Generator of tuples
+    """
+    _, columns = EXPORT_COLUMNS[kind]
+    return queryset.values_list(*[field for _, field in columns]).iterator(chunk_size=chunk_size)
+
+
+async def aexport_rows(queryset, kind, chunk_size):
+    """
+    Async version of export_rows, reading each chunk of rows in a thread so the event loop is free in between. The
+    chunks are read from export_rows rather than QuerySet.aiterator(), as Django 5.0 runs a values_list query's first
+    fetch in the event loop, which raises SynchronousOnlyOperation.
+    :param queryset: QuerySet from export_queryset, possibly filtered
+    :param kind: One of EXPORT_COLUMNS
+    :param chunk_size: Number of rows fetched from the database at a time
+    :return: Async generator of tuples
+    """
+    rows = export_rows(queryset, kind, chunk_size)
+    next_chunk = sync_to_async(lambda: list(islice(rows, chunk_size)))
+    while chunk := await next_chunk():
+        for row in chunk:
+            yield row
+
+
+def stream_csv(rows, kind, header=True):
+    """
+    Yields the rows as lines of CSV, starting with a header line
+    :param rows: Iterable of tuples from export_rows
+    :param kind: One of EXPORT_COLUMNS
+    :param header: Whether to start with the header line
+    :return: Generator of str
+    """
+    _, columns = EXPORT_COLUMNS[kind]
+    writer = csv.writer(Echo())
+    if header:
+        yield writer.writerow([header for header, _ in columns])
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_ndjson(rows, kind, header=True):
+    """
+    Yields the rows as newline delimited JSON objects
+    :param rows: Iterable of tuples from export_rows
+    :param kind: One of EXPORT_COLUMNS
+    :param header: Unused, as NDJSON has no header line
+    :return: Generator of str
+    """
+    _, columns = EXPORT_COLUMNS[kind]
+    headers = [header for header, _ in columns]
+    for row in rows:
+        yield json.dumps(dict(zip(headers, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def in_blocks(lines, block_size):
+    """
+    Joins the lines into blocks of block_size lines, so the server writes to the client once per block rather than
+    once per row
+    :param lines: Iterable of str
+    :param block_size: Number of lines per block
+    :return: Generator of str
+    """
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) >= block_size:
+            yield ''.join(block)
+            block = []
+    if block:
+        yield ''.join(block)
+
+
+STREAMS = {
+    'csv': stream_csv,
+    'ndjson': stream_ndjson,
+}
+
+
+async def astream_blocks(rows, kind, file_format, block_size):
+    """
+    Async version of in_blocks(STREAMS[file_format](rows, kind), block_size) for the rows from aexport_rows. Under
+    ASGI a streaming response over a sync iterator is read into memory before it is sent, so the export is streamed
+    from this instead.
+    :param rows: Async iterable of tuples from aexport_rows
+    :param kind: One of EXPORT_COLUMNS
+    :param file_format: One of STREAMS
+    :param block_size: Number of rows per block
+    :return: Async generator of str
+    """
+    stream = STREAMS[file_format]
+    block = []
+    header = True
+    async for row in rows:
+        block.append(row)
+        if len(block) >= block_size:
+            yield ''.join(stream(block, kind, header=header))
+            block, header = [], False
+    if block or header:
+        yield ''.join(stream(block, kind, header=header))
@@ -0,0 +1,112 @@
+from datetime import datetime, time, timedelta
+
+from django import forms
+from django.db.models import Q
+from django.utils import timezone
+
+from conversion.rates import currency_choices
+from payapp.models import Account, Request, Notification
+
+
+def blank_currency_choices():
+    """
+    Returns the currency choices with a blank choice for any currency
+    :return: List of tuples
+    """
+    return [('', 'Any currency')] + currency_choices()
+
+
+class TransactionFilterForm(forms.Form):
+    """
+    Form to filter the transactions shown in the admin transaction explorer. Every field is optional and the fields
+    left empty do not filter.
+    """
+    KIND_CHOICES = (
+        ('transfers', 'Transfers'),
+        ('requests', 'Requests'),
+    )
+    STATUS_CHOICES = (('', 'Any status'),) + Request.REQUEST_STATUS_CHOICES
+
+    kind = forms.ChoiceField(choices=KIND_CHOICES, required=False)
+    date_from = forms.DateField(required=False, label='From', widget=forms.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(required=False, label='To', widget=forms.DateInput(attrs={'type': 'date'}))
+    user = forms.CharField(required=False, label='Username')
+    currency = forms.ChoiceField(choices=blank_currency_choices, required=False)
+    status = forms.ChoiceField(choices=STATUS_CHOICES, required=False, help_text='Requests only')
+    min_amount = forms.DecimalField(required=False, min_value=0, decimal_places=2, label='Min amount')
+    max_amount = forms.DecimalField(required=False, min_value=0, decimal_places=2, label='Max amount')
+
+    def clean(self):
+        """
+        Checks that the ranges are the right way round
+        :return: dict
+        """
+        cleaned_data = super().clean()
+        date_from, date_to = cleaned_data.get('date_from'), cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise forms.ValidationError("The start date must be before the end date.")
+        min_amount, max_amount = cleaned_data.get('min_amount'), cleaned_data.get('max_amount')
+        if min_amount is not None and max_amount is not None and min_amount > max_amount:
+            raise forms.ValidationError("The minimum amount must not be more than the maximum amount.")
+        return cleaned_data
+
+    def get_kind(self):
+        """
+        Returns the kind of transaction to show, transfers unless requests were chosen
+        :return: str
+        """
+        return (self.cleaned_data.get('kind') if self.is_valid() else None) or 'transfers'
+
+    def filter_queryset(self, queryset):
+        """
+        Applies the filters to a queryset of transfers, requests or notifications. The amount and currency filters use
+        the sender's amount and currency, and the status filter is only applied to requests. Notifications are only
+        filtered by date and user.
+        :param queryset: QuerySet of Transfer, Request or Notification
+        :return: QuerySet
+        """
+        data = self.cleaned_data
+        sender, receiver = ('from_user', 'to_user') if queryset.model is Notification else ('sender', 'receiver')
+        if data.get('date_from'):
+            queryset = queryset.filter(created_at__gte=self.start_of(data['date_from']))
+        if data.get('date_to'):
+            # The end date is inclusive, so everything before the start of the next day
+            queryset = queryset.filter(created_at__lt=self.start_of(data['date_to'] + timedelta(days=1)))
+        if data.get('user'):
+            # Look the accounts up first so the filter can use the sender and receiver indexes
+            accounts = list(Account.objects.filter(user__username=data['user']).values_list('id', flat=True))
+            queryset = queryset.filter(Q(**{f'{sender}_id__in': accounts}) | Q(**{f'{receiver}_id__in': accounts}))
+        if queryset.model is Notification:
+            return queryset
+        if data.get('currency'):
+            queryset = queryset.filter(sender__currency=data['currency'])
+        if data.get('status') and queryset.model is Request:
+            queryset = queryset.filter(status=data['status'])
+        if data.get('min_amount') is not None:
+            queryset = queryset.filter(amount__gte=data['min_amount'])
+        if data.get('max_amount') is not None:
+            queryset = queryset.filter(amount__lte=data['max_amount'])
+        return queryset
+
+    @staticmethod
+    def start_of(day):
+        """
+        Returns the start of a day in the current time zone
+        :param day: date
+        :return: Aware datetime
+        """
+        return timezone.make_aware(datetime.combine(day, time.min))
+
+
+class ExportFilterForm(TransactionFilterForm):
+    """
+    Form to filter the transfers, requests or notifications exported by the admin export, and pick the file format
+    """
+    FORMAT_CHOICES = (
+        ('csv', 'CSV'),
+        ('ndjson', 'NDJSON'),
+    )
+
+    kind = forms.ChoiceField(choices=TransactionFilterForm.KIND_CHOICES + (('notifications', 'Notifications'),),
+                             required=False)
+    format = forms.ChoiceField(choices=FORMAT_CHOICES, required=False)
@@ -1,23 +1,21 @@
+import csv
+import json
+from datetime import timedelta
+from io import StringIO
 from unittest.mock import patch
 
 from django.contrib.auth.models import User, Group
 from django.test import TestCase, Client
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from payapp.models import Account
+from payapp.models import Account, Notification, Request, Transfer
 from register.forms import UserForm
-from thrift_timestamp import server
 
 
 class CustomAdminViewTests(TestCase):
-    # Stops the Thrift server after all tests have run
-    @classmethod
-    def tearDownClass(cls):
-        super().tearDownClass()
-        # Stop the Thrift server
-        server.stop_thrift_server()
-        print("Thrift server stopped")
-
     def setUp(self):
         self.client = Client()
         # Create a user and an admin user
@@ -141,3 +139,105 @@ class CustomAdminViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
+
+class TransactionExplorerTests(TestCase):
+    def setUp(self):
+        self.admin_user = User.objects.create_user(username='adminuser', password='adminpassword')
+        self.admin_user.groups.add(Group.objects.get(name='AdminGroup'))
+        self.alice = Account.objects.create(user=User.objects.create_user(username='alice'), balance=100,
+                                            currency='gbp')
+        self.bob = Account.objects.create(user=User.objects.create_user(username='bob'), balance=100,
+                                          currency='usd')
+        start = timezone.now() - timedelta(days=10)
+        for day in range(10):
+            Transfer.objects.create(sender=self.alice if day % 2 else self.bob,
+                                    receiver=self.bob if day % 2 else self.alice,
+                                    amount=day + 1, created_at=start + timedelta(days=day))
+        Request.objects.create(sender=self.alice, receiver=self.bob, amount=5, status='declined')
+        Request.objects.create(sender=self.bob, receiver=self.alice, amount=7)
+        self.client.login(username='adminuser', password='adminpassword')
+        self.url = reverse('custom_admin:all_transactions')
+
+    def shown(self, **filters):
+        """Returns the amounts of the transactions on the first page for the given filters"""
+        response = self.client.get(self.url, filters)
+        self.assertEqual(response.status_code, 200)
+        return [int(t.amount) for t in response.context['transactions'] or []]
+
+    def test_filters(self):
+        self.assertEqual(self.shown(), list(range(10, 0, -1)))
+        self.assertEqual(self.shown(user='alice', currency='gbp'), [10, 8, 6, 4, 2])
+        self.assertEqual(self.shown(min_amount=3, max_amount=5), [5, 4, 3])
+        yesterday = (timezone.now() - timedelta(days=2)).date()
+        self.assertEqual(self.shown(date_from=yesterday.isoformat(), date_to=yesterday.isoformat()), [9])
+        self.assertEqual(self.shown(kind='requests', status='pending'), [7])
+        self.assertEqual(self.shown(kind='requests', user='nobody'), [])
+
+    def test_invalid_filters_show_errors(self):
+        response = self.client.get(self.url, {'min_amount': 5, 'max_amount': 1})
+        self.assertIsNone(response.context['transactions'])
+        self.assertContains(response, 'The minimum amount must not be more than the maximum amount.')
+
+    def test_pages_in_bounded_queries(self):
+        """
+        Test that a page loads the accounts and users with the transactions rather than once per row, and that the
+        cursor continues where the page ended
+        """
+        query_counts = []
+        for page_size in (2, 8):
+            with self.settings(PAYAPP_PAGE_SIZE=page_size), CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.url)
+            self.assertEqual(len(response.context['transactions']), page_size)
+            query_counts.append(len(queries.captured_queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        self.assertEqual(self.shown(cursor=response.context['transactions'].next_cursor), [2, 1])
+
+    def export(self, **params):
+        """Downloads an export and returns the response and its content"""
+        response = self.client.get(reverse('custom_admin:export_transactions'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_export_csv(self):
+        with self.settings(CUSTOM_ADMIN_EXPORT_CHUNK_SIZE=3):
+            response, content = self.export(user='alice', currency='gbp')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('attachment; filename="transfers-', response['Content-Disposition'])
+        rows = list(csv.reader(StringIO(content)))
+        self.assertEqual(rows[0], ['id', 'created_at', 'sender', 'receiver', 'currency', 'amount', 'type'])
+        self.assertEqual([row[5] for row in rows[1:]], ['2.00', '4.00', '6.00', '8.00', '10.00'])
+
+    def test_export_ndjson(self):
+        Notification.objects.create(to_user=self.alice, from_user=self.bob, message='Hello')
+        response, content = self.export(kind='notifications', format='ndjson', user='bob')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([(row['from_user'], row['to_user'], row['message']) for row in rows],
+                         [('bob', 'alice', 'Hello')])
+
+        response, content = self.export(kind='requests', format='ndjson', status='declined')
+        self.assertEqual([json.loads(line)['amount'] for line in content.splitlines()], ['5.00'])
+
+    async def test_export_streams_blocks_under_asgi(self):
+        """
+        Test that under ASGI the export is an async stream sent a block at a time, the same as the WSGI export
+        """
+        await self.async_client.alogin(username='adminuser', password='adminpassword')
+        with self.settings(CUSTOM_ADMIN_EXPORT_CHUNK_SIZE=3):
+            response = await self.async_client.get(reverse('custom_admin:export_transactions'))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_async)
+            blocks = [block async for block in response.streaming_content]
+        self.assertEqual(len(blocks), 4)
+        rows = list(csv.reader(StringIO(b''.join(blocks).decode())))
+        self.assertEqual(rows[0], ['id', 'created_at', 'sender', 'receiver', 'currency', 'amount', 'type'])
+        self.assertEqual([row[5] for row in rows[1:]], [f'{amount}.00' for amount in range(1, 11)])
+
+    def test_export_rejects_invalid_filters(self):
+        response = self.client.get(reverse('custom_admin:export_transactions'), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+        self.client.logout()
+        response = self.client.get(reverse('custom_admin:export_transactions'))
+        self.assertEqual(response.status_code, 302)
@@ -5,4 +5,5 @@ urlpatterns = [
     path('register/', views.register, name='register'),
     path('all_users/', views.all_users, name='all_users'),
     path('all_transactions/', views.all_transactions, name='all_transactions'),
+    path('export/', views.export_transactions, name='export_transactions'),
 ]
@@ -1,12 +1,20 @@
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIRequest
 from django.db.models import Q
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import redirect, render
+from django.utils import timezone
 from django.contrib import messages
 from django.conf import settings
 
+from custom_admin.export import CONTENT_TYPES, STREAMS, aexport_rows, astream_blocks, export_queryset, export_rows, \
+    in_blocks
+from custom_admin.forms import ExportFilterForm, TransactionFilterForm
 from payapp.custom_exceptions import CurrencyConversionError
 from payapp.models import Account, Transfer, Request
+from payapp.pagination import paginate_list
 from register.forms import UserForm
+from register.permissions import ADMIN_GROUP_NAME, get_admin_group_id, is_admin_user
 
 
 def admin_login_required_message(function):
@@ -19,7 +27,7 @@ def admin_login_required_message(function):
 
         # If the user is logged in and an admin, call the function
         if user.is_authenticated:
-            if user.groups.filter(name="AdminGroup").exists():
+            if is_admin_user(user):
                 return function(request, *args, **kwargs)
             else:
                 messages.error(request, "You need to be an admin to view this page.")
@@ -43,23 +51,69 @@ def all_users(request):
     :return:
     """
     users_list = Account.objects.filter(Q(user__groups=None)).select_related('user')
-    admin_list = Account.objects.filter(Q(user__groups__name="AdminGroup")).select_related('user')
+    admin_list = Account.objects.filter(Q(user__groups__name=ADMIN_GROUP_NAME)).select_related('user')
     context = {'users': users_list, 'admins': admin_list}
     return render(request, 'custom_admin/all_users.html', context)
 
 
+def transaction_queryset(kind):
+    """
+    Returns the transfers or requests with only the columns the explorer shows, loading both accounts and users in
+    the same query
+    :param kind: 'transfers' or 'requests'
+    :return: QuerySet
+    """
+    model = Request if kind == 'requests' else Transfer
+    extra_field = 'status' if model is Request else 'type'
+    return (model.objects.select_related('sender__user', 'receiver__user')
+            .only('id', 'amount', 'created_at', extra_field, 'sender__currency', 'sender__user__username',
+                  'receiver__user__username'))
+
+
 @admin_login_required_message
 def all_transactions(request):
     """
-    Admin view function to display all transactions with admin required decorator
+    Admin view function to explore all transactions with admin required decorator. The transfers or requests are
+    filtered by the query string and shown a page at a time, newest first.
     :param request:
     :return:
     """
-    transfer_list = Transfer.objects.all().order_by('-created_at')
-    request_list = Request.objects.all().order_by('-created_at')
+    form = TransactionFilterForm(request.GET)
+    kind = form.get_kind()
+    page, cursor = None, None
+    if form.is_valid():
+        page, cursor = paginate_list(request, form.filter_queryset(transaction_queryset(kind)))
 
     return render(request, 'custom_admin/all_transactions.html',
-                  {'transfers': transfer_list, 'requests': request_list})
+                  {'form': form, 'kind': kind, 'transactions': page, 'cursor': cursor})
+
+
+@admin_login_required_message
+def export_transactions(request):
+    """
+    Admin view function to download transfers, requests or notifications as CSV or NDJSON with admin required
+    decorator. Takes the filters of the transaction explorer in the query string, plus kind=notifications and
+    format=csv or ndjson. The file is streamed from a server-side cursor, so exports of any size use constant memory.
+    Under ASGI the stream is async, so Django sends it block by block rather than reading it all first.
+    :param request:
+    :return:
+    """
+    form = ExportFilterForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text(), content_type='text/plain')
+    kind = form.get_kind()
+    file_format = form.cleaned_data.get('format') or 'csv'
+    chunk_size = getattr(settings, 'CUSTOM_ADMIN_EXPORT_CHUNK_SIZE', 2000)
+
+    queryset = form.filter_queryset(export_queryset(kind))
+    if isinstance(request, ASGIRequest):
+        content = astream_blocks(aexport_rows(queryset, kind, chunk_size), kind, file_format, chunk_size)
+    else:
+        content = in_blocks(STREAMS[file_format](export_rows(queryset, kind, chunk_size), kind), chunk_size)
+    response = StreamingHttpResponse(content, content_type=CONTENT_TYPES[file_format])
+    filename = f"{kind}-{timezone.now():%Y%m%d-%H%M%S}.{file_format}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 
 @admin_login_required_message
@@ -84,8 +138,7 @@ def register(request):
                 return render(request, 'register/register.html', context)
             # Add the admin to the admin group
             admin = User.objects.get(username=form.cleaned_data.get('username'))
-            admin_group = Group.objects.get(name='AdminGroup')
-            admin.groups.add(admin_group)
+            admin.groups.add(get_admin_group_id())
             # Redirects the user to the home page after registration
             messages.success(request, f"Admin {admin} has been registered.")
             return redirect('home')
@@ -1,22 +1,18 @@
-from django.shortcuts import get_object_or_404
+from payapp.live import live_settings
+from payapp.middleware import get_account, get_unread_notifications_count
 
-from payapp.models import Account, Notification
+# The processors return callables, which templates only call when they use the value, and share the account loaded
+# once per request by get_account, whose unread counter saves counting notifications
 
 
 def get_unread_notifications(request):
     """
-    This function returns the number of incoming transactions for the logged-in user
+    This function returns the number of unread notifications for the logged-in user
     :param request: HttpRequest object
-    :return: Dictionary containing the count of incoming requests
+    :return: Dictionary containing the count of unread notifications
     """
-    incoming_count = None  # Default value
+    return {'unread_notifications_count': lambda: get_unread_notifications_count(request)}
 
-    if request.user.is_authenticated:
-        user_account = get_object_or_404(Account, user=request.user)
-        incoming_count = Notification.objects.filter(to_user=user_account, read=False).count()
-        return {'unread_notifications_count': incoming_count}
-    else:
-        return {'unread_notifications_count': None}
 
 def user_currency(request):
     """
@@ -24,12 +20,11 @@ def user_currency(request):
     :param request:
     :return:
     """
-    if request.user.is_authenticated:
-        user_account = get_object_or_404(Account, user=request.user)
-        currency = user_account.currency
-        return {'user_currency': currency}
-    else:
-        return {'user_currency': None}
+    def currency():
+        account = get_account(request)
+        return account.currency if account is not None else None
+    return {'user_currency': currency}
+
 
 def user_balance(request):
     """
@@ -37,9 +32,16 @@ def user_balance(request):
     :param request:
     :return:
     """
-    if request.user.is_authenticated:
-        user_account = get_object_or_404(Account, user=request.user)
-        balance = user_account.balance
-        return {'user_balance': balance}
-    else:
-        return {'user_balance': None}
+    def balance():
+        account = get_account(request)
+        return account.balance if account is not None else None
+    return {'user_balance': balance}
+
+
+def live_updates(request):
+    """
+    This function returns whether pages load the live update script, which is only enabled under an ASGI server
+    :param request:
+    :return: Dictionary containing whether live updates are enabled
+    """
+    return {'live_updates_enabled': live_settings()['ENABLED']}
@@ -15,3 +15,14 @@ class CurrencyConversionError(Exception):
         print(message)
         self.message = message
         super().__init__(self.message)
+
+
+class UnknownReceiverException(Exception):
+    """
+    Exception raised when a payment is addressed to usernames which have no account.
+    """
+
+    def __init__(self, usernames, message="Some receivers do not exist"):
+        self.usernames = usernames
+        self.message = f"{message}: {', '.join(usernames)}"
+        super().__init__(self.message)
@@ -0,0 +1,82 @@
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery, Sum
+
+from payapp.models import Account, BalanceSnapshot, LedgerEntry
+
+
+def latest_snapshot(account, at=None):
+    """
+    Returns the account's latest balance snapshot, or the latest taken at or before the given time
+    :param account: Account or account id
+    :param at: Aware datetime, None for the latest snapshot
+    :return: BalanceSnapshot or None
+    """
+    snapshots = BalanceSnapshot.objects.filter(account=account)
+    if at is not None:
+        snapshots = snapshots.filter(created_at__lte=at)
+    return snapshots.order_by('-id').first()
+
+
+def sum_entries(entries):
+    """
+    Returns the sum of the amounts of the entries, zero if there are none
+    :param entries: QuerySet of LedgerEntry
+    :return: Decimal
+    """
+    return entries.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+
+
+def balance_as_of(account, at=None):
+    """
+    Returns the account's balance according to the ledger, now or at the given time. The balance is read from the
+    latest snapshot before then plus the entries posted after it, so only a small delta is summed.
+    :param account: Account or account id
+    :param at: Aware datetime, None for the current balance
+    :return: Decimal
+    """
+    snapshot = latest_snapshot(account, at)
+    entries = LedgerEntry.objects.filter(account=account)
+    if at is not None:
+        entries = entries.filter(created_at__lte=at)
+    if snapshot is None:
+        return sum_entries(entries)
+    return snapshot.balance + sum_entries(entries.filter(id__gt=snapshot.last_entry_id))
+
+
+def reconcile_account(account_id, snapshot=True):
+    """
+    Checks the account's balance against its ledger, reading only the entries since its latest snapshot. The account
+    is locked while it is checked so no transfer can post between reading the balance and the entries. If the
+    balance matches and there are new entries, a new snapshot is taken so the next check starts from here.
+    :param account_id: The id of the account
+    :param snapshot: False to only check the account
+    :return: Tuple of the balance on the account and the balance according to the ledger
+    """
+    with transaction.atomic():
+        balance = Account.objects.select_for_update().values_list('balance', flat=True).get(pk=account_id)
+        previous = latest_snapshot(account_id)
+        entries = LedgerEntry.objects.filter(account_id=account_id)
+        if previous is not None:
+            entries = entries.filter(id__gt=previous.last_entry_id)
+        last_entry_id = entries.order_by('-id').values_list('id', flat=True).first()
+        expected = (previous.balance if previous else Decimal('0.00')) + sum_entries(entries)
+        if snapshot and balance == expected and last_entry_id is not None:
+            BalanceSnapshot.objects.create(account_id=account_id, last_entry_id=last_entry_id, balance=expected)
+    return balance, expected
+
+
+def accounts_to_reconcile():
+    """
+    Returns the ids of the accounts with ledger entries after their latest snapshot, the only ones a reconciliation
+    needs to check, found in one query
+    :return: List of account ids
+    """
+    snapshot_entry = (BalanceSnapshot.objects.filter(account=OuterRef('pk')).order_by('-id')
+                      .values('last_entry_id')[:1])
+    newest_entry = LedgerEntry.objects.filter(account=OuterRef('pk')).order_by('-id').values('id')[:1]
+    return list(Account.objects.annotate(snapshot_entry=Subquery(snapshot_entry), newest_entry=Subquery(newest_entry))
+                .filter(Q(snapshot_entry__isnull=True, newest_entry__isnull=False)
+                        | Q(newest_entry__gt=F('snapshot_entry')))
+                .order_by('id').values_list('id', flat=True))
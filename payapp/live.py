@@ -0,0 +1,216 @@
+import asyncio
+import json
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+# Accounts whose changes are read by each poll of the database
+POLL_BATCH_SIZE = 500
+# Most notifications sent by a stream per read, the rest follow on the next read
+STREAM_NOTIFICATIONS = 20
+
+
+def live_settings():
+    """
+    Returns the live update settings, PAYAPP_LIVE over the defaults
+    :return: Dict
+    """
+    return {'ENABLED': False, 'POLL_INTERVAL': 2, 'KEEPALIVE': 15, 'RETRY': 3000,
+            **getattr(settings, 'PAYAPP_LIVE', {})}
+
+
+class Broker:
+    """
+    In-process publish/subscribe of account changes for the live streams.
+
+    Each stream subscribes to its account with an asyncio.Event, which is set when the account changes, so an idle
+    stream costs no more than the event and no query. Changes can be published from any thread, and changes published
+    before a stream wakes coalesce into one wake-up, after which the stream reads the account once.
+
+    Changes made by other processes, such as the outbox worker or another server worker, are not published here, so
+    while anyone is subscribed one poller per process reads every subscribed account in a query per batch and
+    publishes those which changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._poller = None
+
+    def subscribe(self, account_id):
+        """
+        Subscribes to the changes of the account, starting the poller if it is not running. Must be called from the
+        event loop the stream runs in.
+        :param account_id: The id of the account
+        :return: asyncio.Event set when the account changes
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._lock:
+            self._subscribers[account_id].add((loop, event))
+        interval = live_settings()['POLL_INTERVAL']
+        if interval and (self._poller is None or self._poller.done()):
+            self._poller = loop.create_task(poll_accounts(self, interval))
+        return event
+
+    def unsubscribe(self, account_id, event):
+        """
+        Unsubscribes the event, stopping the poller once nobody is subscribed
+        :param account_id: The id of the account
+        :param event: The event returned by subscribe
+        :return: None
+        """
+        with self._lock:
+            subscribers = self._subscribers[account_id]
+            subscribers.difference_update({subscriber for subscriber in subscribers if subscriber[1] is event})
+            if not subscribers:
+                del self._subscribers[account_id]
+            idle = not self._subscribers
+        if idle and self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+
+    def account_ids(self):
+        """
+        Returns the ids of the accounts with subscribers
+        :return: List of account ids
+        """
+        with self._lock:
+            return list(self._subscribers)
+
+    def publish(self, account_ids):
+        """
+        Wakes the streams of the accounts. Safe to call from any thread.
+        :param account_ids: Iterable of account ids
+        :return: None
+        """
+        with self._lock:
+            subscribers = [subscriber for pk in set(account_ids) for subscriber in self._subscribers.get(pk, ())]
+        for loop, event in subscribers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The stream's event loop has closed, it will unsubscribe as it is cleaned up
+                pass
+
+
+broker = Broker()
+
+
+def notify_accounts(*account_ids):
+    """
+    Publishes that the accounts changed once the current transaction commits, so streams never read uncommitted or
+    rolled back changes
+    :param account_ids: The ids of the changed accounts
+    :return: None
+    """
+    transaction.on_commit(lambda: broker.publish(account_ids))
+
+
+async def poll_accounts(broker, interval):
+    """
+    Polls the subscribed accounts every interval seconds, publishing the accounts whose balance, unread counter or
+    newest notification changed since the last poll
+    :param broker: The Broker to read the subscribed accounts from and publish to
+    :param interval: Seconds between polls
+    :return: None
+    """
+    # Imported here as the models publish to this module
+    from payapp.models import Account, Notification
+
+    seen = {}
+    newest_notification = Notification.objects.filter(to_user=OuterRef('pk')).order_by('-id').values('id')[:1]
+    while True:
+        await asyncio.sleep(interval)
+        account_ids = broker.account_ids()
+        changed = []
+        for start in range(0, len(account_ids), POLL_BATCH_SIZE):
+            accounts = (Account.objects.filter(pk__in=account_ids[start:start + POLL_BATCH_SIZE])
+                        .annotate(newest_notification=Subquery(newest_notification))
+                        .values_list('pk', 'balance', 'unread_notifications', 'newest_notification'))
+            async for pk, *state in accounts:
+                if seen.get(pk) != state:
+                    seen[pk] = state
+                    changed.append(pk)
+        # Forget the accounts nobody is subscribed to any more
+        seen = {pk: seen[pk] for pk in account_ids if pk in seen}
+        broker.publish(changed)
+
+
+def format_event(name, data, event_id=None):
+    """
+    Formats a Server-Sent Event
+    :param name: The event name
+    :param data: The JSON serializable data of the event
+    :param event_id: The event id the browser sends back as Last-Event-ID when it reconnects
+    :return: str
+    """
+    lines = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{lines}event: {name}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
+
+
+async def newest_notification_id(account_id):
+    """
+    Returns the id of the account's newest notification, 0 if it has none
+    :param account_id: The id of the account
+    :return: int
+    """
+    from payapp.models import Notification
+
+    return await (Notification.objects.filter(to_user_id=account_id).order_by('-id')
+                  .values_list('id', flat=True).afirst()) or 0
+
+
+async def account_stream(account_id, last_event_id=None):
+    """
+    Yields the Server-Sent Events of an account: its balance and unread notification count when the stream starts
+    and whenever they change, and each new notification. Between changes the stream waits on the broker without
+    touching the database, sending a keepalive comment every KEEPALIVE seconds so proxies keep the connection open.
+    :param account_id: The id of the account
+    :param last_event_id: The id of the last notification the browser received, to resume after a reconnect, None to
+    only send notifications made from now on
+    :return: Async generator of str
+    """
+    from payapp.models import Account, Notification
+
+    options = live_settings()
+    changed = broker.subscribe(account_id)
+    try:
+        yield f'retry: {options["RETRY"]}\n\n'
+        after = last_event_id if last_event_id is not None else await newest_notification_id(account_id)
+        sent = {}
+        while True:
+            # Clear before reading, so a change made while reading wakes the stream again
+            changed.clear()
+            try:
+                account = await Account.objects.values('balance', 'currency', 'unread_notifications').aget(
+                    pk=account_id)
+            except Account.DoesNotExist:
+                return
+            notifications = [notification async for notification in Notification.objects.filter(
+                to_user_id=account_id, id__gt=after).order_by('id').values(
+                'id', 'notification_type', 'message', 'created_at', 'read')[:STREAM_NOTIFICATIONS]]
+            for notification in notifications:
+                yield format_event('notification', notification, notification['id'])
+                after = notification['id']
+            if len(notifications) == STREAM_NOTIFICATIONS:
+                changed.set()
+
+            # Only send the balance and the unread count when they differ from what the browser has
+            for name, data in (('balance', {'balance': account['balance'], 'currency': account['currency']}),
+                               ('unread', {'count': account['unread_notifications']})):
+                if sent.get(name) != data:
+                    yield format_event(name, data)
+                    sent[name] = data
+
+            while not changed.is_set():
+                try:
+                    await asyncio.wait_for(changed.wait(), options['KEEPALIVE'])
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+    finally:
+        broker.unsubscribe(account_id, changed)
@@ -0,0 +1,50 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from payapp.outbox import process_outbox
+
+
+class Command(BaseCommand):
+    help = ("Processes the pending outbox events in batches, making the notifications of payments, until it receives "
+            "SIGTERM or SIGINT. Options default to the PAYAPP_OUTBOX setting.")
+
+    def add_arguments(self, parser):
+        options = getattr(settings, 'PAYAPP_OUTBOX', {})
+        parser.add_argument('--batch-size', type=int, default=options.get('BATCH_SIZE', 500),
+                            help="Events processed per transaction")
+        parser.add_argument('--interval', type=float, default=options.get('POLL_INTERVAL', 1),
+                            help="Seconds to wait before polling again when the outbox is empty")
+        parser.add_argument('--once', action='store_true', help="Process the pending events and exit")
+
+    def handle(self, *args, **options):
+        """
+        Processes batches of events back to back while there are any, polling every interval seconds when the
+        outbox is empty. A batch which fails is retried on the next poll.
+        :param args:
+        :param options:
+        :return:
+        """
+        stop = threading.Event()
+        if not options['once']:
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+            signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+        total = 0
+        while not stop.is_set():
+            try:
+                processed = process_outbox(options['batch_size'])
+            except Exception as e:
+                self.stderr.write(f"Processing the outbox failed, retrying: {e}")
+                processed = 0
+                if options['once']:
+                    raise
+            total += processed
+            if processed < options['batch_size']:
+                if options['once']:
+                    break
+                stop.wait(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f"Processed {total} outbox events."))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from payapp.retention import delete_in_batches, expired_notifications, expired_outbox_events, retention_settings
+
+
+class Command(BaseCommand):
+    help = ("Deletes read notifications and processed outbox events older than their retention period, in batches, so "
+            "the tables only hold recent rows.")
+
+    def add_arguments(self, parser):
+        defaults = retention_settings()
+        parser.add_argument('--days', type=int, default=defaults['NOTIFICATION_DAYS'],
+                            help="Days read notifications are kept")
+        parser.add_argument('--outbox-days', type=int, default=defaults['OUTBOX_DAYS'],
+                            help="Days processed outbox events are kept")
+        parser.add_argument('--batch-size', type=int, default=defaults['BATCH_SIZE'],
+                            help="Rows deleted per statement")
+        parser.add_argument('--dry-run', action='store_true', help="Count the rows without deleting them")
+
+    def handle(self, *args, **options):
+        """
+        Purges the expired notifications and outbox events, reporting how many were deleted.
+        :param args:
+        :param options:
+        :return:
+        """
+        notifications = expired_notifications(options['days'])
+        events = expired_outbox_events(options['outbox_days'])
+        if options['dry_run']:
+            self.stdout.write(f"Would delete {notifications.count()} notifications and {events.count()} outbox "
+                              f"events.")
+            return
+
+        deleted_notifications = delete_in_batches(notifications, options['batch_size'])
+        deleted_events = delete_in_batches(events, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted_notifications} notifications and {deleted_events} outbox events."))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from payapp.models import Account, Notification
+
+
+class Command(BaseCommand):
+    help = ("Recounts the unread notifications of every account and corrects the denormalized "
+            "Account.unread_notifications counters which have drifted.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report drifted counters without fixing them")
+
+    def handle(self, *args, **options):
+        """
+        Finds the accounts whose counter differs from their actual number of unread notifications and corrects them
+        in one UPDATE.
+        :param args:
+        :param options:
+        :return:
+        """
+        unread = (Notification.objects.filter(to_user=OuterRef('pk'), read=False).order_by()
+                  .values('to_user').annotate(count=Count('id')).values('count'))
+        with transaction.atomic():
+            drifted = (Account.objects.select_for_update()
+                       .annotate(actual=Coalesce(Subquery(unread), 0))
+                       .exclude(unread_notifications=F('actual')))
+            drifted_ids = list(drifted.values_list('id', flat=True))
+            if drifted_ids and not options['dry_run']:
+                Account.objects.filter(id__in=drifted_ids).update(unread_notifications=Coalesce(Subquery(unread), 0))
+
+        if options['dry_run']:
+            self.stdout.write(f"{len(drifted_ids)} unread notification counters have drifted.")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Corrected {len(drifted_ids)} unread notification counters."))
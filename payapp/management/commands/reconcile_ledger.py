@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from payapp.ledger import accounts_to_reconcile, reconcile_account
+
+
+class Command(BaseCommand):
+    help = ("Checks the balance of every account with new ledger entries against its ledger, starting from its latest "
+            "balance snapshot, and takes a new snapshot of each account which reconciles.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Check the accounts without taking snapshots")
+
+    def handle(self, *args, **options):
+        """
+        Reconciles the accounts whose ledger has changed since their latest snapshot, reporting those whose balance
+        does not match.
+        :param args:
+        :param options:
+        :return:
+        """
+        account_ids = accounts_to_reconcile()
+        mismatched = 0
+        for account_id in account_ids:
+            balance, expected = reconcile_account(account_id, snapshot=not options['dry_run'])
+            if balance != expected:
+                mismatched += 1
+                self.stdout.write(self.style.ERROR(
+                    f"Account {account_id} has a balance of {balance} but its ledger adds up to {expected}."))
+
+        message = f"Reconciled {len(account_ids)} accounts, {mismatched} did not match the ledger."
+        self.stdout.write(self.style.SUCCESS(message) if not mismatched else message)
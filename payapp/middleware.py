@@ -0,0 +1,71 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.functional import SimpleLazyObject
+
+from payapp.models import Account
+
+
+def get_account(request):
+    """
+    Returns the account of the logged-in user, loading it at most once per request.
+    :param request: HttpRequest object
+    :return: Account or None if the user is not logged in or has no account
+    """
+    if not hasattr(request, '_cached_account'):
+        account = None
+        if request.user.is_authenticated:
+            account = Account.objects.filter(user=request.user).first()
+            if account is not None:
+                # Prime the reverse relation so templates using user.account share this instance
+                request.user.account = account
+        request._cached_account = account
+    return request._cached_account
+
+
+async def aget_account(request):
+    """
+    Async version of get_account for async views. The user and their account are loaded with async calls and cached
+    on the request, replacing the lazy request.user, so context processors and templates read them without a query.
+    :param request: HttpRequest object
+    :return: Account or None if the user is not logged in or has no account
+    """
+    if not hasattr(request, '_cached_account'):
+        request.user = user = await request.auser()
+        account = None
+        if user.is_authenticated:
+            account = await Account.objects.filter(user=user).afirst()
+            # Prime the reverse relation, even when there is no account, so templates reading user.account make no
+            # query
+            Account.user.field.remote_field.set_cached_value(user, account)
+        request._cached_account = account
+    return request._cached_account
+
+
+def get_unread_notifications_count(request):
+    """
+    Returns the number of unread notifications of the logged-in user from the counter on their account, so no
+    notifications are counted.
+    :param request: HttpRequest object
+    :return: int or None if the user is not logged in or has no account
+    """
+    account = get_account(request)
+    return account.unread_notifications if account is not None else None
+
+
+class AccountMiddleware:
+    """
+    Middleware which attaches the logged-in user's account to the request as request.account. The account is a lazy
+    object, so it is only loaded if a view, context processor or template uses it, and then only once. Must come
+    after AuthenticationMiddleware. It does no I/O of its own, so under ASGI it runs in the event loop rather than
+    making Django hand the request to a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        request.account = SimpleLazyObject(lambda: get_account(request))
+        return self.get_response(request)
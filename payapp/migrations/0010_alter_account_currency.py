@@ -0,0 +1,20 @@
+# Generated by Django 5.0.2 on 2026-10-17 22:48
+
+import conversion.rates
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversion', '0002_seed_currencies_and_rates'),
+        ('payapp', '0009_alter_account_created_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='account',
+            name='currency',
+            field=models.CharField(choices=conversion.rates.currency_choices, default='gbp', max_length=3),
+        ),
+    ]
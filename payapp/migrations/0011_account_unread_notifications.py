@@ -0,0 +1,29 @@
+# Generated by Django 5.0.2 on 2026-10-17 22:53
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_unread_notifications(apps, schema_editor):
+    Account = apps.get_model('payapp', 'Account')
+    Notification = apps.get_model('payapp', 'Notification')
+    unread = (Notification.objects.filter(to_user=OuterRef('pk'), read=False).order_by()
+              .values('to_user').annotate(count=Count('id')).values('count'))
+    Account.objects.update(unread_notifications=Coalesce(Subquery(unread), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payapp', '0010_alter_account_currency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='unread_notifications',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_unread_notifications, migrations.RunPython.noop),
+    ]
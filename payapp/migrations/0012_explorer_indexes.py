@@ -0,0 +1,25 @@
+# Generated by Django 5.0.2 on 2026-10-17 23:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payapp', '0011_account_unread_notifications'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['created_at', 'id'], name='request_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='request_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['created_at', 'id'], name='transaction_created_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.0.2 on 2026-10-17 23:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payapp', '0012_explorer_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('read', False)), fields=['to_user', 'created_at', 'id'], name='notification_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['request', 'notification_type'], name='notification_request_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['sender', 'created_at', 'id'], name='request_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['receiver', 'created_at', 'id'], name='request_receiver_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['sender', 'created_at', 'id'], name='request_sender_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['receiver', 'created_at', 'id'], name='request_receiver_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['sender', 'created_at', 'id'], name='transaction_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfer',
+            index=models.Index(fields=['receiver', 'created_at', 'id'], name='transaction_receiver_idx'),
+        ),
+    ]
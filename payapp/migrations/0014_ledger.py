@@ -0,0 +1,71 @@
+# Generated by Django 5.0.2 on 2026-10-17 23:10
+
+import django.db.models.deletion
+import payapp.models
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def open_ledgers(apps, schema_editor):
+    # The existing balances have no history to replay, so each account's ledger opens with its current balance
+    Account = apps.get_model('payapp', 'Account')
+    LedgerEntry = apps.get_model('payapp', 'LedgerEntry')
+    now = timezone.now()
+    LedgerEntry.objects.bulk_create(
+        [LedgerEntry(account_id=account_id, entry_type='opening', amount=balance, created_at=now)
+         for account_id, balance in Account.objects.values_list('id', 'balance').iterator()],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payapp', '0013_access_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_type', models.CharField(choices=[('opening', 'Opening Balance'), ('debit', 'Debit'), ('credit', 'Credit')], max_length=10)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('created_at', payapp.models.ThriftTimestampField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='payapp.account')),
+                ('transfer', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='payapp.transfer')),
+            ],
+            options={
+                'verbose_name': 'Ledger Entry',
+                'verbose_name_plural': 'Ledger Entries',
+                'db_table': 'ledger_entry',
+            },
+        ),
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('created_at', payapp.models.ThriftTimestampField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_snapshots', to='payapp.account')),
+                ('last_entry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='payapp.ledgerentry')),
+            ],
+            options={
+                'verbose_name': 'Balance Snapshot',
+                'verbose_name_plural': 'Balance Snapshots',
+                'db_table': 'balance_snapshot',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['account', 'id'], name='ledger_entry_account_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['account', 'created_at'], name='ledger_entry_account_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='balancesnapshot',
+            index=models.Index(fields=['account', 'id'], name='balance_snapshot_account_idx'),
+        ),
+        migrations.RunPython(open_ledgers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.0.2 on 2026-10-17 23:19
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payapp', '0014_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='idempotency_key',
+            field=models.CharField(blank=True, default=None, max_length=100, null=True, unique=True),
+        ),
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(max_length=100, unique=True)),
+                ('event_type', models.CharField(choices=[('notification', 'Notification')], default='notification', max_length=20)),
+                ('payload', models.JSONField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_at', models.DateTimeField(blank=True, default=None, null=True)),
+            ],
+            options={
+                'verbose_name': 'Outbox Event',
+                'verbose_name_plural': 'Outbox Events',
+                'db_table': 'outbox_event',
+                'indexes': [models.Index(condition=models.Q(('processed_at__isnull', True)), fields=['id'], name='outbox_event_pending_idx')],
+            },
+        ),
+    ]
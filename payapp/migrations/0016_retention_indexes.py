@@ -0,0 +1,21 @@
+# Generated by Django 5.0.2 on 2026-10-17 23:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payapp', '0015_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('read', True)), fields=['created_at'], name='notification_read_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outboxevent',
+            index=models.Index(condition=models.Q(('processed_at__isnull', False)), fields=['processed_at'], name='outbox_event_processed_idx'),
+        ),
+    ]
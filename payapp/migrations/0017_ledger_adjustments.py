@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-17 23:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payapp', '0016_retention_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='entry_type',
+            field=models.CharField(choices=[('opening', 'Opening Balance'), ('debit', 'Debit'), ('credit', 'Credit'), ('adjustment', 'Adjustment')], max_length=10),
+        ),
+    ]
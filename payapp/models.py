@@ -1,20 +1,29 @@
 from django.contrib.auth.models import User
+from conversion.rates import currency_choices
 from payapp.custom_exceptions import InsufficientBalanceException
-from payapp.utils import convert_currency
+from payapp.live import notify_accounts
+from payapp.utils import convert_currency, write_atomic
 from django.db import transaction
 from django.db import models
-from thrift_timestamp.client import ThriftTimestampClient
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from thrift_timestamp.sources import get_timestamp_source, take_reserved_timestamp
 
 
 class ThriftTimestampField(models.DateTimeField):
-    """Defines a custom field to store the current timestamp using a Thrift service."""
+    """
+    Defines a custom field to store the current timestamp from the configured timestamp source (the Thrift service,
+    the local clock or both). Inside a reserve_timestamps block the timestamp is taken from the reserved block.
+    """
 
     def pre_save(self, model_instance, add):
         if add and not getattr(model_instance, self.attname):
-            client = ThriftTimestampClient()
-            timestamp = client.get_current_timestamp()
-            if timestamp is not None:
-                setattr(model_instance, self.attname, timestamp)
+            timestamp = take_reserved_timestamp()
+            if timestamp is None:
+                # The strict Thrift source raises TimestampUnavailableError rather than saving without a timestamp
+                timestamp = get_timestamp_source().now()
+            setattr(model_instance, self.attname, timestamp)
 
         return super().pre_save(model_instance, add)
 
@@ -26,15 +35,18 @@ class Account(models.Model):
     Attributes:
     - user: OneToOneField to User model
     - balance: DecimalField to store account balance
-    - CURRENCY_CHOICES: Tuple of tuples to store currency choices
+    - CURRENCY_CHOICES: Callable returning the currency choices from the Currency table
     - currency: CharField to store currency type
     - created_at: DateTimeField to store account creation date
     - STATUS_CHOICES: Tuple of tuples to store account status choices
     - status: CharField to store account status
+    - unread_notifications: PositiveIntegerField to store the number of unread notifications
 
     Methods:
     - __str__: Returns the username of the user linked to the account
-    - change_balance: Modifies the account balance by a specified amount
+    - from_db: Loads the account, keeping the balance it was loaded with
+    - save: Saves the account, recording the opening balance of a new account, or any change to the balance of an
+      existing one, in the ledger
     """
 
     class Meta:
@@ -44,11 +56,8 @@ class Account(models.Model):
 
     user = models.OneToOneField(User, on_delete=models.CASCADE, null=False, blank=False, related_name='account')
     balance = models.DecimalField(max_digits=10, decimal_places=2, default=1000)
-    CURRENCY_CHOICES = (
-        ('gbp', 'GBP'),
-        ('usd', 'USD'),
-        ('eur', 'EUR'),
-    )
+    # Callable choices read from the cached currency table, so adding a Currency needs no code change
+    CURRENCY_CHOICES = currency_choices
     currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES, default='gbp')
     created_at = ThriftTimestampField()
     STATUS_CHOICES = (
@@ -57,6 +66,9 @@ class Account(models.Model):
         ('suspended', 'Suspended'),
     )
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='active')
+    # Denormalized count of unread notifications, kept in step by Notification.save and Notification.mark_as_read
+    # and rebuilt by the rebuild_unread_counters command
+    unread_notifications = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         """
@@ -66,6 +78,48 @@ class Account(models.Model):
         """
         return self.user.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Loads the account, keeping the balance it was loaded with so save can tell whether it was changed.
+
+        :return: Account
+        """
+        account = super().from_db(db, field_names, values)
+        account._loaded_balance = account.__dict__.get('balance')
+        return account
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        """
+        Saves the account, opening a new account's ledger with its starting balance in the same transaction. Saving a
+        changed balance on an existing account, or saving with 'balance' in update_fields, posts an adjustment entry
+        for the difference from the stored balance, so the ledger still adds up to the balance. Other saves neither
+        lock the row nor touch the ledger.
+
+        :return: None
+        """
+        adding = self._state.adding
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            balance_saved = self.balance != getattr(self, '_loaded_balance', None)
+        else:
+            balance_saved = 'balance' in update_fields
+        previous = None
+        if not adding and balance_saved:
+            # Lock the row so the difference is taken from the balance this save overwrites
+            previous = Account.objects.select_for_update().filter(pk=self.pk).values_list('balance', flat=True).first()
+        super().save(*args, **kwargs)
+        if adding:
+            # The opening balance dates from the account's creation
+            LedgerEntry.objects.create(account=self, entry_type='opening', amount=self.balance,
+                                       created_at=self.created_at)
+        elif previous is not None:
+            balance = self._meta.get_field('balance').to_python(self.balance)
+            if balance != previous:
+                LedgerEntry.objects.create(account=self, entry_type='adjustment', amount=balance - previous)
+        self._loaded_balance = self.balance
+
 
 class Transfer(models.Model):
     """
@@ -87,6 +141,13 @@ class Transfer(models.Model):
         db_table = 'transaction'
         verbose_name = 'Transaction'
         verbose_name_plural = 'Transactions'
+        indexes = [
+            # Newest first paging over every transfer, as in the admin transaction explorer
+            models.Index(fields=['created_at', 'id'], name='transaction_created_idx'),
+            # Newest first paging over the transfers an account sent or received
+            models.Index(fields=['sender', 'created_at', 'id'], name='transaction_sender_idx'),
+            models.Index(fields=['receiver', 'created_at', 'id'], name='transaction_receiver_idx'),
+        ]
 
     sender = models.ForeignKey(Account, on_delete=models.CASCADE,
                                related_name='transaction_sender')
@@ -108,40 +169,68 @@ class Transfer(models.Model):
         """
         return f'{self.sender.user.username} sent {self.amount} to {self.receiver.user.username}'
 
-    @transaction.atomic
+    @write_atomic
     def execute(self, amount):
         """
         Transfers the specified amount from the sender's account to the receiver's account.
 
+        Both accounts are locked with SELECT ... FOR UPDATE in id order, so two transfers between the same accounts in
+        opposite directions cannot deadlock, and the balances are changed with UPDATE statements computed by the
+        database. The sender is only debited WHERE balance >= the amount, so concurrent transfers can neither lose an
+        update nor overdraw the account.
+
         :param amount: The amount to transfer from the sender's account to the receiver's account
 
         :return: None
         """
-        # Checks that the sender has enough balance to transfer the amount
-        if self.sender.balance < amount:
-            raise InsufficientBalanceException
         # Ensures that the amount to transfer is positive so users cannot transfer negative/zero amounts
-        if self.amount <= 0:
+        if self.amount <= 0 or amount <= 0:
             raise ValueError
 
+        # Lock both accounts, always in the same order, and read their current balances and currencies
+        accounts = {account.pk: account for account in
+                    Account.objects.select_for_update().filter(pk__in=[self.sender_id, self.receiver_id])
+                    .order_by('pk').only('balance', 'currency')}
+        sender, receiver = accounts[self.sender_id], accounts[self.receiver_id]
+
         # If the transaction type is a transfer, the amount is subtracted from the sender's balance, convert
         # and add to the receiver's balance
         if self.type == 'transfer':
-            self.sender.balance -= amount
-            converted_amount = convert_currency(self.sender.currency, self.receiver.currency, amount)
-            self.receiver.balance += converted_amount
+            debit = amount
+            credit = convert_currency(sender.currency, receiver.currency, amount)
 
         # If the transaction type is a request, the amount is converted first and then transferred
         else:
-            converted_amount = convert_currency(self.receiver.currency, self.sender.currency, amount)
-            self.sender.balance -= converted_amount
-            self.receiver.balance += amount
-            self.amount = converted_amount
-
-        # Save the sender, receiver and transfer
-        self.sender.save()
-        self.receiver.save()
-        self.save()
+            debit = convert_currency(receiver.currency, sender.currency, amount)
+            credit = amount
+            self.amount = debit
+
+        # Debit the sender only if the balance covers the amount, checked and changed in one statement
+        if not Account.objects.filter(pk=sender.pk, balance__gte=debit).update(balance=F('balance') - debit):
+            raise InsufficientBalanceException
+        Account.objects.filter(pk=receiver.pk).update(balance=F('balance') + credit)
+
+        # Keep any loaded accounts in step with the database, exact as the rows are locked until commit
+        if Transfer.sender.is_cached(self):
+            self.sender.balance = sender.balance - debit
+        if Transfer.receiver.is_cached(self):
+            self.receiver.balance = receiver.balance + credit
+
+        # Save the transfer, only rewriting the amount if it was already saved
+        if self.pk:
+            self.save(update_fields=['amount'])
+        else:
+            self.save()
+
+        # Post the matching debit and credit entries to the ledger, dated with the transfer's timestamp so a payment
+        # takes one timestamp from the source
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(account_id=sender.pk, transfer=self, entry_type='debit', amount=-debit,
+                        created_at=self.created_at),
+            LedgerEntry(account_id=receiver.pk, transfer=self, entry_type='credit', amount=credit,
+                        created_at=self.created_at),
+        ])
+        notify_accounts(sender.pk, receiver.pk)
         return None
 
 
@@ -167,6 +256,19 @@ class Request(models.Model):
         db_table = 'request'
         verbose_name = 'Request'
         verbose_name_plural = 'Requests'
+        indexes = [
+            # Newest first paging over every request, and over the requests with one status
+            models.Index(fields=['created_at', 'id'], name='request_created_idx'),
+            models.Index(fields=['status', 'created_at', 'id'], name='request_status_created_idx'),
+            # Newest first paging over the requests an account made or received
+            models.Index(fields=['sender', 'created_at', 'id'], name='request_sender_idx'),
+            models.Index(fields=['receiver', 'created_at', 'id'], name='request_receiver_idx'),
+            # The pending requests an account made or has to answer, a small share of all requests
+            models.Index(fields=['sender', 'created_at', 'id'], condition=models.Q(status='pending'),
+                         name='request_sender_pending_idx'),
+            models.Index(fields=['receiver', 'created_at', 'id'], condition=models.Q(status='pending'),
+                         name='request_receiver_pending_idx'),
+        ]
 
     sender = models.ForeignKey(Account, on_delete=models.CASCADE,
                                related_name='request_sender')
@@ -202,7 +304,7 @@ class Request(models.Model):
 
         # Checks that the receiver of the request has enough balance to accept the request
         if self.receiver.balance >= amount:
-            with transaction.atomic():
+            with write_atomic():
                 # Creates a transaction
                 transfer = Transfer(sender=self.receiver, receiver=self.sender,
                                     amount=amount, type='request')
@@ -210,7 +312,7 @@ class Request(models.Model):
                 # Executes the transaction
                 transfer.execute(amount)
                 self.status = 'accepted'
-                self.save()
+                self.save(update_fields=['status'])
                 return None
         # If the receiver does not have enough balance to accept the request, raise an exception
         else:
@@ -224,7 +326,7 @@ class Request(models.Model):
         :return: None
         """
         self.status = 'declined'
-        self.save()
+        self.save(update_fields=['status'])
         return None
 
     @transaction.atomic
@@ -235,7 +337,7 @@ class Request(models.Model):
         :return: None
         """
         self.status = 'cancelled'
-        self.save()
+        self.save(update_fields=['status'])
         return None
 
 
@@ -251,6 +353,7 @@ class Notification(models.Model):
     - message: CharField to store notification message
     - created_at: DateTimeField to store notification creation date
     - read: BooleanField to store whether the notification has been read
+    - idempotency_key: CharField to store the key of the outbox event the notification was made from
 
     Methods:
     - __str__: Returns the notification message
@@ -261,6 +364,15 @@ class Notification(models.Model):
         db_table = 'notification'
         verbose_name = 'Notification'
         verbose_name_plural = 'Notifications'
+        indexes = [
+            # Newest first paging over an account's unread notifications, a small share of all notifications
+            models.Index(fields=['to_user', 'created_at', 'id'], condition=models.Q(read=False),
+                         name='notification_unread_idx'),
+            # The notification of a request, looked up when the request is answered
+            models.Index(fields=['request', 'notification_type'], name='notification_request_type_idx'),
+            # Read notifications by age, deleted once past their retention period
+            models.Index(fields=['created_at'], condition=models.Q(read=True), name='notification_read_created_idx'),
+        ]
 
     from_user = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='sent_notification')
     to_user = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='received_notification')
@@ -277,6 +389,8 @@ class Notification(models.Model):
     message = models.CharField(max_length=255)
     created_at = ThriftTimestampField()
     read = models.BooleanField(default=False)
+    # Unique, so an outbox event delivered more than once only makes one notification
+    idempotency_key = models.CharField(max_length=100, unique=True, null=True, blank=True, default=None)
 
     def __str__(self):
         """
@@ -286,13 +400,208 @@ class Notification(models.Model):
         """
         return self.message
 
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        """
+        Saves the notification, counting a new unread notification on the receiving account in the same transaction.
+
+        :return: None
+        """
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding and not self.read:
+            Account.objects.filter(pk=self.to_user_id).update(unread_notifications=F('unread_notifications') + 1)
+            notify_accounts(self.to_user_id)
+
     @transaction.atomic
     def mark_as_read(self):
         """
-        Marks the notification as read.
+        Marks the notification as read and takes it off the receiving account's unread count. The conditional update
+        makes sure a notification marked as read twice, even concurrently, is only taken off once.
 
         :return: None
         """
+        if Notification.objects.filter(pk=self.pk, read=False).update(read=True):
+            Account.objects.filter(pk=self.to_user_id, unread_notifications__gt=0).update(
+                unread_notifications=F('unread_notifications') - 1)
+            notify_accounts(self.to_user_id)
         self.read = True
-        self.save()
         return None
+
+    @staticmethod
+    @transaction.atomic
+    def mark_all_as_read(to_user, *conditions, **filters):
+        """
+        Marks the account's unread notifications matching the conditions and filters as read with one UPDATE, and
+        takes the number marked off the account's unread count with another, without loading any notification. Only
+        notifications which were unread are counted, so concurrent calls never take one off twice.
+
+        :param to_user: The Account whose notifications are marked
+        :param conditions: Q objects the notifications must match
+        :param filters: Field lookups the notifications must match
+        :return: int: The number of notifications marked as read
+        """
+        marked = Notification.objects.filter(*conditions, to_user=to_user, read=False, **filters).update(read=True)
+        if marked:
+            Account.objects.filter(pk=to_user.pk).update(
+                unread_notifications=Greatest(F('unread_notifications') - marked, 0))
+            notify_accounts(to_user.pk)
+        return marked
+
+
+class LedgerEntry(models.Model):
+    """
+    LedgerEntry model for the append-only, double-entry record of every balance change.
+
+    Every account opens with an entry for its starting balance and every executed transfer posts a debit entry on the
+    sender's account and a matching credit entry on the receiver's, each in its account's currency. A balance changed
+    by saving the account posts an adjustment entry, so an account's balance is always the sum of its entries. Entries
+    are never changed or deleted.
+
+    Attributes:
+    - account: ForeignKey to Account model for the account whose balance changed
+    - transfer: ForeignKey to Transfer model for the transfer which posted the entry, None for opening balances and
+      adjustments
+    - ENTRY_TYPE_CHOICES: Tuple of tuples to store entry type choices
+    - entry_type: CharField to store entry type
+    - amount: DecimalField to store the signed change in balance, negative for debits
+    - created_at: DateTimeField to store entry creation date
+
+    Methods:
+    - __str__: Returns the account and the change in balance
+    - save: Saves a new entry, refusing to change an existing one
+    - delete: Refuses to delete the entry
+    """
+
+    class Meta:
+        db_table = 'ledger_entry'
+        verbose_name = 'Ledger Entry'
+        verbose_name_plural = 'Ledger Entries'
+        indexes = [
+            # An account's entries after a snapshot, and up to a point in time
+            models.Index(fields=['account', 'id'], name='ledger_entry_account_idx'),
+            models.Index(fields=['account', 'created_at'], name='ledger_entry_account_time_idx'),
+        ]
+
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='ledger_entries')
+    transfer = models.ForeignKey(Transfer, on_delete=models.CASCADE, null=True, blank=True, default=None,
+                                 related_name='ledger_entries')
+    ENTRY_TYPE_CHOICES = (
+        ('opening', 'Opening Balance'),
+        ('debit', 'Debit'),
+        ('credit', 'Credit'),
+        ('adjustment', 'Adjustment'),
+    )
+    entry_type = models.CharField(max_length=10, choices=ENTRY_TYPE_CHOICES)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    created_at = ThriftTimestampField()
+
+    def __str__(self):
+        """
+        Returns the account and the change in balance.
+
+        :return: str: The account and the change in balance
+        """
+        return f'{self.get_entry_type_display()} of {self.amount} on account {self.account_id}'
+
+    def save(self, *args, **kwargs):
+        """
+        Saves a new entry. The ledger is append-only, so an entry which has already been saved cannot be changed.
+
+        :return: None
+        """
+        if not self._state.adding:
+            raise ValueError("Ledger entries cannot be changed once saved")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        """
+        Refuses to delete the entry, as the ledger is append-only.
+        """
+        raise ValueError("Ledger entries cannot be deleted")
+
+
+class BalanceSnapshot(models.Model):
+    """
+    BalanceSnapshot model for storing an account's balance checked against the ledger.
+
+    A snapshot records the balance made up by the account's entries up to and including last_entry, so the balance at
+    any later point is the snapshot plus the few entries after it, and reconciling the account only has to read
+    those entries.
+
+    Attributes:
+    - account: ForeignKey to Account model for the account
+    - last_entry: ForeignKey to LedgerEntry model for the last entry included in the snapshot
+    - balance: DecimalField to store the balance after last_entry
+    - created_at: DateTimeField to store snapshot creation date
+    """
+
+    class Meta:
+        db_table = 'balance_snapshot'
+        verbose_name = 'Balance Snapshot'
+        verbose_name_plural = 'Balance Snapshots'
+        indexes = [
+            # An account's latest snapshot
+            models.Index(fields=['account', 'id'], name='balance_snapshot_account_idx'),
+        ]
+
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='balance_snapshots')
+    last_entry = models.ForeignKey(LedgerEntry, on_delete=models.CASCADE, related_name='+')
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+    created_at = ThriftTimestampField()
+
+    def __str__(self):
+        """
+        Returns the account and its balance.
+
+        :return: str: The account and its balance
+        """
+        return f'Account {self.account_id} had {self.balance} at {self.created_at}'
+
+
+class OutboxEvent(models.Model):
+    """
+    OutboxEvent model for the transactional outbox of work done after a payment commits.
+
+    Payments append an event in their own transaction instead of doing the work themselves, and the process_outbox
+    command does it in batches in the background. Events are delivered at least once, so each carries an idempotency
+    key which the work it causes is recorded under.
+
+    Attributes:
+    - idempotency_key: CharField to store the key identifying the event, unique so it is only published once
+    - EVENT_TYPE_CHOICES: Tuple of tuples to store event type choices
+    - event_type: CharField to store event type
+    - payload: JSONField to store the event data
+    - created_at: DateTimeField to store event creation date
+    - processed_at: DateTimeField to store when the event was processed, None while it is pending
+    """
+
+    class Meta:
+        db_table = 'outbox_event'
+        verbose_name = 'Outbox Event'
+        verbose_name_plural = 'Outbox Events'
+        indexes = [
+            # The pending events, oldest first, a small share of all events
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True), name='outbox_event_pending_idx'),
+            # Processed events by age, deleted once past their retention period
+            models.Index(fields=['processed_at'], condition=models.Q(processed_at__isnull=False),
+                         name='outbox_event_processed_idx'),
+        ]
+
+    idempotency_key = models.CharField(max_length=100, unique=True)
+    EVENT_TYPE_CHOICES = (
+        ('notification', 'Notification'),
+    )
+    event_type = models.CharField(max_length=20, choices=EVENT_TYPE_CHOICES, default='notification')
+    payload = models.JSONField()
+    # Read from the local clock, as the outbox is on the payment's critical path
+    created_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True, default=None)
+
+    def __str__(self):
+        """
+        Returns the event type and idempotency key.
+
+        :return: str: The event type and idempotency key
+        """
+        return f'{self.event_type} {self.idempotency_key}'
@@ -0,0 +1,137 @@
+from collections import Counter
+from datetime import datetime
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from payapp.live import notify_accounts
+from payapp.models import Account, Notification, OutboxEvent, Request
+
+
+def notification_event(to_user, from_user, notification_type, message, created_at, request=None, key=None):
+    """
+    Returns an unsaved outbox event which makes a notification when processed
+    :param to_user: The Account notified
+    :param from_user: The Account the notification is from
+    :param notification_type: One of Notification.NOTIFICATION_TYPE_CHOICES
+    :param message: The notification message
+    :param created_at: The time the notification is dated
+    :param request: The Request the notification is about, if any
+    :param key: The idempotency key, defaults to the notification type and the request's id
+    :return: OutboxEvent
+    """
+    if key is None:
+        key = f'{notification_type}:{request.pk}'
+    return OutboxEvent(idempotency_key=key, event_type='notification', payload={
+        'to_user': to_user.pk,
+        'from_user': from_user.pk,
+        'notification_type': notification_type,
+        'message': message,
+        'request': request.pk if request is not None else None,
+        'created_at': created_at.isoformat(),
+    })
+
+
+def publish(*events):
+    """
+    Appends the events to the outbox in the current transaction. An event whose idempotency key was already published
+    is skipped, so retrying a publish is harmless.
+    :param events: OutboxEvents
+    :return: None
+    """
+    OutboxEvent.objects.bulk_create(events, ignore_conflicts=True)
+
+
+def publish_notification(*args, **kwargs):
+    """
+    Publishes an outbox event which makes a notification when processed, taking the arguments of notification_event
+    :return: None
+    """
+    publish(notification_event(*args, **kwargs))
+
+
+def count_unread(counts):
+    """
+    Adds the numbers of new unread notifications to the accounts' counters in one UPDATE
+    :param counts: Dict of account id to the number of new unread notifications
+    :return: None
+    """
+    if counts:
+        Account.objects.filter(pk__in=counts).update(unread_notifications=F('unread_notifications') + Case(
+            *[When(pk=pk, then=Value(count)) for pk, count in counts.items()], default=Value(0)))
+        notify_accounts(*counts)
+
+
+def delivered_keys(keys):
+    """
+    Returns the idempotency keys of the notifications already made
+    :param keys: Iterable of idempotency keys
+    :return: Set of idempotency keys
+    """
+    return set(Notification.objects.filter(idempotency_key__in=keys).values_list('idempotency_key', flat=True))
+
+
+def insert_notifications(notifications):
+    """
+    Inserts the notifications with bulk_create, skipping any whose idempotency key was used since it was checked, as
+    by another worker delivering the same event. If the batch conflicts, each notification is inserted in a savepoint
+    of its own, so exactly the ones inserted are known.
+    :param notifications: List of unsaved Notifications
+    :return: List of the notifications inserted
+    """
+    try:
+        with transaction.atomic():
+            return Notification.objects.bulk_create(notifications)
+    except IntegrityError:
+        inserted = []
+        for notification in notifications:
+            try:
+                with transaction.atomic():
+                    inserted += Notification.objects.bulk_create([notification])
+            except IntegrityError:
+                pass
+        return inserted
+
+
+def materialize_notifications(events):
+    """
+    Makes the notifications of the events, skipping those already made from an earlier delivery of the same event. A
+    request notification whose request has been answered in the meantime is made already read.
+    :param events: List of notification OutboxEvents
+    :return: The number of notifications made
+    """
+    delivered = delivered_keys([event.idempotency_key for event in events])
+    events = [event for event in events if event.idempotency_key not in delivered]
+    request_ids = {event.payload['request'] for event in events if event.payload['notification_type'] == 'request_sent'}
+    answered = set(Request.objects.filter(pk__in=request_ids).exclude(status='pending').values_list('pk', flat=True))
+
+    notifications = [
+        Notification(to_user_id=event.payload['to_user'], from_user_id=event.payload['from_user'],
+                     notification_type=event.payload['notification_type'], message=event.payload['message'],
+                     request_id=event.payload['request'],
+                     created_at=datetime.fromisoformat(event.payload['created_at']),
+                     read=event.payload['notification_type'] == 'request_sent' and event.payload['request'] in answered,
+                     idempotency_key=event.idempotency_key)
+        for event in events]
+    inserted = insert_notifications(notifications)
+    # Count the new unread notifications, which bulk_create does not do
+    count_unread(Counter(notification.to_user_id for notification in inserted if not notification.read))
+    return len(inserted)
+
+
+def process_outbox(batch_size=500):
+    """
+    Processes the oldest batch of pending outbox events in one transaction, marking them processed. If processing
+    fails the transaction is rolled back and the events stay pending, so every event is processed at least once.
+    Workers running at the same time skip each other's locked events where the database supports it.
+    :param batch_size: The largest number of events to process
+    :return: The number of events processed
+    """
+    with transaction.atomic():
+        events = list(OutboxEvent.objects.select_for_update(skip_locked=True)
+                      .filter(processed_at__isnull=True).order_by('id')[:batch_size])
+        if events:
+            materialize_notifications([event for event in events if event.event_type == 'notification'])
+            OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).update(processed_at=timezone.now())
+    return len(events)
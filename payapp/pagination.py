@@ -0,0 +1,178 @@
+import base64
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib import messages
+from django.db.models import Q
+
+
+class InvalidCursor(Exception):
+    """Exception raised when a pagination cursor cannot be decoded."""
+
+    def __init__(self, message="Invalid pagination cursor"):
+        self.message = message
+        super().__init__(self.message)
+
+
+def encode_cursor(created_at, pk):
+    """
+    Encodes the position of a row as an opaque, URL safe cursor.
+    :param created_at: The created_at of the last row on the page
+    :param pk: The id of the last row on the page
+    :return: str
+    """
+    payload = json.dumps([created_at.isoformat(), pk], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor made by encode_cursor.
+    :param cursor: str
+    :return: Tuple of the created_at and id the next page starts after
+    :raises InvalidCursor: if the cursor was not made by encode_cursor
+    """
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, pk = json.loads(payload)
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, TypeError):
+        raise InvalidCursor
+
+
+def get_page_size(requested=None):
+    """
+    Returns the page size to use, defaulting to the PAYAPP_PAGE_SIZE setting and capped at PAYAPP_MAX_PAGE_SIZE.
+    :param requested: The page size asked for by the client, if any
+    :return: int
+    """
+    page_size = getattr(settings, 'PAYAPP_PAGE_SIZE', 25)
+    if requested:
+        try:
+            page_size = int(requested)
+        except (TypeError, ValueError):
+            pass
+    return max(1, min(page_size, getattr(settings, 'PAYAPP_MAX_PAGE_SIZE', 100)))
+
+
+class KeysetPage:
+    """
+    One page of rows, newest first.
+
+    Attributes:
+    - items: List of the rows on the page
+    - next_cursor: Cursor of the following (older) page, or None if this is the last page
+    - has_next: True if there is a following page
+    """
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+
+def page_queryset(queryset, cursor, page_size):
+    """
+    Returns the queryset of the rows of one page, newest first, plus one more row which shows whether there is a
+    following page.
+    :param queryset: QuerySet of a model with created_at and id fields
+    :param cursor: Cursor of the page, None for the first page
+    :param page_size: Number of rows per page
+    :return: QuerySet
+    :raises InvalidCursor: if the cursor cannot be decoded
+    """
+    queryset = queryset.order_by('-created_at', '-id')
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    return queryset[:page_size + 1]
+
+
+def make_page(items, page_size):
+    """
+    Returns the page of the rows fetched by page_queryset, dropping the extra row if there is one.
+    :param items: List of the rows fetched
+    :param page_size: Number of rows per page
+    :return: KeysetPage
+    """
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(items[-1].created_at, items[-1].id)
+    return KeysetPage(items, next_cursor)
+
+
+def paginate(queryset, cursor=None, page_size=None):
+    """
+    Returns one page of the queryset, newest first, using keyset pagination on (created_at, id). Each page is found
+    by seeking past the last row of the previous one, so it costs the same however far back it is, and rows added
+    while paging do not shift or repeat rows on later pages.
+    :param queryset: QuerySet of a model with created_at and id fields
+    :param cursor: Cursor of the page to return, None for the first page
+    :param page_size: Number of rows per page, defaults to get_page_size()
+    :return: KeysetPage
+    :raises InvalidCursor: if the cursor cannot be decoded
+    """
+    page_size = page_size or get_page_size()
+    return make_page(list(page_queryset(queryset, cursor, page_size)), page_size)
+
+
+async def apaginate(queryset, cursor=None, page_size=None):
+    """
+    Async version of paginate, fetching the page with the async ORM.
+    :param queryset: QuerySet of a model with created_at and id fields
+    :param cursor: Cursor of the page to return, None for the first page
+    :param page_size: Number of rows per page, defaults to get_page_size()
+    :return: KeysetPage
+    :raises InvalidCursor: if the cursor cannot be decoded
+    """
+    page_size = page_size or get_page_size()
+    return make_page([item async for item in page_queryset(queryset, cursor, page_size)], page_size)
+
+
+def paginate_list(request, queryset, param='cursor'):
+    """
+    Returns the page of the queryset selected by the cursor in the given query parameter, showing the newest page
+    with an error message if the cursor is invalid
+    :param request: The request, whose page_size query parameter sets the page size
+    :param queryset: QuerySet to paginate
+    :param param: Name of the query parameter holding the cursor
+    :return: Tuple of the KeysetPage and the cursor it was found with
+    """
+    cursor = request.GET.get(param)
+    page_size = get_page_size(request.GET.get('page_size'))
+    try:
+        return paginate(queryset, cursor, page_size), cursor
+    except InvalidCursor:
+        messages.error(request, "That page could not be found, showing the newest instead.")
+        return paginate(queryset, None, page_size), None
+
+
+async def apaginate_list(request, queryset, param='cursor'):
+    """
+    Async version of paginate_list, fetching the page with the async ORM
+    :param request: The request, whose page_size query parameter sets the page size
+    :param queryset: QuerySet to paginate
+    :param param: Name of the query parameter holding the cursor
+    :return: Tuple of the KeysetPage and the cursor it was found with
+    """
+    cursor = request.GET.get(param)
+    page_size = get_page_size(request.GET.get('page_size'))
+    try:
+        return await apaginate(queryset, cursor, page_size), cursor
+    except InvalidCursor:
+        messages.error(request, "That page could not be found, showing the newest instead.")
+        return await apaginate(queryset, None, page_size), None
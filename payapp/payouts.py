@@ -0,0 +1,104 @@
+from collections import defaultdict
+
+from django.db.models import Case, F, Value, When
+
+from conversion.engine import to_decimal
+from conversion.rates import get_currency_symbol
+from payapp.custom_exceptions import InsufficientBalanceException, UnknownReceiverException
+from payapp.live import notify_accounts
+from payapp.models import Account, LedgerEntry, Transfer
+from payapp.outbox import notification_event, publish
+from payapp.utils import convert_currency_many, write_atomic
+from thrift_timestamp.sources import reserve_timestamps
+
+# Receivers credited by each UPDATE statement, which sets every receiver's balance with one CASE expression
+CREDIT_BATCH_SIZE = 500
+
+
+def credit_accounts(credits):
+    """
+    Adds the amounts to the accounts' balances, a batch of accounts per UPDATE statement
+    :param credits: Dict of account id to the amount to add
+    :return: None
+    """
+    account_ids = sorted(credits)
+    for start in range(0, len(account_ids), CREDIT_BATCH_SIZE):
+        batch = account_ids[start:start + CREDIT_BATCH_SIZE]
+        Account.objects.filter(pk__in=batch).update(balance=F('balance') + Case(
+            *[When(pk=pk, then=Value(credits[pk])) for pk in batch], output_field=Account._meta.get_field('balance')))
+
+
+@write_atomic
+def execute_payouts(sender, payouts):
+    """
+    Pays several receivers from one account in a single transaction. The receivers are looked up in one query, the
+    amounts are converted once per receiving currency, the sender is debited once for the total and the transfers,
+    ledger entries are written with bulk_create, taking their timestamps from one reserved block, and the notifications
+    are published to the outbox in one statement. Either every payout is made or none is.
+
+    :param sender: The paying Account
+    :param payouts: List of (receiver username, amount in the sender's currency) pairs
+    :return: List of the Transfers made, in the order of the payouts
+    :raises ValueError: if an amount is not positive or a payout is to the sender
+    :raises UnknownReceiverException: if a username has no account
+    :raises InsufficientBalanceException: if the sender cannot cover the total
+    :raises CurrencyConversionError: if an amount cannot be converted
+    """
+    payouts = [(username, to_decimal(amount)) for username, amount in payouts]
+    if not payouts or any(amount <= 0 for _, amount in payouts):
+        raise ValueError("Every payout needs a positive amount")
+
+    # Look every receiver up in one query
+    usernames = {username for username, _ in payouts}
+    receivers = {account.user.username: account for account in
+                 Account.objects.filter(user__username__in=usernames).select_related('user')}
+    missing = sorted(usernames - receivers.keys())
+    if missing:
+        raise UnknownReceiverException(missing)
+    if any(account.pk == sender.pk for account in receivers.values()):
+        raise ValueError("You cannot send money to yourself")
+
+    # Lock the sender and the receivers in id order, like Transfer.execute, so payouts cannot deadlock with transfers
+    locked = {account.pk: account for account in
+              Account.objects.select_for_update().filter(pk__in=[sender.pk] + [a.pk for a in receivers.values()])
+              .order_by('pk').only('balance', 'currency')}
+
+    # Convert the amounts once per receiving currency
+    by_currency = defaultdict(list)
+    for index, (username, amount) in enumerate(payouts):
+        by_currency[locked[receivers[username].pk].currency].append(index)
+    converted = [None] * len(payouts)
+    for currency, indexes in by_currency.items():
+        amounts = convert_currency_many(locked[sender.pk].currency, currency, [payouts[i][1] for i in indexes])
+        for index, amount in zip(indexes, amounts):
+            converted[index] = amount
+
+    # Debit the sender once, only if the balance covers the total
+    total = sum(amount for _, amount in payouts)
+    if not Account.objects.filter(pk=sender.pk, balance__gte=total).update(balance=F('balance') - total):
+        raise InsufficientBalanceException
+    sender.balance = locked[sender.pk].balance - total
+
+    credits = defaultdict(lambda: 0)
+    for (username, _), amount in zip(payouts, converted):
+        credits[receivers[username].pk] += amount
+    # Transfers and their debit and credit ledger entries, all timestamped from one block
+    with reserve_timestamps(len(payouts) * 3):
+        transfers = Transfer.objects.bulk_create([
+            Transfer(sender=sender, receiver=receivers[username], amount=amount, type='transfer')
+            for username, amount in payouts])
+        LedgerEntry.objects.bulk_create(
+            [entry for transfer, amount in zip(transfers, converted) for entry in (
+                LedgerEntry(account_id=sender.pk, transfer=transfer, entry_type='debit', amount=-transfer.amount),
+                LedgerEntry(account_id=transfer.receiver_id, transfer=transfer, entry_type='credit', amount=amount),
+            )])
+    # Credit every receiver
+    credit_accounts(credits)
+    notify_accounts(sender.pk, *credits)
+    # Leave the notifications to the outbox worker
+    symbol = get_currency_symbol(locked[sender.pk].currency)
+    publish(*[notification_event(to_user=transfer.receiver, from_user=sender, notification_type='payment_sent',
+                                 message=f"You have received {symbol}{transfer.amount} from {sender.user.username}",
+                                 created_at=transfer.created_at, key=f'payment_sent:{transfer.pk}')
+              for transfer in transfers])
+    return transfers
@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from payapp.models import Notification, OutboxEvent
+
+
+def retention_settings():
+    """
+    Returns the retention settings, PAYAPP_RETENTION over the defaults
+    :return: Dict
+    """
+    return {'NOTIFICATION_DAYS': 90, 'OUTBOX_DAYS': 7, 'BATCH_SIZE': 1000, **getattr(settings, 'PAYAPP_RETENTION', {})}
+
+
+def delete_in_batches(queryset, batch_size):
+    """
+    Deletes the rows of the queryset batch_size at a time, each batch a short statement of its own so the table is
+    never locked for long and the rows deleted so far stay deleted if the purge is stopped
+    :param queryset: QuerySet of the rows to delete
+    :param batch_size: The largest number of rows deleted by one statement
+    :return: The number of rows deleted
+    """
+    deleted = 0
+    while True:
+        batch = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return deleted
+        # Nothing refers to these models, so the delete is a single DELETE with no rows loaded
+        deleted += queryset.model.objects.filter(pk__in=batch).delete()[0]
+        if len(batch) < batch_size:
+            return deleted
+
+
+def expired_notifications(days):
+    """
+    Returns the read notifications made more than the given number of days ago. Unread notifications are kept however
+    old they are.
+    :param days: The number of days read notifications are kept
+    :return: QuerySet
+    """
+    return Notification.objects.filter(read=True, created_at__lt=timezone.now() - timedelta(days=days))
+
+
+def expired_outbox_events(days):
+    """
+    Returns the outbox events processed more than the given number of days ago. Pending events are always kept.
+    :param days: The number of days processed events are kept
+    :return: QuerySet
+    """
+    return OutboxEvent.objects.filter(processed_at__lt=timezone.now() - timedelta(days=days))
@@ -0,0 +1,60 @@
+from django.conf import settings
+from rest_framework import serializers
+
+from payapp.models import Transfer, Request, Notification
+
+
+class TransferSerializer(serializers.ModelSerializer):
+    """
+    This class is used to serialize the transfers served by the transfers API
+    """
+    sender = serializers.CharField(source='sender.user.username')
+    receiver = serializers.CharField(source='receiver.user.username')
+    currency = serializers.CharField(source='sender.currency')
+
+    class Meta:
+        model = Transfer
+        fields = ['id', 'sender', 'receiver', 'amount', 'currency', 'type', 'created_at']
+
+
+class RequestSerializer(serializers.ModelSerializer):
+    """
+    This class is used to serialize the payment requests served by the requests API
+    """
+    sender = serializers.CharField(source='sender.user.username')
+    receiver = serializers.CharField(source='receiver.user.username')
+    currency = serializers.CharField(source='sender.currency')
+
+    class Meta:
+        model = Request
+        fields = ['id', 'sender', 'receiver', 'amount', 'currency', 'status', 'created_at']
+
+
+class NotificationSerializer(serializers.ModelSerializer):
+    """
+    This class is used to serialize the notifications served by the notifications API
+    """
+    class Meta:
+        model = Notification
+        fields = ['id', 'notification_type', 'message', 'request', 'read', 'created_at']
+
+
+class PayoutSerializer(serializers.Serializer):
+    """
+    This class is used to validate one payout of a bulk payout
+    """
+    receiver = serializers.CharField(max_length=150)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0.01)
+
+
+class BulkPayoutSerializer(serializers.Serializer):
+    """
+    This class is used to validate the request data for the bulk payout API
+    """
+    payouts = PayoutSerializer(many=True, allow_empty=False)
+
+    def validate_payouts(self, payouts):
+        max_items = getattr(settings, 'PAYAPP_BULK_PAYOUT_MAX_ITEMS', 1000)
+        if len(payouts) > max_items:
+            raise serializers.ValidationError(f"At most {max_items} payouts can be made at once.")
+        return payouts
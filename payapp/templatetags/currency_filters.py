@@ -1,19 +1,15 @@
 from django import template
 
-register = template.Library()
+from conversion.rates import get_currency_symbol
 
-CURRENCY_SYMBOLS = {
-    'GBP': '£',
-    'USD': '$',
-    'EUR': '€',
-}
+register = template.Library()
 
 
 @register.filter
 def currency_symbol(value):
     """
-    This function is used to get the currency symbol for the given currency code.
+    This function is used to get the currency symbol for the given currency code from the cached currency table.
     :param value: Currency code
     :return:
     """
-    return CURRENCY_SYMBOLS.get(value.upper(), value)
+    return get_currency_symbol(value)
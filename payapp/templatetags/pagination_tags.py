@@ -0,0 +1,20 @@
+from django import template
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def cursor_url(context, param, cursor=None):
+    """
+    This function is used to build the URL of another page of a paginated list, keeping the rest of the query string
+    so each list on a page keeps its own position.
+    :param context: Template context holding the request
+    :param param: Name of the query parameter holding the list's cursor
+    :param cursor: Cursor of the page to link to, None for the newest page
+    :return: str
+    """
+    query = context['request'].GET.copy()
+    query.pop(param, None)
+    if cursor:
+        query[param] = cursor
+    return f"?{query.urlencode()}" if query else context['request'].path
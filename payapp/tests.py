@@ -1,18 +1,39 @@
+import asyncio
+import json
+import random
+import time
+from decimal import Decimal
+from io import StringIO
+from contextlib import suppress
 from threading import Thread
-from django.test import TestCase, Client
+from unittest import skipUnless
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction, OperationalError
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.models import User, Group
-from payapp.models import Account, Request, Notification
-from thrift_timestamp import server
+from datetime import timedelta
+
+from django.utils import timezone
+from payapp.models import (Account, Request, Notification, Transfer, LedgerEntry, BalanceSnapshot,
+                           OutboxEvent)
+from conversion.engine import convert
+from conversion.rates import invalidate_rates
+from payapp import views
+from payapp.custom_exceptions import InsufficientBalanceException
+from payapp.ledger import balance_as_of, reconcile_account
+from payapp.live import broker
+from payapp.outbox import materialize_notifications, notification_event, process_outbox, publish, publish_notification
+from payapp.pagination import paginate, decode_cursor, encode_cursor, InvalidCursor
+from payapp.utils import write_atomic
+from thrift_timestamp.sources import get_timestamp_source
 
 class PayAppViewTests(TestCase):
-    @classmethod
-    def tearDownClass(cls):
-        super().tearDownClass()
-        # Stop the Thrift server
-        server.stop_thrift_server()
-        print('Thrift server stopped.')
-
     def setUp(self):
         self.client = Client()
         # Create a user and an admin user
@@ -51,6 +72,9 @@ class PayAppViewTests(TestCase):
         self.assertTrue(Request.objects.filter(sender__user=self.user, receiver__user=receiver).exists())
         self.assertEqual(response.status_code, 302)  # Redirect to home indicates success
 
+        # Notifications are made by the outbox worker
+        process_outbox()
+
         # Verify that a notification has been created for the receiver
         self.assertTrue(Notification.objects.filter(to_user__user=receiver, from_user__user=self.user,
                                                     notification_type='request_sent').exists())
@@ -88,6 +112,9 @@ class PayAppViewTests(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertEqual(req.status, 'accepted')  # The request is accepted successfully
 
+        # Notifications are made by the outbox worker
+        process_outbox()
+
         # Verify that a notification has been created for the sender indicating the request was accepted
         self.assertTrue(Notification.objects.filter(to_user=receiver_account, from_user=sender_account,
                                                     notification_type='request_accepted').exists())
@@ -128,6 +155,9 @@ class PayAppViewTests(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertEqual(req.status, 'declined')  # The request is declined successfully
 
+        # Notifications are made by the outbox worker
+        process_outbox()
+
         # Verify that a notification has been created for the sender
         self.assertTrue(Notification.objects.filter(to_user=req.sender, from_user=req.receiver,
                                                     notification_type='request_declined').exists())
@@ -150,6 +180,9 @@ class PayAppViewTests(TestCase):
         self.assertEqual(response.status_code, 302)  # Redirect to home indicates success
         self.assertEqual(req.status, 'cancelled')  # The request is cancelled successfully
 
+        # Notifications are made by the outbox worker
+        process_outbox()
+
         # Verify that a notification has been created for the receiver
         self.assertTrue(Notification.objects.filter(to_user=req.receiver, from_user=req.sender,
                                                     notification_type='request_cancelled').exists())
@@ -177,6 +210,9 @@ class PayAppViewTests(TestCase):
         self.assertEqual(sender_account.balance, 90)  # 100 - 10
         self.assertEqual(receiver_account.balance, 60)  # 50 + 10
 
+        # Notifications are made by the outbox worker
+        process_outbox()
+
         # Verify that a notification has been created for the receiver
         self.assertTrue(Notification.objects.filter(to_user=receiver_account, from_user=sender_account,
                                                     notification_type='payment_sent').exists())
@@ -209,3 +245,772 @@ class PayAppViewTests(TestCase):
             'receiver': 'nonexistentuser',
         })
         self.assertEqual(response.status_code, 200)
+
+    def count_queries_on(self, table, url):
+        """Loads the page and returns how many queries selected from the given table"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return sum(1 for query in queries.captured_queries if f'FROM "{table}"' in query['sql'])
+
+    def test_account_is_loaded_once_per_page(self):
+        """
+        Test that the view and the context processors share one account lookup
+        """
+        self.assertEqual(self.count_queries_on('account', reverse('payapp:send_payment')), 1)
+        self.assertEqual(self.count_queries_on('account', reverse('home')), 1)
+        # The unread badge reads the counter on the account rather than counting notifications
+        self.assertEqual(self.count_queries_on('notification', reverse('home')), 0)
+
+    def test_posts_load_the_sender_account_once(self):
+        """
+        Test that requests and payments reuse the request's account as the sender rather than loading it again
+        """
+        Account.objects.create(user=User.objects.create_user(username='receiver'), balance=50)
+        data = {'amount': 10, 'receiver': 'receiver', 'message': 'Test'}
+        with self.assertNumQueries(11):
+            response = self.client.post(reverse('payapp:make_request'), data)
+        self.assertEqual(response.status_code, 302)
+        with self.assertNumQueries(17):
+            response = self.client.post(reverse('payapp:send_payment'), data)
+        self.assertEqual(response.status_code, 302)
+
+    def test_account_is_not_loaded_for_anonymous_users(self):
+        self.client.logout()
+        self.assertEqual(self.count_queries_on('account', reverse('register:login')), 0)
+
+    def test_unread_counter_is_maintained(self):
+        """
+        Test that creating notifications counts them on the receiving account and marking them read, even twice,
+        takes them off once
+        """
+        sender = Account.objects.get(user=self.admin_user)
+        receiver = Account.objects.get(user=self.user)
+        first = Notification.objects.create(to_user=receiver, from_user=sender, message='First')
+        Notification.objects.create(to_user=receiver, from_user=sender, message='Second')
+        Notification.objects.create(to_user=receiver, from_user=sender, message='Read', read=True)
+        receiver.refresh_from_db()
+        self.assertEqual(receiver.unread_notifications, 2)
+
+        first.mark_as_read()
+        Notification.objects.get(pk=first.pk).mark_as_read()
+        receiver.refresh_from_db()
+        self.assertEqual(receiver.unread_notifications, 1)
+        self.assertTrue(Notification.objects.get(pk=first.pk).read)
+
+    def test_unread_counter_follows_request_flow(self):
+        """
+        Test the counters through making and accepting a request
+        """
+        receiver = Account.objects.get(user=self.admin_user)
+        self.client.post(reverse('payapp:make_request'), {'amount': 10, 'receiver': 'adminuser'})
+        process_outbox()
+        receiver.refresh_from_db()
+        self.assertEqual(receiver.unread_notifications, 1)
+
+        self.client.login(username='adminuser', password='adminpassword')
+        self.client.get(reverse('payapp:accept_request', args=[Request.objects.get().id]))
+        process_outbox()
+        receiver.refresh_from_db()
+        self.assertEqual(receiver.unread_notifications, 0)
+        self.assertEqual(Account.objects.get(user=self.user).unread_notifications, 1)
+
+    def test_rebuild_unread_counters(self):
+        """
+        Test that the repair command corrects drifted counters
+        """
+        sender = Account.objects.get(user=self.admin_user)
+        receiver = Account.objects.get(user=self.user)
+        Notification.objects.create(to_user=receiver, from_user=sender, message='Unread')
+        Account.objects.filter(pk=receiver.pk).update(unread_notifications=5)
+        Account.objects.filter(pk=sender.pk).update(unread_notifications=1)
+
+        out = StringIO()
+        call_command('rebuild_unread_counters', stdout=out)
+        self.assertIn('Corrected 2', out.getvalue())
+        receiver.refresh_from_db()
+        sender.refresh_from_db()
+        self.assertEqual((receiver.unread_notifications, sender.unread_notifications), (1, 0))
+
+
+class PaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='userpassword')
+        self.other = User.objects.create_user(username='other', password='otherpassword')
+        self.account = Account.objects.create(user=self.user, balance=100)
+        self.other_account = Account.objects.create(user=self.other, balance=100)
+        # Transfers a second apart, with the last two sharing a timestamp so the id breaks the tie
+        start = timezone.now() - timedelta(days=1)
+        self.transfers = [Transfer.objects.create(sender=self.account, receiver=self.other_account, amount=i,
+                                                  created_at=start + timedelta(seconds=min(i, 3)))
+                          for i in range(5)]
+        self.client.login(username='user', password='userpassword')
+
+    def collect_pages(self, queryset, page_size):
+        """Follows the cursors through every page, returning the ids of each page"""
+        pages, cursor = [], None
+        while True:
+            page = paginate(queryset, cursor, page_size)
+            pages.append([row.id for row in page])
+            if not page.has_next:
+                return pages
+            cursor = page.next_cursor
+
+    def test_pages_cover_every_row_once(self):
+        newest_first = [t.id for t in reversed(self.transfers)]
+        pages = self.collect_pages(Transfer.objects.all(), 2)
+        self.assertEqual(pages, [newest_first[0:2], newest_first[2:4], newest_first[4:]])
+
+    def test_pages_are_stable_across_inserts(self):
+        first = paginate(Transfer.objects.all(), None, 2)
+        Transfer.objects.create(sender=self.account, receiver=self.other_account, amount=99)
+        second = paginate(Transfer.objects.all(), first.next_cursor, 2)
+        self.assertEqual([t.id for t in second], [self.transfers[2].id, self.transfers[1].id])
+
+    def test_cursor_round_trip_and_invalid_cursor(self):
+        created_at = self.transfers[0].created_at
+        self.assertEqual(decode_cursor(encode_cursor(created_at, 7)), (created_at, 7))
+        for cursor in ('not-a-cursor', 'W10', encode_cursor(created_at, 7)[:-3]):
+            with self.assertRaises(InvalidCursor):
+                paginate(Transfer.objects.all(), cursor)
+
+    def test_transfers_view_pages(self):
+        response = self.client.get(reverse('payapp:transfers'), {'page_size': 2})
+        self.assertEqual([t.id for t in response.context['transfers']],
+                         [self.transfers[4].id, self.transfers[3].id])
+        self.assertContains(response, 'Older')
+
+        response = self.client.get(reverse('payapp:transfers'),
+                                   {'page_size': 2, 'cursor': response.context['transfers'].next_cursor})
+        self.assertEqual([t.id for t in response.context['transfers']],
+                         [self.transfers[2].id, self.transfers[1].id])
+
+        # An invalid cursor shows the newest page
+        response = self.client.get(reverse('payapp:transfers'), {'cursor': 'garbage'})
+        self.assertEqual(len(response.context['transfers']), 5)
+
+    def test_requests_view_pages_each_list(self):
+        for i in range(3):
+            Request.objects.create(sender=self.account, receiver=self.other_account, amount=i)
+        Request.objects.create(sender=self.other_account, receiver=self.account, amount=5)
+        response = self.client.get(reverse('payapp:requests'), {'page_size': 2})
+        self.assertEqual(len(response.context['outgoing_requests']), 2)
+        self.assertTrue(response.context['outgoing_requests'].has_next)
+        self.assertEqual(len(response.context['incoming_requests']), 1)
+        self.assertEqual(len(response.context['completed_requests']), 0)
+
+        response = self.client.get(reverse('payapp:requests'), {
+            'page_size': 2, 'outgoing_cursor': response.context['outgoing_requests'].next_cursor})
+        self.assertEqual(len(response.context['outgoing_requests']), 1)
+        self.assertEqual(len(response.context['incoming_requests']), 1)
+
+    def test_transfers_api(self):
+        url = reverse('payapp:transfers_api')
+        response = self.client.get(url, {'page_size': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([t['id'] for t in response.json()['results']], [t.id for t in self.transfers[:1:-1]])
+        self.assertEqual(response.json()['results'][0]['receiver'], 'other')
+
+        response = self.client.get(url, {'page_size': 3, 'cursor': response.json()['next_cursor']})
+        self.assertEqual([t['id'] for t in response.json()['results']], [t.id for t in self.transfers[1::-1]])
+        self.assertIsNone(response.json()['next_cursor'])
+
+        self.assertEqual(self.client.get(url, {'cursor': 'garbage'}).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_requests_and_notifications_api(self):
+        Request.objects.create(sender=self.other_account, receiver=self.account, amount=5)
+        Notification.objects.create(to_user=self.account, from_user=self.other_account, message='Hello')
+        response = self.client.get(reverse('payapp:requests_api'), {'kind': 'incoming'})
+        self.assertEqual([r['sender'] for r in response.json()['results']], ['other'])
+        self.assertEqual(self.client.get(reverse('payapp:requests_api'), {'kind': 'bogus'}).status_code, 400)
+        response = self.client.get(reverse('payapp:notifications_api'))
+        self.assertEqual([n['message'] for n in response.json()['results']], ['Hello'])
+
+
+@skipUnless(connection.vendor == 'sqlite', "Reads SQLite's EXPLAIN QUERY PLAN output")
+class QueryPlanTests(TestCase):
+    """
+    Regression tests checking with EXPLAIN that the hot queries are answered from an index rather than by scanning a
+    whole table
+    """
+    def setUp(self):
+        self.account = Account.objects.create(user=User.objects.create_user(username='user'), balance=100)
+        self.other_account = Account.objects.create(user=User.objects.create_user(username='other'), balance=100)
+
+    def assertUsesIndex(self, queryset, table, index=None, sorted_by_index=False):
+        """
+        Asserts that the query does not scan the table, optionally that it reads the given index and that its
+        ordering comes from the index rather than a sort
+        """
+        plan = queryset.explain()
+        self.assertNotRegex(plan, rf'SCAN {table}(?! USING)', f"The query scans {table}:\n{plan}")
+        if index:
+            self.assertIn(f'INDEX {index}', plan)
+        if sorted_by_index:
+            self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan)
+
+    def page(self, queryset):
+        """Returns the query a keyset page of the queryset runs"""
+        return queryset.order_by('-created_at', '-id')[:26]
+
+    def test_table_scans_are_detected(self):
+        self.assertRegex(Transfer.objects.filter(amount=5).explain(), r'SCAN transaction(?! USING)')
+
+    def test_transfer_queries(self):
+        self.assertUsesIndex(self.page(Transfer.objects.filter(sender=self.account)), 'transaction',
+                             'transaction_sender_idx', sorted_by_index=True)
+        self.assertUsesIndex(self.page(Transfer.objects.filter(receiver=self.account)), 'transaction',
+                             'transaction_receiver_idx', sorted_by_index=True)
+        self.assertUsesIndex(self.page(views.transfer_list_for(self.account)), 'transaction')
+        self.assertUsesIndex(self.page(Transfer.objects.all()), 'transaction', 'transaction_created_idx',
+                             sorted_by_index=True)
+
+    def test_request_queries(self):
+        self.assertUsesIndex(self.page(views.request_list_for(self.account, 'incoming')), 'request',
+                             'request_receiver_pending_idx', sorted_by_index=True)
+        self.assertUsesIndex(self.page(views.request_list_for(self.account, 'outgoing')), 'request',
+                             'request_sender_pending_idx', sorted_by_index=True)
+        self.assertUsesIndex(self.page(views.request_list_for(self.account, 'completed')), 'request')
+        self.assertUsesIndex(self.page(Request.objects.filter(status='accepted')), 'request',
+                             'request_status_created_idx', sorted_by_index=True)
+
+    def test_notification_queries(self):
+        self.assertUsesIndex(self.page(views.notification_list_for(self.account)), 'notification',
+                             'notification_unread_idx', sorted_by_index=True)
+        request = Request.objects.create(sender=self.account, receiver=self.other_account, amount=1)
+        self.assertUsesIndex(Notification.objects.filter(request=request, notification_type='request_sent'),
+                             'notification', 'notification_request_type_idx')
+
+
+class ConcurrentTransferTests(TransactionTestCase):
+    """
+    Stress test running many transfers between a few accounts from several threads at once
+    """
+    THREADS = 8
+    TRANSFERS_PER_THREAD = 40
+
+    def setUp(self):
+        self.accounts = [Account.objects.create(user=User.objects.create_user(username=f'user{i}'), balance=50,
+                                                currency='gbp')
+                         for i in range(4)]
+
+    def run_transfers(self, seed, results):
+        """
+        Makes random transfers between the accounts, retrying when the database is busy. Each thread counts into its
+        own results, so no increment is lost to another thread.
+        """
+        generator = random.Random(seed)
+        try:
+            for _ in range(self.TRANSFERS_PER_THREAD):
+                sender, receiver = generator.sample(self.accounts, 2)
+                amount = Decimal(generator.randint(1, 30))
+                while True:
+                    try:
+                        with transaction.atomic():
+                            transfer = Transfer(sender_id=sender.pk, receiver_id=receiver.pk, amount=amount)
+                            transfer.execute(amount)
+                        results['done'] += 1
+                        break
+                    except InsufficientBalanceException:
+                        results['refused'] += 1
+                        break
+                    except OperationalError:
+                        # SQLite refuses concurrent writers rather than queueing them, so try again
+                        time.sleep(0.001)
+        except Exception as e:
+            results['errors'].append(e)
+        finally:
+            connection.close()
+
+    def test_balances_are_conserved(self):
+        thread_results = [{'done': 0, 'refused': 0, 'errors': []} for _ in range(self.THREADS)]
+        threads = [Thread(target=self.run_transfers, args=(seed, thread_results[seed])) for seed in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results = {'done': sum(result['done'] for result in thread_results),
+                   'refused': sum(result['refused'] for result in thread_results),
+                   'errors': [e for result in thread_results for e in result['errors']]}
+
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(results['done'] + results['refused'], self.THREADS * self.TRANSFERS_PER_THREAD)
+        balances = list(Account.objects.filter(pk__in=[account.pk for account in self.accounts])
+                        .values_list('balance', flat=True))
+        # No money was created or lost, and no account was overdrawn
+        self.assertEqual(sum(balances), 50 * len(self.accounts))
+        self.assertTrue(all(balance >= 0 for balance in balances))
+        # Every completed transfer was recorded, and the ledger agrees with every balance
+        self.assertEqual(Transfer.objects.count(), results['done'])
+        for account in self.accounts:
+            account.refresh_from_db()
+            self.assertEqual(balance_as_of(account), account.balance)
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.sender = Account.objects.create(user=User.objects.create_user(username='sender'), balance=100,
+                                             currency='gbp')
+        self.receiver = Account.objects.create(user=User.objects.create_user(username='receiver'), balance=100,
+                                               currency='gbp')
+
+    def transfer(self, amount):
+        transfer = Transfer(sender=self.sender, receiver=self.receiver, amount=amount)
+        transfer.execute(Decimal(amount))
+        return transfer
+
+    def test_transfers_post_double_entries(self):
+        transfer = self.transfer(30)
+        entries = list(transfer.ledger_entries.order_by('id').values_list('account_id', 'entry_type', 'amount'))
+        self.assertEqual(entries, [(self.sender.pk, 'debit', Decimal('-30.00')),
+                                   (self.receiver.pk, 'credit', Decimal('30.00'))])
+        self.assertEqual(balance_as_of(self.sender), Decimal('70.00'))
+        self.assertEqual(balance_as_of(self.receiver), Decimal('130.00'))
+
+    def test_transfers_take_one_timestamp(self):
+        source = get_timestamp_source()
+        with patch.object(source, 'now', wraps=source.now) as now:
+            transfer = self.transfer(30)
+        self.assertEqual(now.call_count, 1)
+        self.assertEqual(set(transfer.ledger_entries.values_list('created_at', flat=True)), {transfer.created_at})
+
+    def test_balance_as_of_uses_snapshot_and_delta(self):
+        self.transfer(10)
+        reconcile_account(self.sender.pk)
+        between = timezone.now()
+        self.transfer(5)
+        self.assertEqual(BalanceSnapshot.objects.get(account=self.sender).balance, Decimal('90.00'))
+        self.assertEqual(balance_as_of(self.sender, between), Decimal('90.00'))
+        self.assertEqual(balance_as_of(self.sender), Decimal('85.00'))
+        self.assertEqual(balance_as_of(self.sender, timezone.now() - timedelta(days=1)), Decimal('0.00'))
+
+    def test_balance_changes_post_adjustments(self):
+        self.sender.balance = Decimal('150.00')
+        self.sender.save()
+        self.sender.status = 'inactive'
+        self.sender.save(update_fields=['status'])
+        self.sender.save()
+        self.assertEqual(list(LedgerEntry.objects.filter(account=self.sender).order_by('id')
+                              .values_list('entry_type', 'amount')),
+                         [('opening', Decimal('100.00')), ('adjustment', Decimal('50.00'))])
+        self.assertEqual(balance_as_of(self.sender), Decimal('150.00'))
+
+        # The adjustment is taken from the stored balance, so a transfer made since the account was loaded is kept
+        stale = Account.objects.get(pk=self.receiver.pk)
+        self.transfer(30)
+        stale.balance = 0
+        stale.save()
+        self.assertEqual(LedgerEntry.objects.filter(account=self.receiver).latest('id').amount, Decimal('-130.00'))
+        self.assertEqual(balance_as_of(self.receiver), Decimal('0.00'))
+
+    def test_saves_without_a_balance_change_skip_the_ledger(self):
+        account = Account.objects.get(pk=self.sender.pk)
+        with CaptureQueriesContext(connection) as queries:
+            account.status = 'inactive'
+            account.save()
+            account.save(update_fields=['status'])
+        self.assertFalse(any(query['sql'].startswith('SELECT') for query in queries.captured_queries))
+        self.assertEqual(LedgerEntry.objects.filter(account=self.sender).count(), 1)
+
+    def test_entries_are_append_only(self):
+        entry = LedgerEntry.objects.filter(account=self.sender).get()
+        entry.amount = 1000
+        with self.assertRaises(ValueError):
+            entry.save()
+        with self.assertRaises(ValueError):
+            entry.delete()
+
+    def test_reconcile_ledger_command(self):
+        call_command('reconcile_ledger', stdout=StringIO())
+        self.transfer(20)
+        out = StringIO()
+        call_command('reconcile_ledger', stdout=out)
+        self.assertIn('Reconciled 2 accounts, 0 did not match', out.getvalue())
+        self.assertEqual(BalanceSnapshot.objects.filter(account=self.receiver).count(), 2)
+
+        # Only accounts with new entries are checked again, and a balance changed outside the ledger is reported
+        self.transfer(5)
+        Account.objects.filter(pk=self.receiver.pk).update(balance=1)
+        out = StringIO()
+        call_command('reconcile_ledger', stdout=out)
+        self.assertIn(f'Account {self.receiver.pk} has a balance of 1.00 but its ledger adds up to 125.00',
+                      out.getvalue())
+        self.assertIn('Reconciled 2 accounts, 1 did not match', out.getvalue())
+        self.assertEqual(BalanceSnapshot.objects.filter(account=self.receiver).count(), 2)
+
+
+class BulkPayoutTests(TestCase):
+    def setUp(self):
+        self.payer = Account.objects.create(user=User.objects.create_user(username='payer', password='payerpassword'),
+                                            balance=1000, currency='gbp')
+        self.staff = [Account.objects.create(user=User.objects.create_user(username=f'staff{i}'), balance=0,
+                                             currency='usd' if i % 2 else 'gbp')
+                      for i in range(4)]
+        self.client.login(username='payer', password='payerpassword')
+        self.url = reverse('payapp:bulk_payout_api')
+
+    def pay(self, payouts):
+        return self.client.post(self.url, {'payouts': [{'receiver': receiver, 'amount': amount}
+                                                       for receiver, amount in payouts]},
+                                content_type='application/json')
+
+    def test_payouts_are_made_in_one_transaction(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.pay([(f'staff{i}', '10.00') for i in range(4)] + [('staff0', '5.00')])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['total'], '45.00')
+        self.assertEqual(len(response.json()['transfers']), 5)
+
+        self.payer.refresh_from_db()
+        self.assertEqual(self.payer.balance, Decimal('955.00'))
+        balances = {account.user.username: account.balance for account in Account.objects.filter(
+            pk__in=[account.pk for account in self.staff]).select_related('user')}
+        usd = convert('gbp', 'usd', Decimal('10.00'))
+        self.assertEqual(balances, {'staff0': Decimal('15.00'), 'staff1': usd, 'staff2': Decimal('10.00'),
+                                    'staff3': usd})
+        self.assertEqual(OutboxEvent.objects.filter(processed_at__isnull=True).count(), 5)
+        process_outbox()
+        self.assertEqual(Account.objects.get(pk=self.staff[0].pk).unread_notifications, 2)
+        self.assertEqual(Notification.objects.filter(from_user=self.payer).count(), 5)
+        for account in [self.payer] + self.staff:
+            account.refresh_from_db()
+            self.assertEqual(balance_as_of(account), account.balance)
+        # The number of queries does not grow with the number of payouts
+        self.assertLess(len(queries.captured_queries), 20)
+
+    def test_failed_payouts_change_nothing(self):
+        response = self.pay([('staff0', '10.00'), ('nobody', '10.00'), ('ghost', '1.00')])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['receivers'], ['ghost', 'nobody'])
+
+        response = self.pay([('staff0', '600.00'), ('staff1', '600.00')])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.pay([('payer', '1.00')]).status_code, 400)
+        self.assertEqual(self.pay([('staff0', '-1.00')]).status_code, 400)
+        self.assertEqual(self.pay([]).status_code, 400)
+
+        self.payer.refresh_from_db()
+        self.assertEqual(self.payer.balance, Decimal('1000.00'))
+        self.assertFalse(Transfer.objects.exists())
+
+    def test_payout_limit(self):
+        with self.settings(PAYAPP_BULK_PAYOUT_MAX_ITEMS=2):
+            self.assertEqual(self.pay([('staff0', '1.00')] * 3).status_code, 400)
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.sender = Account.objects.create(user=User.objects.create_user(username='sender', password='senderpassword'),
+                                             balance=100)
+        self.receiver = Account.objects.create(user=User.objects.create_user(username='receiver',
+                                                                             password='receiverpassword'),
+                                               balance=100)
+
+    def test_payment_only_appends_an_event(self):
+        self.client.login(username='sender', password='senderpassword')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('payapp:send_payment'), {'amount': 10, 'receiver': 'receiver'})
+        self.assertFalse(any('INTO "notification"' in query['sql'] for query in queries.captured_queries))
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.idempotency_key, f'payment_sent:{Transfer.objects.get().pk}')
+        self.assertIsNone(event.processed_at)
+
+        self.assertEqual(process_outbox(), 1)
+        notification = Notification.objects.get()
+        self.assertEqual((notification.to_user, notification.idempotency_key), (self.receiver, event.idempotency_key))
+        self.assertEqual(notification.created_at, Transfer.objects.get().created_at)
+        self.receiver.refresh_from_db()
+        self.assertEqual(self.receiver.unread_notifications, 1)
+        self.assertEqual(process_outbox(), 0)
+
+    def test_events_are_idempotent(self):
+        """
+        Test that publishing an event twice, or delivering it again after it was processed, makes one notification
+        """
+        event = notification_event(self.receiver, self.sender, 'payment_sent', 'Paid', timezone.now(), key='once')
+        publish(event)
+        publish(notification_event(self.receiver, self.sender, 'payment_sent', 'Paid', timezone.now(), key='once'))
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+        process_outbox()
+        # Deliver the event again, as a worker which died before committing would
+        OutboxEvent.objects.update(processed_at=None)
+        process_outbox()
+        self.assertEqual(Notification.objects.count(), 1)
+        self.receiver.refresh_from_db()
+        self.assertEqual(self.receiver.unread_notifications, 1)
+
+    def test_concurrent_deliveries_count_once(self):
+        """
+        Test that an event delivered again while its first delivery was committing, so the check for notifications
+        already made misses it, leaves the unread counter unchanged
+        """
+        publish_notification(self.receiver, self.sender, 'payment_sent', 'Paid', timezone.now(), key='once')
+        publish_notification(self.receiver, self.sender, 'payment_sent', 'Paid again', timezone.now(), key='twice')
+        materialize_notifications([OutboxEvent.objects.get(idempotency_key='once')])
+        self.receiver.refresh_from_db()
+        self.assertEqual(self.receiver.unread_notifications, 1)
+
+        with patch('payapp.outbox.delivered_keys', return_value=set()):
+            self.assertEqual(materialize_notifications(list(OutboxEvent.objects.order_by('id'))), 1)
+            self.assertEqual(materialize_notifications([OutboxEvent.objects.get(idempotency_key='once')]), 0)
+        self.assertEqual(Notification.objects.count(), 2)
+        self.receiver.refresh_from_db()
+        self.assertEqual(self.receiver.unread_notifications, 2)
+
+    def test_request_answered_before_delivery(self):
+        """
+        Test that a request notification made after its request was answered is made already read
+        """
+        self.client.login(username='sender', password='senderpassword')
+        self.client.post(reverse('payapp:make_request'), {'amount': 10, 'receiver': 'receiver'})
+        self.client.login(username='receiver', password='receiverpassword')
+        self.client.get(reverse('payapp:decline_request', args=[Request.objects.get().pk]))
+        process_outbox()
+        self.assertTrue(Notification.objects.get(notification_type='request_sent').read)
+        self.assertFalse(Notification.objects.get(notification_type='request_declined').read)
+        self.receiver.refresh_from_db()
+        self.assertEqual(self.receiver.unread_notifications, 0)
+
+    def test_process_outbox_command(self):
+        for i in range(5):
+            publish_notification(self.receiver, self.sender, 'payment_sent', f'Paid {i}', timezone.now(), key=str(i))
+        out = StringIO()
+        call_command('process_outbox', '--once', '--batch-size', '2', stdout=out)
+        self.assertIn('Processed 5 outbox events.', out.getvalue())
+        self.assertEqual(Notification.objects.count(), 5)
+
+
+@override_settings(PAYAPP_LIVE={'POLL_INTERVAL': None})
+class LiveUpdateTests(TestCase):
+    def setUp(self):
+        self.sender = Account.objects.create(user=User.objects.create_user(username='sender', password='senderpassword'),
+                                             balance=100)
+        self.receiver = Account.objects.create(user=User.objects.create_user(username='receiver',
+                                                                             password='receiverpassword'),
+                                               balance=100)
+
+    async def read_event(self, stream):
+        """
+        Returns the name and data of the next event of the stream, skipping comments
+        """
+        while True:
+            chunk = (await asyncio.wait_for(anext(stream), 5)).decode()
+            if chunk.startswith('retry:') or chunk.startswith(':'):
+                continue
+            fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+            return fields['event'], json.loads(fields['data'])
+
+    async def open_stream(self, **headers):
+        await self.async_client.alogin(username='receiver', password='receiverpassword')
+        response = await self.async_client.get(reverse('payapp:live'), headers=headers)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return response.streaming_content
+
+    async def close_stream(self, stream):
+        """
+        Disconnects from the stream as the ASGI handler does, by cancelling the task waiting on it
+        """
+        reader = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0.1)
+        reader.cancel()
+        with suppress(asyncio.CancelledError):
+            await reader
+
+    def pay(self, amount):
+        with self.captureOnCommitCallbacks(execute=True):
+            Transfer(sender=self.sender, receiver=self.receiver, amount=amount).execute(amount)
+
+    def test_script_is_only_loaded_when_enabled(self):
+        self.client.login(username='receiver', password='receiverpassword')
+        self.assertNotContains(self.client.get(reverse('home')), 'id="live-updates"')
+        with self.settings(PAYAPP_LIVE={'ENABLED': True, 'POLL_INTERVAL': None}):
+            self.assertContains(self.client.get(reverse('home')), 'id="live-updates"')
+
+    def test_stream_needs_asgi_and_login(self):
+        self.client.login(username='receiver', password='receiverpassword')
+        self.assertEqual(self.client.get(reverse('payapp:live')).status_code, 204)
+
+    async def test_stream_needs_login(self):
+        response = await self.async_client.get(reverse('payapp:live'))
+        self.assertEqual(response.status_code, 401)
+
+    async def test_stream_pushes_balance_and_notifications(self):
+        stream = await self.open_stream()
+        try:
+            self.assertEqual(await self.read_event(stream), ('balance', {'balance': '100.00', 'currency': 'gbp'}))
+            self.assertEqual(await self.read_event(stream), ('unread', {'count': 0}))
+
+            # A transfer in this process wakes the stream once it commits
+            await sync_to_async(self.pay)(Decimal('10.00'))
+            self.assertEqual(await self.read_event(stream), ('balance', {'balance': '110.00', 'currency': 'gbp'}))
+
+            def notify():
+                with self.captureOnCommitCallbacks(execute=True):
+                    Notification.objects.create(to_user=self.receiver, from_user=self.sender, message='Paid')
+            await sync_to_async(notify)()
+            name, data = await self.read_event(stream)
+            self.assertEqual((name, data['message'], data['read']), ('notification', 'Paid', False))
+            self.assertEqual(await self.read_event(stream), ('unread', {'count': 1}))
+        finally:
+            await self.close_stream(stream)
+        self.assertEqual(broker.account_ids(), [])
+
+    async def test_stream_resumes_after_last_event_id(self):
+        first = await Notification.objects.acreate(to_user=self.receiver, from_user=self.sender, message='First')
+        await Notification.objects.acreate(to_user=self.receiver, from_user=self.sender, message='Second')
+        stream = await self.open_stream(**{'Last-Event-ID': str(first.pk)})
+        try:
+            name, data = await self.read_event(stream)
+            self.assertEqual((name, data['message']), ('notification', 'Second'))
+        finally:
+            await self.close_stream(stream)
+
+    @override_settings(PAYAPP_LIVE={'POLL_INTERVAL': 0.05})
+    async def test_poller_publishes_changes_made_elsewhere(self):
+        stream = await self.open_stream()
+        try:
+            await self.read_event(stream)
+            await self.read_event(stream)
+            # An update which publishes nothing, as one made by another process
+            await Account.objects.filter(pk=self.receiver.pk).aupdate(balance=Decimal('42.00'))
+            self.assertEqual(await self.read_event(stream), ('balance', {'balance': '42.00', 'currency': 'gbp'}))
+        finally:
+            await self.close_stream(stream)
+
+
+class NotificationMaintenanceTests(TestCase):
+    def setUp(self):
+        self.sender = Account.objects.create(user=User.objects.create_user(username='sender', password='senderpassword'),
+                                             balance=100)
+        self.receiver = Account.objects.create(user=User.objects.create_user(username='receiver',
+                                                                             password='receiverpassword'),
+                                               balance=100)
+        self.client.login(username='receiver', password='receiverpassword')
+
+    def notify(self, message, **kwargs):
+        return Notification.objects.create(to_user=self.receiver, from_user=self.sender, message=message, **kwargs)
+
+    def test_mark_all_as_read_is_one_update(self):
+        self.notify('First')
+        self.notify('Second')
+        pending = Request.objects.create(sender=self.sender, receiver=self.receiver, amount=5)
+        self.notify('Request', notification_type='request_sent', request=pending)
+        # Another account's notification is left alone
+        Notification.objects.create(to_user=self.sender, from_user=self.receiver, message='Other')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('payapp:mark_all_as_read'), {'all': '1'})
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE "notification"')]
+        self.assertEqual(len(updates), 1)
+        # The pending request's notification stays unread until the request is answered
+        self.assertEqual(list(Notification.objects.filter(read=False).values_list('message', flat=True).order_by('id')),
+                         ['Request', 'Other'])
+        self.receiver.refresh_from_db()
+        self.assertEqual(self.receiver.unread_notifications, 1)
+
+    def test_mark_selected_as_read(self):
+        first, second = self.notify('First'), self.notify('Second')
+        other = Notification.objects.create(to_user=self.sender, from_user=self.receiver, message='Other')
+        self.client.post(reverse('payapp:mark_all_as_read'), {'notification': [first.pk, other.pk]})
+        self.assertEqual(set(Notification.objects.filter(read=True)), {first})
+        self.receiver.refresh_from_db()
+        self.assertEqual(self.receiver.unread_notifications, 1)
+
+        # Marking them again takes nothing more off the count
+        self.assertEqual(Notification.mark_all_as_read(self.receiver, pk__in=[first.pk]), 0)
+        self.client.post(reverse('payapp:mark_all_as_read'), {})
+        self.assertFalse(Notification.objects.get(pk=second.pk).read)
+        self.receiver.refresh_from_db()
+        self.assertEqual(self.receiver.unread_notifications, 1)
+
+    def test_purge_deletes_expired_rows_in_batches(self):
+        old = timezone.now() - timedelta(days=100)
+        self.notify('Old read', read=True, created_at=old)
+        self.notify('Old read too', read=True, created_at=old)
+        self.notify('Old unread', created_at=old)
+        self.notify('Recent read', read=True)
+        publish_notification(self.receiver, self.sender, 'payment_sent', 'Processed', old, key='processed')
+        publish_notification(self.receiver, self.sender, 'payment_sent', 'Pending', old, key='pending')
+        OutboxEvent.objects.filter(idempotency_key='processed').update(processed_at=old)
+
+        out = StringIO()
+        call_command('purge_notifications', '--dry-run', stdout=out)
+        self.assertIn('Would delete 2 notifications and 1 outbox events.', out.getvalue())
+        self.assertEqual(Notification.objects.count(), 4)
+
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('purge_notifications', '--batch-size', '1', stdout=out)
+        self.assertIn('Deleted 2 notifications and 1 outbox events.', out.getvalue())
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if query['sql'].startswith('DELETE FROM "notification"')]), 2)
+        self.assertEqual(set(Notification.objects.values_list('message', flat=True)), {'Old unread', 'Recent read'})
+        self.assertEqual(list(OutboxEvent.objects.values_list('idempotency_key', flat=True)), ['pending'])
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.sender = Account.objects.create(user=User.objects.create_user(username='sender', password='senderpassword'),
+                                             balance=100)
+        self.receiver = Account.objects.create(user=User.objects.create_user(username='receiver',
+                                                                             password='receiverpassword'),
+                                               balance=100)
+        Transfer(sender=self.sender, receiver=self.receiver, amount=Decimal('5.00')).execute(Decimal('5.00'))
+        Request.objects.create(sender=self.receiver, receiver=self.sender, amount=5)
+        Notification.objects.create(to_user=self.sender, from_user=self.receiver, message='Hello')
+
+    async def test_read_views_render_under_asgi(self):
+        """
+        Test that the async views load everything the templates need with async calls, even with the rate table and
+        the admin check not cached, so rendering makes no query in the event loop
+        """
+        invalidate_rates()
+        await self.async_client.alogin(username='sender', password='senderpassword')
+        for name, text in (('home', 'Welcome, <b>sender</b>'), ('payapp:transfers', 'receiver'),
+                           ('payapp:requests', 'receiver'), ('payapp:notifications', 'Hello')):
+            response = await self.async_client.get(reverse(name))
+            self.assertContains(response, text)
+            self.assertContains(response, '<span id="user-balance">95.00</span>', html=False)
+
+    async def test_read_views_need_login(self):
+        response = await self.async_client.get(reverse('payapp:transfers'))
+        self.assertRedirects(response, f"{settings.LOGIN_URL}?next={reverse('payapp:transfers')}",
+                             fetch_redirect_response=False)
+        response = await self.async_client.get(reverse('home'))
+        self.assertContains(response, 'Please <a href')
+
+
+@skipUnless(connection.vendor == 'sqlite', "The SQLite profile's options only apply to SQLite")
+class SQLiteProfileTests(TransactionTestCase):
+    def test_connections_are_tuned(self):
+        """
+        Test that every connection runs the configured pragmas, and that only payments begin by taking the write lock
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            cursor.execute('PRAGMA synchronous')
+            # NORMAL
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+        with CaptureQueriesContext(connection) as queries, transaction.atomic():
+            Account.objects.count()
+        self.assertEqual(queries.captured_queries[0]['sql'], 'BEGIN DEFERRED')
+
+        with CaptureQueriesContext(connection) as queries, write_atomic():
+            Account.objects.count()
+            with transaction.atomic():
+                Account.objects.count()
+        self.assertEqual(queries.captured_queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+        # A payment inside a deferred transaction is a savepoint of it, and the next transaction is deferred again
+        sender, receiver = [Account.objects.create(user=User.objects.create_user(username=name), balance=100)
+                            for name in ('sender', 'receiver')]
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                Transfer(sender=sender, receiver=receiver, amount=10).execute(Decimal(10))
+            Transfer(sender=sender, receiver=receiver, amount=10).execute(Decimal(10))
+        self.assertEqual([query['sql'] for query in queries.captured_queries if query['sql'].startswith('BEGIN')],
+                         ['BEGIN DEFERRED', 'BEGIN IMMEDIATE'])
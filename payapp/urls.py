@@ -10,5 +10,11 @@ urlpatterns = [
     path('cancel_request/<int:request_id>/', views.cancel_request, name='cancel_request'),
     path('send_payment/', views.send_payment, name='send_payment'),
     path('notifications/', views.notifications, name='notifications'),
+    path('notifications/read/', views.mark_notifications_as_read, name='mark_all_as_read'),
     path('notifications/read/<int:notification_id>/', views.mark_notification_as_read, name='mark_as_read'),
+    path('live/', views.live_updates, name='live'),
+    path('api/transfers/', views.TransferListAPI.as_view(), name='transfers_api'),
+    path('api/requests/', views.RequestListAPI.as_view(), name='requests_api'),
+    path('api/notifications/', views.NotificationListAPI.as_view(), name='notifications_api'),
+    path('api/payouts/', views.BulkPayoutAPI.as_view(), name='bulk_payout_api'),
 ]
@@ -1,56 +1,86 @@
-import decimal
-import os
-
-import requests
-from decimal import Decimal
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
 
+from conversion.engine import convert, convert_many, UnsupportedCurrencyError
+from conversion.remote import get_remote_client, RemoteConversionError
 from payapp.custom_exceptions import CurrencyConversionError
 
+
 def convert_currency(currency1, currency2, amount_of_currency1):
     """
-    Utility function to convert an amount of currency1 to currency2 using the currency conversion RESTful service.
+    Utility function to convert an amount of currency1 to currency2. By default the in-process conversion engine is
+    used, so a conversion inside a database transaction does no network I/O; with CONVERSION_BACKEND = 'remote' the
+    remote conversion service is called instead.
     :param currency1: The currency to convert from.
     :param currency2: The currency to convert to.
     :param amount_of_currency1: The amount of currency1 to convert.
     :return: Decimal - The amount of currency2 after conversion.
     """
-    # Makes sure that the input is uppercase
-    currency1 = currency1.upper()
-    currency2 = currency2.upper()
-    # If the currencies are the same, return the amount as a Decimal
-    if currency1 == currency2:
-        return Decimal(amount_of_currency1)
+    try:
+        if getattr(settings, 'CONVERSION_BACKEND', 'local') == 'remote':
+            return get_remote_client().convert(currency1, currency2, amount_of_currency1)
+        return convert(currency1, currency2, amount_of_currency1)
+    # If either currency is not supported, raise an exception
+    except UnsupportedCurrencyError:
+        raise CurrencyConversionError(f'Unsupported currency conversion from {currency1} to {currency2}')
+    # If the remote service is unavailable or its circuit is open, raise an exception
+    except RemoteConversionError as e:
+        raise CurrencyConversionError(e.message)
+    # If the amount is not a number, raise an exception
+    except ValueError:
+        raise CurrencyConversionError('Invalid amount for currency conversion')
 
-    # Get the base URL from the environment variable, default to localhost
-    base_url = os.getenv('BASE_URL', 'https://localhost:8000')
 
-    # Build the URL for the RESTful service
-    url = f'{base_url}/webapps2024/conversion/{currency1.upper()}/{currency2.upper()}/{amount_of_currency1}'
-    # Make a request to the RESTful service
+def convert_currency_many(currency1, currency2, amounts_of_currency1):
+    """
+    Utility function to convert several amounts of currency1 to currency2, looking the rate up once with the local
+    engine. The remote conversion service has no batch call, so with CONVERSION_BACKEND = 'remote' each amount is
+    converted by its own call.
+    :param currency1: The currency to convert from.
+    :param currency2: The currency to convert to.
+    :param amounts_of_currency1: Iterable of amounts of currency1 to convert.
+    :return: List of Decimals - The amounts of currency2 after conversion, in the same order.
+    """
     try:
-        response = requests.get(url, verify=False)  # Disable SSL verification as it's using a self-signed certificate
-
-    # If there is a connection error, raise an exception
-    except requests.exceptions.ConnectionError:
-        print('Connection error, please check your network')
-        raise CurrencyConversionError('Connection error, please check your network')
-    # If there is a request exception, raise an exception
-    except requests.exceptions.RequestException:
-        print('Error in currency conversion, please try again')
-        raise CurrencyConversionError('Error in currency conversion, please try again')
-
-    # If the request is unsuccessful, raise an exception
-    if response.status_code != 200:
-        print('Error in currency conversion, response status: ' + str(response.status_code))
-        raise CurrencyConversionError('Error in currency conversion, response status: ' + str(response.status_code))
+        if getattr(settings, 'CONVERSION_BACKEND', 'local') == 'remote':
+            client = get_remote_client()
+            return [client.convert(currency1, currency2, amount) for amount in amounts_of_currency1]
+        return convert_many(currency1, currency2, amounts_of_currency1)
+    # If either currency is not supported, raise an exception
+    except UnsupportedCurrencyError:
+        raise CurrencyConversionError(f'Unsupported currency conversion from {currency1} to {currency2}')
+    # If the remote service is unavailable or its circuit is open, raise an exception
+    except RemoteConversionError as e:
+        raise CurrencyConversionError(e.message)
+    # If an amount is not a number, raise an exception
+    except ValueError:
+        raise CurrencyConversionError('Invalid amount for currency conversion')
 
-    try:
-        # Parsing JSON from the response and converting the specified field to Decimal
-        data = response.json()
-        converted_amount = Decimal(str(data['converted_amount']))  # Convert to string to avoid float precision issues
-        print(converted_amount)
-    except (ValueError, KeyError, decimal.InvalidOperation):
-        print('Invalid response format from currency conversion service')
-        raise CurrencyConversionError('Invalid response format from currency conversion service')
-
-    return converted_amount
\ No newline at end of file
+
+class WriteAtomic(transaction.Atomic):
+    """
+    Atomic block whose transaction, if it is the outermost block, begins in the database's write_transaction_mode,
+    which the SQLite profile sets to IMMEDIATE. Other databases begin it as atomic() would.
+    """
+    def __enter__(self):
+        connection = transaction.get_connection(self.using)
+        connection.beginning_write = True
+        try:
+            super().__enter__()
+        finally:
+            connection.beginning_write = False
+
+
+def write_atomic(using=None, savepoint=True, durable=False):
+    """
+    Utility function used as transaction.atomic() is, for the transactions which read rows and then write them, as
+    payments do. On SQLite such a transaction takes the write lock when it begins, so concurrent payments wait for
+    each other rather than failing, while every other transaction still begins deferred.
+    :param using: The database alias, or the function decorated
+    :param savepoint: Whether a nested block makes a savepoint
+    :param durable: Whether the block must be the outermost one
+    :return: WriteAtomic
+    """
+    if callable(using):
+        return WriteAtomic(DEFAULT_DB_ALIAS, savepoint, durable)(using)
+    return WriteAtomic(using, savepoint, durable)
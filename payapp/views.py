@@ -1,38 +1,56 @@
-from datetime import datetime
+import asyncio
 
+from asgiref.sync import iscoroutinefunction
 from django.contrib import messages
 from django.contrib.auth.models import User
 from django.db.models import Q
-from django.http import Http404
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
-from payapp.custom_exceptions import InsufficientBalanceException
+from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from conversion.rates import aget_rate_table, get_currency_symbol
+from payapp.custom_exceptions import InsufficientBalanceException, UnknownReceiverException, CurrencyConversionError
 from payapp.forms import RequestForm, PaymentForm
 from payapp.models import Transfer, Account, Request, Notification
+from payapp.live import account_stream
+from payapp.outbox import publish_notification
+from payapp.middleware import aget_account
+from payapp.pagination import paginate, apaginate_list, get_page_size, InvalidCursor
+from payapp.payouts import execute_payouts
+from payapp.utils import write_atomic
+from register.permissions import ais_admin_user
+from payapp.serializers import TransferSerializer, RequestSerializer, NotificationSerializer, BulkPayoutSerializer
 from webapps2024 import settings
 from django.db import transaction
-from thrift_timestamp.client import ThriftTimestampClient
-
-currency_symbols = {
-    'USD': '$',
-    'GBP': '£',
-    'EUR': '€'
-}
-
+from thrift_timestamp.sources import get_timestamp_source, TimestampUnavailableError
 
 def login_required_message(function):
     """
-    Decorator to display a message if the user is not logged in
+    Decorator to display a message if the user is not logged in, for both sync and async views
     """
 
-    def wrap(request, *args, **kwargs):
-        # If the user is logged in, call the function
-        if request.user.is_authenticated:
-            return function(request, *args, **kwargs)
+    def login_required(request):
+        # Display an error message and redirect to the login page
+        messages.error(request, "You need to be logged in to view this page.")
+        return redirect('%s?next=%s' % (settings.LOGIN_URL, request.path))
 
-        # If the user is not logged in, display an error message and redirect to the login page
-        else:
-            messages.error(request, "You need to be logged in to view this page.")
-            return redirect('%s?next=%s' % (settings.LOGIN_URL, request.path))
+    if iscoroutinefunction(function):
+        async def wrap(request, *args, **kwargs):
+            # Load the user and their account without blocking the event loop, then call the view if logged in
+            await aget_account(request)
+            if request.user.is_authenticated:
+                return await function(request, *args, **kwargs)
+            return login_required(request)
+
+    else:
+        def wrap(request, *args, **kwargs):
+            # If the user is logged in, call the function
+            if request.user.is_authenticated:
+                return function(request, *args, **kwargs)
+            return login_required(request)
 
     # Retains the docstring and name of the original function
     wrap.__doc__ = function.__doc__
@@ -40,75 +58,110 @@ def login_required_message(function):
     return wrap
 
 
-def home(request):
+async def arender(request, template_name, context=None):
+    """
+    Renders a template from an async view. Everything the base template reads from the database, the user and their
+    account, the admin check and the currency symbols, is loaded first with async calls, so rendering in the event
+    loop makes no blocking query.
+    :param request:
+    :param template_name: The template to render
+    :param context: The template context
+    :return: HttpResponse
+    """
+    await aget_account(request)
+    await ais_admin_user(request.user)
+    await aget_rate_table()
+    return render(request, template_name, context)
+
+
+async def home(request):
     """
-    View function to display the home page
+    Async view function to display the home page
     :param request:
     :return:
     """
-    # Gets the current timestamp for the dashboard
-    timestamp = ThriftTimestampClient().get_current_timestamp()
-    # Converts the timestamp to a datetime object
-    timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+    # Gets the current timestamp for the dashboard as a datetime object, leaving it out if the time is unavailable
+    try:
+        timestamp = await get_timestamp_source().anow()
+    except TimestampUnavailableError:
+        timestamp = None
+
+    return await arender(request, 'payapp/home.html', {'timestamp': timestamp})
 
-    return render(request, 'payapp/home.html', {'timestamp': timestamp})
+
+def transfer_list_for(account):
+    """
+    Returns the transfers sent or received by the account, with both accounts and users loaded in the same query
+    :param account: Account
+    :return: QuerySet
+    """
+    return (Transfer.objects.filter(Q(sender=account) | Q(receiver=account))
+            .select_related('sender', 'receiver', 'sender__user', 'receiver__user'))
+
+
+# Request lists shown on the requests page and served by the requests API
+REQUEST_KINDS = ('incoming', 'outgoing', 'completed')
+
+
+def request_list_for(account, kind):
+    """
+    Returns the account's requests of the given kind, with both accounts and users loaded in the same query
+    :param account: Account
+    :param kind: 'incoming' for pending requests to pay, 'outgoing' for pending requests made and 'completed' for
+    requests either way which are no longer pending
+    :return: QuerySet
+    """
+    if kind == 'incoming':
+        request_list = Request.objects.filter(receiver=account, status='pending')
+    elif kind == 'outgoing':
+        request_list = Request.objects.filter(sender=account, status='pending')
+    elif kind == 'completed':
+        request_list = Request.objects.filter(Q(sender=account) | Q(receiver=account)).exclude(status='pending')
+    else:
+        raise ValueError(f"Unknown request kind '{kind}', expected one of {', '.join(REQUEST_KINDS)}")
+    return request_list.select_related('sender', 'receiver', 'sender__user', 'receiver__user')
+
+
+def notification_list_for(account):
+    """
+    Returns the account's unread notifications
+    :param account: Account
+    :return: QuerySet
+    """
+    return Notification.objects.filter(to_user=account, read=False)
 
 
 @login_required_message
-def transfers(request):
+async def transfers(request):
     """
-    View function to display the transfers of the logged-in user with login required decorator
+    Async view function to display the transfers of the logged-in user with login required decorator, a page at a
+    time
 
     :param request:
     :return:
     """
-    transfer_list = (Transfer.objects.filter(
-        Q(sender__user=request.user) | Q(receiver__user=request.user)
-    ))
-    if transfer_list.exists():
-        transfer_list = transfer_list.select_related('sender', 'receiver', 'sender__user',
-                                                     'receiver__user').order_by('-created_at')
-    return render(request, 'payapp/transfers.html', {'transfers': transfer_list})
+    page, cursor = await apaginate_list(request, transfer_list_for(request.account))
+    return await arender(request, 'payapp/transfers.html', {'transfers': page, 'cursor': cursor})
 
 
 @login_required_message
-def payment_requests(request):
+async def payment_requests(request):
     """
-    View function to display the requests of the logged-in user
+    Async view function to display the requests of the logged-in user. Each list is paginated on its own, with its
+    cursor in the <kind>_cursor query parameter, and the three pages are fetched concurrently.
 
     :param request:
     :return:
     """
-    # Select outgoing requests where the status is pending
-    outgoing_request_list = (Request.objects.filter(
-        Q(sender__user=request.user, status='pending')
-    ))
-    # Checks that the outgoing request list is not empty as cannot select_related on an empty queryset
-    if outgoing_request_list.exists():
-        outgoing_request_list = (outgoing_request_list.select_related('sender', 'receiver', 'sender__user',
-                                                                      'receiver__user')
-                                 .order_by('-created_at'))
-    # Select incoming requests where the status is pending
-    incoming_request_list = Request.objects.filter(
-        Q(receiver__user=request.user, status='pending')
-    )
-    if incoming_request_list.exists():
-        (incoming_request_list.select_related('sender', 'receiver', 'sender__user', 'receiver__user')
-         .order_by('-created_at'))
-    # Select completed requests from transaction table where the sender or receiver is the logged-in user
-
-    completed_request_list = (Request.objects.filter(
-        (Q(sender__user=request.user) & ~Q(status='pending')) |
-        (Q(receiver__user=request.user) & ~Q(status='pending'))
-    ))
-    if completed_request_list.exists():
-        completed_request_list = completed_request_list.select_related('sender', 'receiver', 'sender__user',
-                                                                       'receiver__user').order_by('-created_at')
+    pages = await asyncio.gather(*[
+        apaginate_list(request, request_list_for(request.account, kind), f'{kind}_cursor') for kind in REQUEST_KINDS])
+    context = {}
+    for kind, (page, cursor) in zip(REQUEST_KINDS, pages):
+        context[f'{kind}_requests'] = page
+        context[f'{kind}_cursor'] = cursor
 
     # Render the requests page with the context
-    context = {'outgoing_requests': outgoing_request_list, 'incoming_requests': incoming_request_list,
-               'completed_requests': completed_request_list}
-    return render(request, 'payapp/requests.html', context)
+    return await arender(request, 'payapp/requests.html', context)
 
 
 @login_required_message
@@ -119,8 +172,8 @@ def make_request(request):
     :param request:
     :return:
     """
-    user = request.user
-    account = Account.objects.get(user=user)
+    # The account shared with the context processors, loaded once per request
+    account = request.account
     # If the form is submitted, validate the form and save the request
     if request.method == 'POST':
         form = RequestForm(request.POST, user_currency=account.currency)  # Passes currency for constructor
@@ -135,18 +188,18 @@ def make_request(request):
                 with transaction.atomic():  # Ensures that the request is saved in the same transaction as the sender
                     # and receiver accounts to maintain atomicity
                     request_instance = form.save(commit=False)  # Creates an instance of the form without saving it
-                    request_instance.sender = Account.objects.get(user=request.user)
+                    request_instance.sender = account
                     request_instance.receiver = Account.objects.get(user__username=request.POST['receiver'])
 
                     # If the receiver is not the sender, save the request
                     if request_instance.receiver != request_instance.sender:
                         request_instance.save()
                         # Adds a notification to the receiver's account
-                        Notification.objects.create(
+                        publish_notification(
                             to_user=request_instance.receiver,
                             from_user=request_instance.sender,
                             message=f"{request_instance.sender.user.username} has requested "
-                                    f"{currency_symbols.get(request_instance.sender.currency.upper())}"
+                                    f"{get_currency_symbol(request_instance.sender.currency)}"
                                     f"{request_instance.amount}",
                             notification_type='request_sent',
                             created_at=request_instance.created_at,
@@ -186,23 +239,23 @@ def accept_request(request, request_id):
     :return:
     """
     # Try to accept the request
-    with transaction.atomic():
+    with write_atomic():
         try:
             req = get_object_or_404(Request, id=request_id)
             req.accept_request(req.amount)
             # Adds a notification to the sender's account
-            Notification.objects.create(
+            publish_notification(
                 to_user=req.sender,
                 from_user=req.receiver,
-                message=f"Your request for {currency_symbols.get(req.sender.currency.upper())}{req.amount} from "
+                message=f"Your request for {get_currency_symbol(req.sender.currency)}{req.amount} from "
                         f"{req.receiver.user.username} has been accepted.",
                 notification_type='request_accepted',
                 created_at=req.created_at,
                 request=req
             )
-            # Marks the request sent notification as read
-            request_notification = Notification.objects.get(request=req, notification_type='request_sent')
-            request_notification.mark_as_read()
+            # Marks the request sent notification as read in one UPDATE. If the outbox has not made it yet nothing is
+            # marked, and it is made already read
+            Notification.mark_all_as_read(req.receiver, request=req, notification_type='request_sent')
             messages.success(request, "Request has been accepted")
             return redirect('payapp:requests')
 
@@ -239,19 +292,19 @@ def decline_request(request, request_id):
             req = get_object_or_404(Request, id=request_id)
             req.decline_request()
             # Adds a notification to the sender's account
-            Notification.objects.create(
+            publish_notification(
                 to_user=req.sender,
                 from_user=req.receiver,
-                message=f"Your request for {currency_symbols.get(req.sender.currency.upper())}{req.amount} from "
+                message=f"Your request for {get_currency_symbol(req.sender.currency)}{req.amount} from "
                         f"{req.receiver.user.username} has been declined.",
                 notification_type='request_declined',
                 created_at=req.created_at,
                 request=req
             )
             messages.success(request, "Request has been declined.")
-            # Marks the request sent notification as read
-            request_notification = Notification.objects.get(request=req, notification_type='request_sent')
-            request_notification.mark_as_read()
+            # Marks the request sent notification as read in one UPDATE. If the outbox has not made it yet nothing is
+            # marked, and it is made already read
+            Notification.mark_all_as_read(req.receiver, request=req, notification_type='request_sent')
             return redirect('payapp:requests')
         # If the request does not exist, display an error message and redirect to the requests page
         except Http404:
@@ -277,11 +330,11 @@ def cancel_request(request, request_id):
         req = get_object_or_404(Request, id=request_id)
         req.cancel_request()
         # Adds a notification to the receiver's account
-        Notification.objects.create(
+        publish_notification(
             to_user=req.receiver,
             from_user=req.sender,
             message=f"{req.sender.user.username} has cancelled their request for "
-                    f"{currency_symbols.get(req.sender.currency.upper())}{req.amount}",
+                    f"{get_currency_symbol(req.sender.currency)}{req.amount}",
             notification_type='request_cancelled',
             created_at=req.created_at,
             request=req,
@@ -306,32 +359,32 @@ def send_payment(request):
     :param request:
     :return:
     """
-    user = request.user
-    account = Account.objects.get(user=user)
+    # The account shared with the context processors, loaded once per request
+    account = request.account
     # If the form is submitted, validate the form and save the payment
     if request.method == 'POST':
         form = PaymentForm(request.POST, user_currency=account.currency)
         # If the form is valid, save the payment
         if form.is_valid():
             # Try to save the payment
-            with transaction.atomic():
+            with write_atomic():
                 try:
                     transaction_instance = form.save(commit=False)
-                    transaction_instance.sender = Account.objects.get(user=request.user)
+                    transaction_instance.sender = account
                     transaction_instance.receiver = Account.objects.get(user__username=request.POST['receiver'])
                     # Makes sure the sender is not the receiver
                     if transaction_instance.receiver != transaction_instance.sender:
                         transaction_instance.execute(transaction_instance.amount)
-                        transaction_instance.save()
                         # Adds a notification to the receiver's account
-                        Notification.objects.create(
+                        publish_notification(
                             to_user=transaction_instance.receiver,
                             from_user=transaction_instance.sender,
-                            message=f"You have received {currency_symbols.get(account.currency.upper())}"
+                            message=f"You have received {get_currency_symbol(account.currency)}"
                                     f"{transaction_instance.amount} from "
                                     f"{transaction_instance.sender.user.username}",
                             notification_type='payment_sent',
-                            created_at=transaction_instance.created_at
+                            created_at=transaction_instance.created_at,
+                            key=f'payment_sent:{transaction_instance.pk}'
                         )
                         messages.success(request, "Payment has been made")
                         return redirect('home')
@@ -367,27 +420,23 @@ def send_payment(request):
 
 
 @login_required_message
-def notifications(request):
+async def notifications(request):
     """
-    View function to display the notifications of the logged-in user
+    Async view function to display the notifications of the logged-in user
 
     :param request:
     :return:
     """
-    user = request.user
-    account = Account.objects.get(user=user)
-    # Select notifications where the receiver is the logged-in user
-    notifications_list = (Notification.objects.filter(to_user=account, read=False))
-    if notifications_list.exists():
-        notifications_list = notifications_list.order_by('-created_at')
+    # Select notifications where the receiver is the logged-in user, a page at a time
+    page, cursor = await apaginate_list(request, notification_list_for(request.account))
     # Render the notifications page with the context
-    return render(request, 'payapp/notifications.html', {'notifications': notifications_list})
+    return await arender(request, 'payapp/notifications.html', {'notifications': page, 'cursor': cursor})
 
 
 @login_required_message
 def mark_notification_as_read(request, notification_id):
     try:
-        notification = Notification.objects.get(id=notification_id, to_user=request.user.account)
+        notification = Notification.objects.get(id=notification_id, to_user=request.account)
         # Mark the notification as read if it is not a request sent or is a cancelled transaction notification
         if notification.notification_type != 'request_sent' or notification.request.status == 'cancelled':
             notification.mark_as_read()
@@ -400,3 +449,141 @@ def mark_notification_as_read(request, notification_id):
         # Handle the case where the notification doesn't exist
         messages.error(request, "Notification not found.")
         return redirect('home')  # Redirect to a safe page
+
+
+# Request notifications stay unread while the request waits for an answer, so they are only marked by answering it
+READABLE_NOTIFICATIONS = ~Q(notification_type='request_sent', request__status='pending')
+
+
+@login_required_message
+def mark_notifications_as_read(request):
+    """
+    View function to mark the notifications selected on the notifications page, or all of them, as read with a
+    single UPDATE
+
+    :param request:
+    :return:
+    """
+    if request.method == 'POST':
+        # Mark every notification if asked to, otherwise only the selected ones
+        if request.POST.get('all'):
+            filters = {}
+        else:
+            filters = {'pk__in': [pk for pk in request.POST.getlist('notification') if pk.isdigit()]}
+            if not filters['pk__in']:
+                messages.error(request, "Select the notifications to mark as read.")
+                return redirect('payapp:notifications')
+        marked = Notification.mark_all_as_read(request.account, READABLE_NOTIFICATIONS, **filters)
+        messages.success(request, f"Marked {marked} notification{'s' if marked != 1 else ''} as read.")
+    return redirect('payapp:notifications')
+
+
+async def live_updates(request):
+    """
+    Async view streaming the logged-in user's balance, unread notification count and new notifications as
+    Server-Sent Events, so the navigation bar stays up to date without reloading the page. The stream only runs under
+    an ASGI server, where an idle connection is a suspended coroutine rather than a blocked worker thread. Under WSGI
+    it answers 204 No Content, which tells the browser not to reconnect.
+    :param request:
+    :return: StreamingHttpResponse of text/event-stream
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponse(status=401)
+    account_id = await Account.objects.filter(user=user).values_list('pk', flat=True).afirst()
+    if account_id is None:
+        raise Http404
+
+    # Resume after the last notification the browser received if it is reconnecting
+    last_event_id = request.headers.get('Last-Event-ID')
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+
+    response = StreamingHttpResponse(account_stream(account_id, last_event_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stops nginx buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class KeysetListAPI(APIView):
+    """
+    Base API serving one of the logged-in user's lists a page at a time, newest first, for infinite scroll.
+
+    The API accepts the following query parameters:
+    - cursor: The next_cursor of the previous page, left out for the newest page
+    - page_size: The number of rows per page, capped at the PAYAPP_MAX_PAGE_SIZE setting
+
+    The API returns the rows of the page in the 'results' field of the response and the cursor of the following page
+    in the 'next_cursor' field, which is null on the last page.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = None
+
+    def get_queryset(self, request):
+        raise NotImplementedError
+
+    def get(self, request):
+        try:
+            queryset = self.get_queryset(request)
+            page = paginate(queryset, request.query_params.get('cursor'),
+                            get_page_size(request.query_params.get('page_size')))
+        except (InvalidCursor, ValueError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'results': self.serializer_class(page.items, many=True).data,
+                         'next_cursor': page.next_cursor})
+
+
+class TransferListAPI(KeysetListAPI):
+    """API serving the transfers sent or received by the logged-in user"""
+    serializer_class = TransferSerializer
+
+    def get_queryset(self, request):
+        return transfer_list_for(request.account)
+
+
+class RequestListAPI(KeysetListAPI):
+    """API serving the logged-in user's requests of the kind given by the kind query parameter, 'incoming' by default"""
+    serializer_class = RequestSerializer
+
+    def get_queryset(self, request):
+        return request_list_for(request.account, request.query_params.get('kind', 'incoming'))
+
+
+class NotificationListAPI(KeysetListAPI):
+    """API serving the logged-in user's unread notifications"""
+    serializer_class = NotificationSerializer
+
+    def get_queryset(self, request):
+        return notification_list_for(request.account)
+
+
+class BulkPayoutAPI(APIView):
+    """
+    API to pay several users from the logged-in user's account in one transaction, e.g. for payroll
+
+    The API expects a JSON body with a 'payouts' list of objects with:
+    - receiver: The username to pay
+    - amount: The amount to pay, in the logged-in user's currency
+
+    Either every payout is made or none is. The API returns the ids of the transfers made in the 'transfers' field and
+    the total debited in the 'total' field of the response.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = BulkPayoutSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        payouts = [(payout['receiver'], payout['amount']) for payout in serializer.validated_data['payouts']]
+        try:
+            transfers = execute_payouts(request.account, payouts)
+        except UnknownReceiverException as e:
+            return Response({'error': e.message, 'receivers': e.usernames}, status=status.HTTP_400_BAD_REQUEST)
+        except InsufficientBalanceException as e:
+            return Response({'error': e.message}, status=status.HTTP_400_BAD_REQUEST)
+        except (ValueError, CurrencyConversionError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'transfers': [transfer.id for transfer in transfers],
+                         'total': str(sum(amount for _, amount in payouts))}, status=status.HTTP_201_CREATED)
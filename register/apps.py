@@ -1,9 +1,6 @@
-from threading import Thread
-
 from django.apps import AppConfig
-from django.db.models.signals import post_migrate
+from django.db.models.signals import post_migrate, post_save, post_delete, m2m_changed
 from register import create_admin_account
-from thrift_timestamp import server
 
 
 class RegisterConfig(AppConfig):
@@ -12,16 +9,18 @@ class RegisterConfig(AppConfig):
 
     def ready(self):
         """
-        Method to start the Thrift server and connect the post_migrate signal for creating the admin account when the
-        app is ready.
+        Method to connect the post_migrate signal for creating the admin account and the signals keeping the admin
+        check caches up to date when the app is ready. The Thrift timestamp server runs as its own process with
+        `manage.py run_timestamp_server`.
         :param self:
         :return:
         """
-        # Start the Thrift server in a separate thread so that it doesn't block the main thread
-        thrift_server_thread = Thread(target=server.start_thrift_server)
-        thrift_server_thread.daemon = True
-        thrift_server_thread.start()
+        from django.contrib.auth.models import Group, User
+        from register import permissions
 
         # Connect the post_migrate signal
         post_migrate.connect(create_admin_account.create_admin_group_and_account, sender=self)
-
+        # Forget the cached admin group id when groups change and memoized checks when a user's groups change
+        post_save.connect(permissions.reset_admin_group_cache, sender=Group)
+        post_delete.connect(permissions.reset_admin_group_cache, sender=Group)
+        m2m_changed.connect(permissions.forget_admin_membership, sender=User.groups.through)
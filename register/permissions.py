@@ -0,0 +1,72 @@
+import threading
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import Group
+
+# Name of the group whose members are admins
+ADMIN_GROUP_NAME = 'AdminGroup'
+
+# Process-wide cache of the admin group's id, reset by the signals connected in RegisterConfig.ready
+_admin_group_id = None
+_admin_group_lock = threading.Lock()
+
+
+def get_admin_group_id():
+    """
+    Returns the id of the admin group, querying it only the first time.
+    :return: int or None if the group does not exist yet
+    """
+    global _admin_group_id
+    if _admin_group_id is None:
+        with _admin_group_lock:
+            if _admin_group_id is None:
+                # A missing group is not cached, so it is found once the post_migrate signal has created it
+                _admin_group_id = Group.objects.filter(name=ADMIN_GROUP_NAME).values_list('id', flat=True).first()
+    return _admin_group_id
+
+
+def reset_admin_group_cache(**kwargs):
+    """Forgets the cached admin group id, e.g. when a group is renamed or deleted."""
+    global _admin_group_id
+    with _admin_group_lock:
+        _admin_group_id = None
+
+
+def is_admin_user(user):
+    """
+    Checks if the user is in the admin group. The answer is memoized on the user object, which lives for one request
+    as request.user, so a page checking several times costs at most one query.
+    :param user: User or AnonymousUser
+    :return: bool
+    """
+    if not user.is_authenticated:
+        return False
+    if getattr(user, '_is_admin', None) is None:
+        group_id = get_admin_group_id()
+        user._is_admin = group_id is not None and user.groups.filter(id=group_id).exists()
+    return user._is_admin
+
+
+async def ais_admin_user(user):
+    """
+    Async version of is_admin_user, running the query in a thread the first time so the event loop is not blocked.
+    :param user: User or AnonymousUser
+    :return: bool
+    """
+    if user.is_authenticated and getattr(user, '_is_admin', None) is None:
+        return await sync_to_async(is_admin_user)(user)
+    return is_admin_user(user)
+
+
+def forget_admin_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Drops the memoized admin check of a user whose groups change, so the change is seen straight away.
+    :param sender: The User.groups through model
+    :param instance: The User, or the Group when the change was made from the group's side
+    :param action: The m2m_changed action
+    :param reverse: True if the change was made from the group's side
+    :param pk_set: The ids of the added or removed objects
+    :return: None
+    """
+    if action in ('post_add', 'post_remove', 'post_clear') and not reverse:
+        instance.__dict__.pop('_is_admin', None)
@@ -1,5 +1,6 @@
 from django import template
-from django.contrib.auth.models import Group
+
+from register.permissions import is_admin_user
 
 # Declares a variable for storing the template library
 register = template.Library()
@@ -10,15 +11,8 @@ register = template.Library()
 # Defines the is_admin filter
 def is_admin(user):
     """
-    Checks if the user is in the AdminGroup
+    Checks if the user is in the AdminGroup, using the shared check memoized for the request
     :param user:
     :return:
     """
-    # Tries to get the AdminGroup
-    try:
-        group = Group.objects.get(name='AdminGroup')
-    # If the AdminGroup does not exist, returns False
-    except Group.DoesNotExist:
-        return False
-    # Returns True if the user is in the AdminGroup, False otherwise
-    return group in user.groups.all()
+    return is_admin_user(user)
@@ -2,21 +2,18 @@ from threading import Thread
 from unittest.mock import patch
 from django.test import TestCase, Client
 from django.urls import reverse
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import AnonymousUser, User, Group
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from register.forms import UserForm, LoginForm
 from payapp.utils import convert_currency
-from thrift_timestamp import server
+from register import permissions
+from register.permissions import ADMIN_GROUP_NAME, is_admin_user
+from register.templatetags.group_tags import is_admin
 
 
 class UserViewTests(TestCase):
 
-    @classmethod
-    def tearDownClass(cls):
-        super().tearDownClass()
-        # Stop the Thrift server
-        server.stop_thrift_server()
-        print('Thrift server stopped.')
-
     def setUp(self):
         self.client = Client()
         # self.admin_group = Group.objects.create(name='AdminGroup')
@@ -84,3 +81,54 @@ class UserViewTests(TestCase):
         response = self.client.get(reverse('register:login'))
         self.assertEqual(response.status_code, 200)
         self.assertIsInstance(response.context['form'], LoginForm)
+
+
+class AdminCheckTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='member', password='memberpassword')
+        self.admin_group = Group.objects.get(name=ADMIN_GROUP_NAME)
+
+    def test_check_is_memoized(self):
+        """
+        Test that repeated admin checks on the same user cost no queries after the first
+        """
+        permissions.get_admin_group_id()
+        with self.assertNumQueries(1):
+            self.assertFalse(is_admin_user(self.user))
+            self.assertFalse(is_admin(self.user))
+            self.assertFalse(is_admin_user(self.user))
+
+    def test_group_id_is_cached_process_wide(self):
+        permissions.reset_admin_group_cache()
+        with self.assertNumQueries(1):
+            self.assertEqual(permissions.get_admin_group_id(), self.admin_group.id)
+            self.assertEqual(permissions.get_admin_group_id(), self.admin_group.id)
+
+    def test_membership_change_invalidates_memo(self):
+        self.assertFalse(is_admin_user(self.user))
+        self.user.groups.add(self.admin_group)
+        self.assertTrue(is_admin_user(self.user))
+        self.user.groups.remove(self.admin_group)
+        self.assertFalse(is_admin_user(self.user))
+
+    def test_renaming_group_resets_group_id(self):
+        permissions.get_admin_group_id()
+        self.admin_group.name = 'FormerAdminGroup'
+        self.admin_group.save()
+        self.addCleanup(permissions.reset_admin_group_cache)
+        self.assertIsNone(permissions.get_admin_group_id())
+
+    def test_anonymous_user_is_not_admin(self):
+        with self.assertNumQueries(0):
+            self.assertFalse(is_admin_user(AnonymousUser()))
+
+    def test_page_checks_admin_once(self):
+        """
+        Test that base.html's two is_admin checks share one membership query
+        """
+        self.user.groups.add(self.admin_group)
+        self.client.login(username='member', password='memberpassword')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('home'))
+        membership_queries = [q for q in queries.captured_queries if 'auth_user_groups' in q['sql']]
+        self.assertEqual(len(membership_queries), 1)
@@ -3,6 +3,7 @@ from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login, logout
 from payapp.custom_exceptions import CurrencyConversionError
 from register.forms import UserForm, LoginForm
+from register.permissions import is_admin_user
 from django.db import transaction
 
 
@@ -70,7 +71,7 @@ def login_view(request):
             if user is not None:
                 login(request, user)
                 messages.success(request, "You have been logged in")
-                if user.groups.filter(name="AdminGroup").exists():
+                if is_admin_user(user):
                     messages.success(request, "You are an admin and can view all transaction and users "
                                               "as well as register new admins.")
                 return redirect('home')
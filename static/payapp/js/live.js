@@ -0,0 +1,49 @@
+// Keeps the balance and the unread notification badge in the navigation bar up to date from the live update stream,
+// so they change without reloading the page, and shows each new notification as an alert. The browser reconnects a
+// dropped stream by itself.
+(function () {
+    const script = document.getElementById('live-updates');
+    if (!script || !window.EventSource) {
+        return;
+    }
+    const source = new EventSource(script.dataset.url);
+
+    source.addEventListener('balance', function (event) {
+        const balance = document.getElementById('user-balance');
+        if (balance) {
+            balance.textContent = JSON.parse(event.data).balance;
+        }
+    });
+
+    source.addEventListener('unread', function (event) {
+        const badge = document.getElementById('unread-badge');
+        if (badge) {
+            const count = JSON.parse(event.data).count;
+            badge.textContent = count;
+            badge.classList.toggle('d-none', !count);
+        }
+    });
+
+    // Shows the notification above the page content, as the messages are, linking to the notifications page
+    source.addEventListener('notification', function (event) {
+        const notification = JSON.parse(event.data);
+        const content = document.querySelector('.container.py-5');
+        if (!content || notification.read) {
+            return;
+        }
+        const alert = document.createElement('div');
+        alert.className = 'alert alert-info alert-dismissible fade show';
+        alert.setAttribute('role', 'alert');
+        const link = document.createElement('a');
+        link.className = 'alert-link';
+        link.href = script.dataset.notificationsUrl;
+        link.textContent = notification.message;
+        const close = document.createElement('button');
+        close.type = 'button';
+        close.className = 'btn-close';
+        close.setAttribute('data-bs-dismiss', 'alert');
+        close.setAttribute('aria-label', 'Close');
+        alert.append(link, close);
+        content.before(alert);
+    });
+})();
@@ -1,33 +1,466 @@
+import itertools
+import os
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.utils.timezone import make_aware
 from thrift.transport import TSocket
 from thrift.transport import TTransport
 from thrift.protocol import TBinaryProtocol
 from thrift_timestamp.gen_py.timestamp_service import TimestampService
+from thrift_timestamp.server import get_server_options, MAX_TIMESTAMP_BATCH
 
+# Default pool configuration, overridden by the THRIFT_TIMESTAMP_POOL setting
+DEFAULT_POOL_OPTIONS = {
+    'MIN_SIZE': 1,
+    'MAX_SIZE': 10,
+    'TIMEOUT': 2000,  # Socket timeout in milliseconds
+    'ACQUIRE_TIMEOUT': 5,  # Seconds to wait for a free connection when the pool is full
+    'IDLE_TIMEOUT': 300,  # Seconds before an idle connection above MIN_SIZE is closed
+    'HEALTH_CHECK_INTERVAL': 30,  # Seconds of idleness before a connection is checked on checkout
+}
 
-class ThriftTimestampClient:
-    """Thrift client to fetch the current timestamp from the Thrift server."""
-    def __init__(self, host='localhost', port=9090):
-        """Initialize the Thrift client with the host and port of the Thrift server."""
+# Timestamp modes: 'binary' fetches epoch microseconds and builds datetimes directly, 'string' fetches formatted
+# timestamps and parses them
+TIMESTAMP_MODES = ('binary', 'string')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Errors which mean the connection itself is broken and should be replaced
+CONNECTION_ERRORS = (TTransport.TTransportException, socket.error, EOFError)
+
+
+class PoolExhaustedError(Exception):
+    """Exception raised when no connection becomes free within the pool's acquire timeout."""
+
+
+class PooledConnection:
+    """A single open connection to the Thrift server, owned by a ThriftConnectionPool."""
+
+    def __init__(self, host, port, timeout, framed=False):
+        """
+        Open a binary-protocol connection to the Thrift server, using the framed transport when the server runs in
+        non-blocking mode and the buffered transport otherwise.
+        """
+        self.socket = TSocket.TSocket(host, port)
+        self.socket.setTimeout(timeout)
+        if framed:
+            self.transport = TTransport.TFramedTransport(self.socket)
+        else:
+            self.transport = TTransport.TBufferedTransport(self.socket)
+        protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
+        self.client = TimestampService.Client(protocol)
+        self.transport.open()
+        self.last_used = time.monotonic()
+
+    def is_healthy(self):
+        """
+        Checks that the server has not closed the connection without making an RPC. A readable socket with no
+        pending reply means the peer hung up.
+        """
+        handle = self.socket.handle
+        if handle is None:
+            return False
+        timeout = handle.gettimeout()
+        try:
+            # Peek without blocking, as the socket timeout would otherwise make recv wait for data
+            handle.setblocking(False)
+            return handle.recv(1, socket.MSG_PEEK) != b''
+        except BlockingIOError:
+            # Nothing to read, so the connection is still open and idle
+            return True
+        except OSError:
+            return False
+        finally:
+            handle.settimeout(timeout)
+
+    def close(self):
+        """Close the connection, ignoring errors from an already broken socket."""
+        try:
+            self.transport.close()
+        except Exception:
+            pass
+
+
+class ThriftConnectionPool:
+    """
+    Thread-safe pool of persistent connections to a single Thrift timestamp server.
+
+    Connections are handed out last-in first-out so that a small set of hot connections is reused and the rest age
+    out through idle eviction. A connection that fails with a transport error is discarded and the call is retried
+    once on a fresh connection.
+    """
+
+    def __init__(self, host, port, min_size=1, max_size=10, timeout=2000, acquire_timeout=5, idle_timeout=300,
+                 health_check_interval=30, framed=False):
+        """Initialize the pool; connections are opened lazily on first use."""
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1")
         self.host = host
         self.port = port
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.framed = framed
+        self._idle = deque()
+        self._size = 0
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+        # Number of connections opened over the lifetime of the pool
+        self.connections_opened = 0
+
+    @property
+    def size(self):
+        """Total number of open connections, both idle and checked out."""
+        return self._size
+
+    @property
+    def idle_count(self):
+        """Number of open connections waiting in the pool."""
+        return len(self._idle)
+
+    def _reset_after_fork(self):
+        """Drop connections inherited from a parent process, as the sockets are shared with it."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle.clear()
+            self._size = 0
+
+    def _open(self):
+        """Open a new connection, releasing the reserved slot if the server cannot be reached."""
+        try:
+            connection = PooledConnection(self.host, self.port, self.timeout, self.framed)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        self.connections_opened += 1
+        return connection
+
+    def _discard(self, connection):
+        """Close a connection and free its slot in the pool."""
+        connection.close()
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _evict_idle(self, now):
+        """Close connections above min_size that have been idle for longer than idle_timeout. Lock must be held."""
+        while len(self._idle) and self._size > self.min_size:
+            # The left of the deque holds the least recently used connection
+            if now - self._idle[0].last_used < self.idle_timeout:
+                break
+            self._idle.popleft().close()
+            self._size -= 1
+
+    def acquire(self):
+        """
+        Check a connection out of the pool, opening a new one if the pool is below max_size.
+
+        :return: PooledConnection
+        :raises PoolExhaustedError: if no connection is freed within acquire_timeout seconds
+        """
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._condition:
+                self._reset_after_fork()
+                now = time.monotonic()
+                self._evict_idle(now)
+                if self._idle:
+                    connection = self._idle.pop()
+                elif self._size < self.max_size:
+                    # Reserve the slot before connecting so concurrent callers cannot overshoot max_size
+                    self._size += 1
+                    connection = None
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise PoolExhaustedError(f"No Thrift connection available after {self.acquire_timeout}s")
+                    self._condition.wait(remaining)
+                    continue
+
+            if connection is None:
+                return self._open()
+            # Connections that sat idle for a while may have been closed by the server
+            if now - connection.last_used >= self.health_check_interval and not connection.is_healthy():
+                self._discard(connection)
+                continue
+            return connection
+
+    def release(self, connection):
+        """Return a healthy connection to the pool."""
+        connection.last_used = time.monotonic()
+        with self._condition:
+            if self._pid != os.getpid():
+                return
+            self._idle.append(connection)
+            self._evict_idle(connection.last_used)
+            self._condition.notify()
+
+    def warm_up(self):
+        """Open connections until min_size connections are pooled."""
+        connections = []
+        try:
+            while self._size < self.min_size:
+                connections.append(self.acquire())
+        finally:
+            for connection in connections:
+                self.release(connection)
+
+    def call(self, method):
+        """
+        Run method(client) on a pooled connection. If the connection turns out to be broken (for example a broken
+        pipe after the server restarted) it is replaced and the call is retried once.
+
+        :param method: Callable taking a TimestampService.Client
+        :return: The result of method
+        """
+        for attempt in range(2):
+            connection = self.acquire()
+            try:
+                result = method(connection.client)
+            except CONNECTION_ERRORS:
+                self._discard(connection)
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                # The connection may hold a half-read reply, so it cannot be reused
+                self._discard(connection)
+                raise
+            self.release(connection)
+            return result
+
+    def close(self):
+        """Close every idle connection in the pool."""
+        with self._condition:
+            while self._idle:
+                self._idle.pop().close()
+                self._size -= 1
+            self._condition.notify_all()
+
+
+# Registry of pools shared by every client in the process, keyed by (host, port)
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(host, port):
+    """
+    Return the process-wide connection pool for the given Thrift server, creating it on first use from the
+    THRIFT_TIMESTAMP_POOL setting.
+    """
+    with _pools_lock:
+        pool = _pools.get((host, port))
+        if pool is None:
+            options = {**DEFAULT_POOL_OPTIONS, **getattr(settings, 'THRIFT_TIMESTAMP_POOL', {})}
+            pool = ThriftConnectionPool(host, port,
+                                        min_size=options['MIN_SIZE'],
+                                        max_size=options['MAX_SIZE'],
+                                        timeout=options['TIMEOUT'],
+                                        acquire_timeout=options['ACQUIRE_TIMEOUT'],
+                                        idle_timeout=options['IDLE_TIMEOUT'],
+                                        health_check_interval=options['HEALTH_CHECK_INTERVAL'],
+                                        framed=get_server_options()['MODE'] == 'nonblocking')
+            _pools[(host, port)] = pool
+            # Pre-open MIN_SIZE connections; an unreachable server is reported when the pool is first used instead
+            try:
+                pool.warm_up()
+            except Exception:
+                pass
+        return pool
+
+
+def close_connection_pools():
+    """Close and forget every pool and load balancer in the process."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+        _balancers.clear()
+
+
+def parse_endpoint(endpoint):
+    """
+    Parse a Thrift server endpoint given as 'host:port' or a (host, port) tuple.
+
+    :return: Tuple of host and port
+    """
+    if isinstance(endpoint, str):
+        host, _, port = endpoint.rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError(f"Invalid Thrift endpoint '{endpoint}', expected 'host:port'")
+        return host, int(port)
+    host, port = endpoint
+    return host, int(port)
+
+
+class EndpointBalancer:
+    """
+    Spreads calls over the connection pools of several Thrift timestamp servers round-robin. A server that cannot be
+    reached is skipped for cooldown seconds and the call moves on to the next one, so a server being restarted or
+    scaled down costs callers a failover rather than an error.
+    """
+
+    def __init__(self, pools, cooldown=5):
+        if not pools:
+            raise ValueError("At least one Thrift endpoint is required")
+        self.pools = list(pools)
+        self.cooldown = cooldown
+        self._counter = itertools.count()
+        # Monotonic time until which each pool, by index, is skipped
+        self._down_until = [0] * len(self.pools)
+
+    def _candidates(self):
+        """Return the pool indexes to try in order, starting from the next one in the rotation."""
+        start = next(self._counter) % len(self.pools)
+        order = [(start + i) % len(self.pools) for i in range(len(self.pools))]
+        now = time.monotonic()
+        available = [index for index in order if self._down_until[index] <= now]
+        # When every server is marked down try them all anyway, as one may have come back
+        return available or order
+
+    def call(self, method):
+        """
+        Run method(client) on the next available server, failing over to the others on connection errors.
+
+        :param method: Callable taking a TimestampService.Client
+        :return: The result of method
+        :raises: The last connection error if no server could be reached
+        """
+        error = None
+        for index in self._candidates():
+            try:
+                result = self.pools[index].call(method)
+            except CONNECTION_ERRORS + (PoolExhaustedError,) as e:
+                self._down_until[index] = time.monotonic() + self.cooldown
+                error = e
+                continue
+            self._down_until[index] = 0
+            return result
+        raise error
+
+
+# Registry of load balancers shared by every client in the process, keyed by their endpoints
+_balancers = {}
+
+
+def get_load_balancer(endpoints=None):
+    """
+    Return the process-wide load balancer for the given endpoints, which default to the THRIFT_TIMESTAMP_ENDPOINTS
+    setting.
+    """
+    if endpoints is None:
+        endpoints = getattr(settings, 'THRIFT_TIMESTAMP_ENDPOINTS', ['localhost:9090'])
+    endpoints = tuple(parse_endpoint(endpoint) for endpoint in endpoints)
+    balancer = _balancers.get(endpoints)
+    if balancer is None:
+        pools = [get_connection_pool(host, port) for host, port in endpoints]
+        with _pools_lock:
+            balancer = _balancers.setdefault(
+                endpoints,
+                EndpointBalancer(pools, cooldown=getattr(settings, 'THRIFT_TIMESTAMP_ENDPOINT_COOLDOWN', 5)))
+    return balancer
+
+
+def timestamp_to_datetime(timestamp):
+    """Convert a binary Thrift Timestamp to an aware UTC datetime without any string formatting or parsing."""
+    return EPOCH + timedelta(microseconds=timestamp.epochMicros)
+
+
+class ThriftTimestampClient:
+    """
+    Thrift client to fetch the current timestamp from the Thrift servers using the shared connection pools, balancing
+    calls over every configured server.
+    """
+    def __init__(self, host=None, port=None, mode=None, endpoints=None):
+        """
+        Initialize the Thrift client with the servers to use and the timestamp mode, which defaults to the
+        THRIFT_TIMESTAMP_MODE setting. Giving a host or port connects to that single server, otherwise the endpoints
+        default to the THRIFT_TIMESTAMP_ENDPOINTS setting.
+        """
+        if host or port:
+            endpoints = [(host or 'localhost', port or 9090)]
+        self.balancer = get_load_balancer(endpoints)
+        self.mode = mode or getattr(settings, 'THRIFT_TIMESTAMP_MODE', 'binary')
+        if self.mode not in TIMESTAMP_MODES:
+            raise ValueError(f"Unknown timestamp mode '{self.mode}', expected one of {', '.join(TIMESTAMP_MODES)}")
 
     def get_current_timestamp(self):
         """Fetch the current timestamp from the Thrift server."""
         try:
-            # Create a Thrift client to connect to the server
-            transport = TSocket.TSocket(self.host, self.port)
-            transport = TTransport.TBufferedTransport(transport)
-            protocol = TBinaryProtocol.TBinaryProtocol(transport)
-            client = TimestampService.Client(protocol)
-            # Open the connection to the server
-            transport.open()
-            # Fetch the current timestamp from the server
-            timestamp = client.getCurrentTimestamp()
-            # Close the connection to the server
-            transport.close()
-            return timestamp
+            return self.balancer.call(lambda client: client.getCurrentTimestamp())
 
         # Handle any exceptions that occur during the process
         except Exception as e:
             print("An error occurred while fetching the timestamp:", e)
             return None
+
+    def get_timestamps(self, count):
+        """
+        Fetch count unique, increasing timestamps from the Thrift server, using one RPC per MAX_TIMESTAMP_BATCH
+        timestamps.
+        """
+        try:
+            timestamps = []
+            while len(timestamps) < count:
+                size = min(count - len(timestamps), MAX_TIMESTAMP_BATCH)
+                timestamps.extend(self.balancer.call(lambda client: client.getTimestamps(size)))
+            return timestamps
+
+        # Handle any exceptions that occur during the process
+        except Exception as e:
+            print("An error occurred while fetching the timestamps:", e)
+            return None
+
+    def get_current_datetime(self):
+        """
+        Fetch the current time from the Thrift server as an aware datetime. In binary mode the datetime is built
+        straight from epoch microseconds, in string mode the formatted timestamp is parsed.
+
+        :return: datetime or None if the server could not be reached
+        """
+        try:
+            if self.mode == 'binary':
+                return timestamp_to_datetime(self.balancer.call(lambda client: client.getTimestamp()))
+            return make_aware(datetime.strptime(self.balancer.call(lambda client: client.getCurrentTimestamp()),
+                                                '%Y-%m-%d %H:%M:%S'))
+
+        # Handle any exceptions that occur during the process
+        except Exception as e:
+            print("An error occurred while fetching the timestamp:", e)
+            return None
+
+    def get_datetimes(self, count):
+        """
+        Fetch count unique, strictly increasing aware datetimes from the Thrift server, using one RPC per
+        MAX_TIMESTAMP_BATCH datetimes.
+
+        :return: List of datetimes or None if the server could not be reached
+        """
+        if self.mode == 'string':
+            timestamps = self.get_timestamps(count)
+            if timestamps is None:
+                return None
+            return [make_aware(datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')) for timestamp in timestamps]
+        try:
+            datetimes = []
+            while len(datetimes) < count:
+                size = min(count - len(datetimes), MAX_TIMESTAMP_BATCH)
+                block = self.balancer.call(lambda client: client.getTimestampBlock(size))
+                datetimes.extend(timestamp_to_datetime(timestamp) for timestamp in block)
+            return datetimes
+
+        # Handle any exceptions that occur during the process
+        except Exception as e:
+            print("An error occurred while fetching the timestamps:", e)
+            return None
+
@@ -0,0 +1,61 @@
+import os
+import signal
+
+from django.core.management.base import BaseCommand
+
+from thrift_timestamp import server
+
+
+class Command(BaseCommand):
+    help = ("Runs the Thrift timestamp server until it receives SIGTERM or SIGINT, then stops accepting connections "
+            "and lets requests in progress finish. Options default to the THRIFT_TIMESTAMP_SERVER setting.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=server.SERVER_MODES)
+        parser.add_argument('--host', help="Interface to listen on, all interfaces by default")
+        parser.add_argument('--port', type=int)
+        parser.add_argument('--workers', type=int, help="Worker threads for the threaded and nonblocking modes")
+        parser.add_argument('--backlog', type=int, help="Size of the socket accept queue")
+        parser.add_argument('--grace-period', type=float, default=server.DEFAULT_GRACE_PERIOD,
+                            help="Seconds to wait for requests in progress when stopping")
+        parser.add_argument('--ready-file',
+                            help="File created once the server accepts connections and removed when it stops, for "
+                                 "readiness probes")
+
+    def handle(self, *args, **options):
+        """
+        Starts the server in the foreground, signalling readiness through the ready file once it is listening.
+        :param args:
+        :param options:
+        :return:
+        """
+        ready_file = options['ready_file']
+
+        def on_ready():
+            if ready_file:
+                with open(ready_file, 'w') as f:
+                    f.write(f"{os.getpid()}\n")
+            self.stdout.write(self.style.SUCCESS("Thrift timestamp server ready"))
+
+        def on_signal(signum, frame):
+            # Stop reporting ready straight away so no new clients are sent here while the server drains
+            self.remove_ready_file(ready_file)
+            server.stop_thrift_server()
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+        try:
+            server.start_thrift_server(mode=options['mode'], host=options['host'], port=options['port'],
+                                       workers=options['workers'], backlog=options['backlog'],
+                                       grace_period=options['grace_period'], on_ready=on_ready)
+        finally:
+            self.remove_ready_file(ready_file)
+
+    @staticmethod
+    def remove_ready_file(ready_file):
+        """Removes the ready file if there is one."""
+        if ready_file:
+            try:
+                os.remove(ready_file)
+            except FileNotFoundError:
+                pass
@@ -1,46 +1,293 @@
+import argparse
 import logging
-from datetime import datetime
+import signal
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
 
 from thrift.protocol import TBinaryProtocol
+from thrift.server import TNonblockingServer
 from thrift.server import TServer
 from thrift.transport import TSocket
 from thrift.transport import TTransport
 
 from thrift_timestamp.gen_py.timestamp_service import TimestampService
+from thrift_timestamp.gen_py.timestamp_service.ttypes import InvalidRequest, Timestamp
 
 # Global variable to hold the Thrift server instance
 server = None
 # Global variable to control the server loop
-server_running = True
+server_running = False
+# Set to make start_thrift_server() shut the server down
+_stop_event = threading.Event()
+
+# Supported server modes:
+# - simple: TSimpleServer, serves a single connection at a time
+# - threaded: TThreadPoolServer, each open connection is served by one of a fixed number of worker threads
+# - nonblocking: TNonblockingServer, multiplexes every connection on one select loop with a pool of worker threads
+#   processing requests (clients must use the framed transport)
+# - forking: TForkingServer, forks a process for every accepted connection; as every child process keeps its own
+#   clock state, timestamps are only guaranteed to be monotonic per connection in this mode
+SERVER_MODES = ('simple', 'threaded', 'nonblocking', 'forking')
+
+# Default server configuration, overridden by the THRIFT_TIMESTAMP_SERVER setting
+DEFAULT_SERVER_OPTIONS = {
+    'MODE': 'threaded',
+    'HOST': None,  # Listen on all interfaces
+    'PORT': 9090,
+    'WORKERS': 32,
+    'BACKLOG': 128,
+}
+
+
+# Largest block of timestamps a single getTimestamps call can reserve
+MAX_TIMESTAMP_BATCH = 1000
+
+# Seconds a stopping server waits for requests already being processed to finish
+DEFAULT_GRACE_PERIOD = 5
+
+
+class StoppableServerSocket(TSocket.TServerSocket):
+    """
+    Server socket which can stop accepting connections while the server loop is still running. The stock Thrift
+    servers accept in an endless loop, so once stopped, accept() parks the server thread instead of failing.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stopped = threading.Event()
+
+    def listen(self):
+        """Bind and listen, unless already listening so the socket can be bound before the server loop starts."""
+        if self.handle is None:
+            super().listen()
+
+    def accept(self):
+        try:
+            return super().accept()
+        except Exception:
+            if self._stopped.is_set():
+                # Park the server thread until the process exits
+                threading.Event().wait()
+            raise
+
+    def stop_accepting(self):
+        """Close the listening socket, refusing new connections while open ones are drained."""
+        self._stopped.set()
+        if self.handle is not None:
+            try:
+                # Shutting the socket down wakes up a thread blocked in accept(), which closing alone does not
+                self.handle.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.handle.close()
+
+
+class CountingProcessor(TimestampService.Processor):
+    """Processor which counts the requests being processed so a stopping server can wait for them to finish."""
+    def __init__(self, handler):
+        super().__init__(handler)
+        self._in_flight = 0
+        self._idle = threading.Condition()
+        self._processMap = {name: self._counting(method) for name, method in self._processMap.items()}
+
+    def _counting(self, method):
+        """Wrap a process_* method, counting it as in flight from reading its arguments to writing its reply."""
+        def process(processor, seqid, iprot, oprot):
+            with self._idle:
+                self._in_flight += 1
+            try:
+                return method(processor, seqid, iprot, oprot)
+            finally:
+                with self._idle:
+                    self._in_flight -= 1
+                    self._idle.notify_all()
+        return process
+
+    @property
+    def in_flight(self):
+        """Number of requests currently being processed."""
+        return self._in_flight
+
+    def wait_idle(self, timeout):
+        """
+        Wait until no request is being processed.
+
+        :return: True if the processor became idle within timeout seconds
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._in_flight == 0, timeout)
+
 
 class TimestampHandler:
+    def __init__(self):
+        """Initialize the handler with a lock guarding the last microsecond and sequence number handed out."""
+        self._lock = threading.Lock()
+        self._last_micros = 0
+        self._sequence = 0
+
+    def _reserve(self, count):
+        """
+        Reserve count consecutive microseconds later than every timestamp handed out so far, even if the clock has
+        not moved on or has gone backwards.
+
+        :return: Tuple of the first reserved epoch microsecond and its sequence number
+        """
+        with self._lock:
+            first = max(time.time_ns() // 1000, self._last_micros + 1)
+            self._last_micros = first + count - 1
+            sequence = self._sequence + 1
+            self._sequence += count
+        return first, sequence
+
+    @staticmethod
+    def _validate_count(count):
+        """Raise InvalidRequest unless count is a valid batch size."""
+        if count is None or not 1 <= count <= MAX_TIMESTAMP_BATCH:
+            raise InvalidRequest(f"count must be between 1 and {MAX_TIMESTAMP_BATCH}")
+
     def getCurrentTimestamp(self):
         """Return the current timestamp in the format 'YYYY-MM-DD HH:MM:SS'"""
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-def start_thrift_server():
-    """Start the Thrift server and serve requests indefinitely."""
+    def getTimestamps(self, count):
+        """
+        Return count unique, strictly increasing local timestamps in the format 'YYYY-MM-DD HH:MM:SS.ffffff', one
+        microsecond apart.
+        """
+        self._validate_count(count)
+        first, _ = self._reserve(count)
+        seconds, micros = divmod(first, 1000000)
+        start = datetime.fromtimestamp(seconds) + timedelta(microseconds=micros)
+        return [(start + timedelta(microseconds=i)).strftime("%Y-%m-%d %H:%M:%S.%f") for i in range(count)]
+
+    def getTimestamp(self):
+        """Return the current time as a binary Timestamp of epoch microseconds and a sequence number."""
+        first, sequence = self._reserve(1)
+        return Timestamp(epochMicros=first, sequence=sequence)
+
+    def getTimestampBlock(self, count):
+        """Return count unique, strictly increasing binary Timestamps, one microsecond apart."""
+        self._validate_count(count)
+        first, sequence = self._reserve(count)
+        return [Timestamp(epochMicros=first + i, sequence=sequence + i) for i in range(count)]
+
+
+def get_server_options():
+    """
+    Return the server configuration from the THRIFT_TIMESTAMP_SERVER setting, falling back to the defaults when
+    Django settings are not configured (e.g. when this module is run as a script).
+    """
+    from django.conf import settings
+    options = dict(DEFAULT_SERVER_OPTIONS)
+    if settings.configured:
+        options.update(getattr(settings, 'THRIFT_TIMESTAMP_SERVER', {}))
+    return options
+
+
+def build_server(mode='threaded', host=None, port=9090, workers=32, backlog=128):
+    """
+    Build a Thrift timestamp server without starting it.
+
+    :param mode: One of SERVER_MODES
+    :param host: The interface to listen on, None for all interfaces
+    :param port: The port to listen on
+    :param workers: The number of worker threads for the threaded and nonblocking modes
+    :param backlog: The size of the socket accept queue
+    :return: The Thrift server instance
+    """
+    if mode not in SERVER_MODES:
+        raise ValueError(f"Unknown Thrift server mode '{mode}', expected one of {', '.join(SERVER_MODES)}")
+
+    handler = TimestampHandler()
+    processor = CountingProcessor(handler)
+    transport = StoppableServerSocket(host=host, port=port)
+    transport.setBacklog(backlog)
+    pfactory = TBinaryProtocol.TBinaryProtocolFactory()
+
+    # The non-blocking server reads whole frames, so it brings its own framed transport
+    if mode == 'nonblocking':
+        thrift_server = TNonblockingServer.TNonblockingServer(processor, transport, pfactory, threads=workers)
+    else:
+        tfactory = TTransport.TBufferedTransportFactory()
+        if mode == 'threaded':
+            thrift_server = TServer.TThreadPoolServer(processor, transport, tfactory, pfactory, daemon=True)
+            thrift_server.setNumThreads(workers)
+        elif mode == 'forking':
+            thrift_server = TServer.TForkingServer(processor, transport, tfactory, pfactory)
+        else:
+            thrift_server = TServer.TSimpleServer(processor, transport, tfactory, pfactory)
+    # Keep hold of the listening socket, which the server classes store under different names
+    thrift_server.listener = transport
+    return thrift_server
+
+
+def start_thrift_server(mode=None, host=None, port=None, workers=None, backlog=None, grace_period=None,
+                        on_ready=None):
+    """
+    Start the Thrift server and serve requests until stop_thrift_server() is called, then shut down gracefully: new
+    connections are refused and requests already being processed get up to grace_period seconds to finish. Any
+    argument left as None is read from the THRIFT_TIMESTAMP_SERVER setting. Must be called from the main thread for
+    stop_thrift_server() to be usable from signal handlers.
+
+    :param on_ready: Callable run once the server is accepting connections
+    """
     # Declare the global variables
     global server
     global server_running
+    options = get_server_options()
+    mode = mode or options['MODE']
+    host = host or options['HOST']
+    port = port or options['PORT']
+    grace_period = DEFAULT_GRACE_PERIOD if grace_period is None else grace_period
     # Create the Thrift server
-    handler = TimestampHandler()
-    processor = TimestampService.Processor(handler)
-    transport = TSocket.TServerSocket(port=9090)
-    tfactory = TTransport.TBufferedTransportFactory()
-    pfactory = TBinaryProtocol.TBinaryProtocolFactory()
+    server = build_server(mode=mode,
+                          host=host,
+                          port=port,
+                          workers=workers or options['WORKERS'],
+                          backlog=backlog or options['BACKLOG'])
+    server_running = True
+    _stop_event.clear()
+
+    # Bind before serving so a busy port fails here and the server is only reported ready once it is listening
+    server.listener.listen()
+    serve_thread = threading.Thread(target=server.serve, name='thrift-timestamp-server', daemon=True)
+    serve_thread.start()
+    print(f"Thrift server ({mode}) listening on {host or '*'}:{port}")
+    if on_ready is not None:
+        on_ready()
+
+    # Wait in the main thread, where signal handlers run
+    _stop_event.wait()
+
+    print("Stopping the Thrift server...")
+    server.listener.stop_accepting()
+    if not server.processor.wait_idle(grace_period):
+        print(f"{server.processor.in_flight} requests were still being processed after {grace_period}s")
+    if isinstance(server, TNonblockingServer.TNonblockingServer):
+        server.stop()
+        serve_thread.join(grace_period)
+    print("Thrift server stopped.")
 
-    # Start the server loop
-    server = TServer.TSimpleServer(processor, transport, tfactory, pfactory)
-    print("Starting the Thrift server...")
-    while server_running:
-        server.serve()
 
 def stop_thrift_server():
-    """Stop the Thrift server."""
+    """Stop the Thrift server started by start_thrift_server(). Safe to call from a signal handler."""
     global server_running
     server_running = False
+    _stop_event.set()
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
-    start_thrift_server()
+    parser = argparse.ArgumentParser(description="Run the Thrift timestamp server.")
+    parser.add_argument('--mode', choices=SERVER_MODES, default=DEFAULT_SERVER_OPTIONS['MODE'])
+    parser.add_argument('--host', default=DEFAULT_SERVER_OPTIONS['HOST'])
+    parser.add_argument('--port', type=int, default=DEFAULT_SERVER_OPTIONS['PORT'])
+    parser.add_argument('--workers', type=int, default=DEFAULT_SERVER_OPTIONS['WORKERS'])
+    parser.add_argument('--backlog', type=int, default=DEFAULT_SERVER_OPTIONS['BACKLOG'])
+    parser.add_argument('--grace-period', type=float, default=DEFAULT_GRACE_PERIOD)
+    args = parser.parse_args()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_thrift_server())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_thrift_server())
+    start_thrift_server(mode=args.mode, host=args.host, port=args.port, workers=args.workers, backlog=args.backlog,
+                        grace_period=args.grace_period)
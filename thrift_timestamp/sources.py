@@ -0,0 +1,353 @@
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from thrift_timestamp.client import ThriftTimestampClient, EPOCH
+
+# Timestamp source modes:
+# - thrift: every timestamp comes from the Thrift server, failing loudly when it cannot be reached
+# - local: timestamps come from this process's monotonic clock and never touch the network
+# - hybrid: timestamps come from the local clock corrected by an offset that a background thread keeps in sync with
+#   the Thrift server
+SOURCE_MODES = ('thrift', 'local', 'hybrid')
+
+# Default source configuration, overridden by the THRIFT_TIMESTAMP_SOURCE setting
+DEFAULT_SOURCE_OPTIONS = {
+    'MODE': 'hybrid',
+    'SYNC_INTERVAL': 10,  # Seconds between background offset syncs in hybrid mode
+    'DRIFT_BOUND': 60,  # Seconds a synced offset is trusted before hybrid mode asks the server directly
+}
+
+
+class TimestampUnavailableError(Exception):
+    """Exception raised when the strict Thrift source cannot get a timestamp from the server."""
+
+    def __init__(self, message="The Thrift timestamp server could not be reached"):
+        self.message = message
+        super().__init__(self.message)
+
+
+def micros_to_datetime(micros):
+    """Convert epoch microseconds to an aware UTC datetime."""
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def datetime_to_micros(value):
+    """Convert an aware datetime to epoch microseconds."""
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class TimestampSource:
+    """
+    Base class for timestamp sources. Counts how many timestamps each underlying source served so the mix can be
+    monitored with get_metrics().
+    """
+    def __init__(self):
+        self._metrics = Counter()
+        self._metrics_lock = threading.Lock()
+
+    def record(self, name, count=1):
+        """Add count to the named metric."""
+        with self._metrics_lock:
+            self._metrics[name] += count
+
+    def get_metrics(self):
+        """Return a copy of the metric counters."""
+        with self._metrics_lock:
+            return dict(self._metrics)
+
+    def now(self):
+        """Return the current time as an aware datetime."""
+        raise NotImplementedError
+
+    def reserve(self, count):
+        """Return count unique, strictly increasing aware datetimes."""
+        raise NotImplementedError
+
+    async def anow(self):
+        """
+        Return the current time without blocking the event loop. Sources which may call the Thrift server do so in a
+        worker thread, as the Thrift client's sockets are blocking.
+        """
+        return await sync_to_async(self.now, thread_sensitive=False)()
+
+
+class ThriftTimestampSource(TimestampSource):
+    """Strict source fetching every timestamp from the Thrift server."""
+    def __init__(self, client=None):
+        super().__init__()
+        self.client = client or ThriftTimestampClient()
+
+    def now(self):
+        """
+        Fetch the current time from the Thrift server.
+
+        :raises TimestampUnavailableError: if the server could not be reached
+        """
+        timestamp = self.client.get_current_datetime()
+        if timestamp is None:
+            self.record('thrift_failures')
+            raise TimestampUnavailableError
+        self.record('thrift')
+        return timestamp
+
+    def reserve(self, count):
+        """
+        Fetch a block of count timestamps from the Thrift server.
+
+        :raises TimestampUnavailableError: if the server could not be reached
+        """
+        timestamps = self.client.get_datetimes(count)
+        if timestamps is None:
+            self.record('thrift_failures')
+            raise TimestampUnavailableError
+        self.record('thrift', count)
+        return timestamps
+
+
+class LocalClockTimestampSource(TimestampSource):
+    """
+    Source serving timestamps from this process's clock. The wall clock is read once and then advanced with the
+    monotonic clock, so timestamps never go backwards when the system time is adjusted, and every timestamp is at
+    least one microsecond after the previous one.
+    """
+    metric = 'local'
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._wall_base = time.time_ns() // 1000
+        self._monotonic_base = time.monotonic_ns() // 1000
+        self._last_micros = 0
+
+    def local_micros(self):
+        """Return the local clock reading in epoch microseconds."""
+        return self._wall_base + time.monotonic_ns() // 1000 - self._monotonic_base
+
+    def offset_micros(self):
+        """Return the correction added to the local clock, none for the plain local source."""
+        return 0
+
+    def _reserve_micros(self, count):
+        """Reserve count consecutive microseconds after every timestamp handed out so far."""
+        with self._lock:
+            first = max(self.local_micros() + self.offset_micros(), self._last_micros + 1)
+            self._last_micros = first + count - 1
+        return first
+
+    def now(self):
+        self.record(self.metric)
+        return micros_to_datetime(self._reserve_micros(1))
+
+    async def anow(self):
+        """Return the current time straight from the local clock, which does no I/O."""
+        return self.now()
+
+    def reserve(self, count):
+        self.record(self.metric, count)
+        first = self._reserve_micros(count)
+        return [micros_to_datetime(first + i) for i in range(count)]
+
+
+class HybridTimestampSource(LocalClockTimestampSource):
+    """
+    Source serving timestamps from the local clock corrected by its offset from the Thrift server. A background thread
+    re-measures the offset every sync_interval seconds, so serving a timestamp costs no RPC. If the offset is older
+    than drift_bound seconds, because the server has been unreachable, the timestamp is fetched from the server
+    directly, and if that fails too the local clock with the last known offset is used.
+    """
+    metric = 'hybrid'
+
+    def __init__(self, client=None, sync_interval=10, drift_bound=60):
+        super().__init__()
+        self.client = client or ThriftTimestampClient()
+        self.sync_interval = sync_interval
+        self.drift_bound = drift_bound
+        self._offset = 0
+        self._synced_at = None
+        self._attempted_at = None
+        self._sync_thread = None
+        self._sync_pid = None
+        self._stop = threading.Event()
+
+    def offset_micros(self):
+        return self._offset
+
+    def sync(self):
+        """
+        Measure the offset between the local clock and the Thrift server, assuming the reply was produced half way
+        through the round trip.
+
+        :return: True if the offset was updated
+        """
+        self._attempted_at = time.monotonic()
+        before = self.local_micros()
+        server_time = self.client.get_current_datetime()
+        after = self.local_micros()
+        if server_time is None:
+            self.record('sync_failures')
+            return False
+        self._offset = datetime_to_micros(server_time) - (before + after) // 2
+        self._synced_at = time.monotonic()
+        self.record('syncs')
+        return True
+
+    def _sync_loop(self):
+        """Keep the offset in sync until stop() is called."""
+        while not self._stop.is_set():
+            self.sync()
+            self._stop.wait(self.sync_interval)
+
+    def start(self):
+        """Start the background sync thread, restarting it in a process forked from the one that started it."""
+        if self._sync_pid == os.getpid() and self._sync_thread.is_alive():
+            return
+        with self._lock:
+            if self._sync_pid == os.getpid() and self._sync_thread.is_alive():
+                return
+            self._stop.clear()
+            self._sync_thread = threading.Thread(target=self._sync_loop, name='timestamp-offset-sync', daemon=True)
+            self._sync_pid = os.getpid()
+            self._sync_thread.start()
+
+    def stop(self):
+        """Stop the background sync thread."""
+        self._stop.set()
+
+    def is_offset_fresh(self):
+        """Return True if the offset was synced within the drift bound."""
+        return self._synced_at is not None and time.monotonic() - self._synced_at <= self.drift_bound
+
+    def _fall_back(self, count):
+        """
+        Serve count timestamps when the offset is stale: from the Thrift server if it answers, otherwise from the
+        local clock. The server is asked at most once per sync interval so an outage does not slow every request.
+        """
+        recently_attempted = (self._attempted_at is not None
+                              and time.monotonic() - self._attempted_at < self.sync_interval)
+        if not recently_attempted and self.sync():
+            return None
+        self.record('local', count)
+        first = self._reserve_micros(count)
+        return [micros_to_datetime(first + i) for i in range(count)]
+
+    def now(self):
+        self.start()
+        if not self.is_offset_fresh():
+            fallback = self._fall_back(1)
+            if fallback is not None:
+                return fallback[0]
+        return super().now()
+
+    async def anow(self):
+        """
+        Return the current time from the local clock while the offset is fresh, and only fall back to a worker thread
+        when the Thrift server may have to be asked.
+        """
+        if self.is_offset_fresh():
+            self.start()
+            return LocalClockTimestampSource.now(self)
+        return await sync_to_async(self.now, thread_sensitive=False)()
+
+    def reserve(self, count):
+        self.start()
+        if not self.is_offset_fresh():
+            fallback = self._fall_back(count)
+            if fallback is not None:
+                return fallback
+        return super().reserve(count)
+
+
+def build_timestamp_source(mode='hybrid', sync_interval=10, drift_bound=60, client=None):
+    """
+    Build a timestamp source for the given mode.
+
+    :param mode: One of SOURCE_MODES
+    :param sync_interval: Seconds between offset syncs in hybrid mode
+    :param drift_bound: Seconds a synced offset is trusted in hybrid mode
+    :param client: The ThriftTimestampClient for the thrift and hybrid modes, defaults to the shared client
+    :return: TimestampSource
+    """
+    if mode == 'thrift':
+        return ThriftTimestampSource(client)
+    if mode == 'local':
+        return LocalClockTimestampSource()
+    if mode == 'hybrid':
+        return HybridTimestampSource(client, sync_interval=sync_interval, drift_bound=drift_bound)
+    raise ValueError(f"Unknown timestamp source mode '{mode}', expected one of {', '.join(SOURCE_MODES)}")
+
+
+# Process-wide timestamp source used by ThriftTimestampField and the views
+_source = None
+_source_lock = threading.Lock()
+
+
+def get_timestamp_source():
+    """Return the process-wide timestamp source, building it on first use from the THRIFT_TIMESTAMP_SOURCE setting."""
+    global _source
+    if _source is None:
+        with _source_lock:
+            if _source is None:
+                options = {**DEFAULT_SOURCE_OPTIONS, **getattr(settings, 'THRIFT_TIMESTAMP_SOURCE', {})}
+                _source = build_timestamp_source(options['MODE'], sync_interval=options['SYNC_INTERVAL'],
+                                                 drift_bound=options['DRIFT_BOUND'])
+    return _source
+
+
+def set_timestamp_source(source):
+    """Replace the process-wide timestamp source, returning the previous one."""
+    global _source
+    with _source_lock:
+        previous, _source = _source, source
+    if isinstance(previous, HybridTimestampSource):
+        previous.stop()
+    return previous
+
+
+# Blocks of timestamps reserved with reserve_timestamps on the current thread, innermost last
+_reserved = threading.local()
+
+
+@contextmanager
+def reserve_timestamps(count, source=None):
+    """
+    Reserve a block of count timestamps at once. Every ThriftTimestampField saved on this thread inside the block
+    takes the next reserved timestamp instead of asking the timestamp source itself, so a transaction inserting
+    several rows costs at most one round-trip for time::
+
+        with transaction.atomic(), reserve_timestamps(3):
+            ...
+
+    If the reservation fails or the block runs out, fields fall back to fetching their own timestamp.
+
+    :param count: The number of timestamps to reserve
+    :param source: The TimestampSource to reserve from, defaults to the process-wide source
+    """
+    source = source or get_timestamp_source()
+    try:
+        block = deque(source.reserve(count))
+    except TimestampUnavailableError:
+        block = deque()
+    if not hasattr(_reserved, 'blocks'):
+        _reserved.blocks = []
+    _reserved.blocks.append(block)
+    try:
+        yield block
+    finally:
+        # Blocks are strictly nested, and two exhausted blocks compare equal, so pop rather than remove by value
+        _reserved.blocks.pop()
+
+
+def take_reserved_timestamp():
+    """Return the next timestamp of the innermost reserve_timestamps block on this thread, or None if there is none."""
+    blocks = getattr(_reserved, 'blocks', None)
+    if blocks and blocks[-1]:
+        return blocks[-1].popleft()
+    return None
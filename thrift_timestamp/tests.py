@@ -1,3 +1,454 @@
-from django.test import TestCase
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from payapp.models import Account
+from thrift_timestamp.client import ThriftConnectionPool, ThriftTimestampClient, PoolExhaustedError, \
+    timestamp_to_datetime, EndpointBalancer, parse_endpoint
+from thrift_timestamp.sources import reserve_timestamps, take_reserved_timestamp, build_timestamp_source, \
+    HybridTimestampSource, LocalClockTimestampSource, ThriftTimestampSource, TimestampUnavailableError, \
+    set_timestamp_source, get_timestamp_source, _reserved
+from thrift_timestamp.gen_py.timestamp_service.ttypes import InvalidRequest, Timestamp
+from thrift_timestamp import server
+from thrift_timestamp.server import build_server, TimestampHandler, MAX_TIMESTAMP_BATCH
+
+
+def get_free_port():
+    """Ask the OS for a port that is not currently in use."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def start_test_server(mode='threaded'):
+    """Start a Thrift server on a free port in a daemon thread and return the port."""
+    port = get_free_port()
+    test_server = build_server(mode=mode, host='localhost', port=port, workers=4)
+    Thread(target=test_server.serve, daemon=True).start()
+    # Wait until the server accepts connections
+    for _ in range(50):
+        try:
+            socket.create_connection(('localhost', port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.02)
+    return port
+
+
+class ThriftConnectionPoolTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.port = start_test_server()
+
+    def make_pool(self, **kwargs):
+        pool = ThriftConnectionPool('localhost', self.port, **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_connection_is_reused(self):
+        """
+        Test that consecutive calls share one connection instead of reconnecting each time
+        """
+        pool = self.make_pool()
+        for _ in range(5):
+            self.assertIsNotNone(pool.call(lambda client: client.getCurrentTimestamp()))
+        self.assertEqual(pool.connections_opened, 1)
+        self.assertEqual(pool.idle_count, 1)
+
+    def test_reconnects_after_broken_connection(self):
+        """
+        Test that a connection closed underneath the pool is replaced transparently
+        """
+        pool = self.make_pool(health_check_interval=3600)
+        pool.call(lambda client: client.getCurrentTimestamp())
+        # Break the pooled socket without telling the pool
+        pool._idle[0].socket.handle.shutdown(socket.SHUT_RDWR)
+        self.assertIsNotNone(pool.call(lambda client: client.getCurrentTimestamp()))
+        self.assertEqual(pool.connections_opened, 2)
+        self.assertEqual(pool.size, 1)
+
+    def test_health_check_discards_closed_connection(self):
+        """
+        Test that an idle connection closed by the peer is discarded on checkout
+        """
+        pool = self.make_pool(health_check_interval=0)
+        pool.call(lambda client: client.getCurrentTimestamp())
+        pool._idle[0].socket.handle.shutdown(socket.SHUT_RDWR)
+        connection = pool.acquire()
+        self.assertTrue(connection.is_healthy())
+        pool.release(connection)
+        self.assertEqual(pool.connections_opened, 2)
+
+    def test_idle_connections_are_evicted(self):
+        """
+        Test that connections above the minimum size are closed once idle for longer than the idle timeout
+        """
+        pool = self.make_pool(min_size=0, idle_timeout=0)
+        pool.call(lambda client: client.getCurrentTimestamp())
+        self.assertEqual(pool.size, 0)
+
+    def test_min_size_connections_are_kept(self):
+        """
+        Test that warming up opens the minimum number of connections and eviction keeps them
+        """
+        pool = self.make_pool(min_size=2, idle_timeout=0)
+        pool.warm_up()
+        self.assertEqual(pool.idle_count, 2)
+        pool.call(lambda client: client.getCurrentTimestamp())
+        self.assertEqual(pool.size, 2)
+
+    def test_max_size_is_enforced(self):
+        """
+        Test that checking out more than max_size connections times out
+        """
+        pool = self.make_pool(max_size=1, acquire_timeout=0.1)
+        connection = pool.acquire()
+        with self.assertRaises(PoolExhaustedError):
+            pool.acquire()
+        pool.release(connection)
+
+    def test_invalid_sizes(self):
+        with self.assertRaises(ValueError):
+            ThriftConnectionPool('localhost', self.port, min_size=3, max_size=2)
+
+    def test_client_shares_pool(self):
+        """
+        Test that separate client instances for the same server use the same pool
+        """
+        self.assertIs(ThriftTimestampClient(port=self.port).balancer, ThriftTimestampClient(port=self.port).balancer)
+
+    def test_client_returns_none_when_server_is_down(self):
+        self.assertIsNone(ThriftTimestampClient(port=get_free_port()).get_current_timestamp())
+
+
+class ThriftServerModeTests(SimpleTestCase):
+    def assert_serves_concurrent_clients(self, mode, framed=False):
+        """
+        Checks that the server answers several clients holding persistent connections at the same time
+        """
+        port = start_test_server(mode)
+        pool = ThriftConnectionPool('localhost', port, max_size=4, framed=framed)
+        self.addCleanup(pool.close)
+        # Hold every connection open at once so a server that only serves one connection would time out
+        connections = [pool.acquire() for _ in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            timestamps = list(executor.map(lambda c: c.client.getCurrentTimestamp(), connections))
+        for connection in connections:
+            pool.release(connection)
+        self.assertEqual(len(timestamps), 4)
+        self.assertTrue(all(timestamps))
+
+    def test_threaded_server(self):
+        self.assert_serves_concurrent_clients('threaded')
+
+    def test_nonblocking_server(self):
+        self.assert_serves_concurrent_clients('nonblocking', framed=True)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            build_server(mode='unknown')
+
+
+class TimestampBatchTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.port = start_test_server()
+
+    def test_batch_is_unique_and_increasing(self):
+        """
+        Test that consecutive batches never repeat or go back in time
+        """
+        handler = TimestampHandler()
+        timestamps = handler.getTimestamps(500) + handler.getTimestamps(500)
+        self.assertEqual(len(set(timestamps)), 1000)
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(InvalidRequest):
+            TimestampHandler().getTimestamps(0)
+        with self.assertRaises(InvalidRequest):
+            TimestampHandler().getTimestamps(MAX_TIMESTAMP_BATCH + 1)
+
+    def test_client_splits_large_batches(self):
+        """
+        Test that the client fetches more than the server's batch limit across several RPCs
+        """
+        timestamps = ThriftTimestampClient(port=self.port).get_timestamps(MAX_TIMESTAMP_BATCH + 5)
+        self.assertEqual(len(set(timestamps)), MAX_TIMESTAMP_BATCH + 5)
+
+    def test_reserved_timestamps_are_used_on_save(self):
+        """
+        Test that rows saved inside a reservation take the reserved timestamps in order
+        """
+        source = ThriftTimestampSource(ThriftTimestampClient(port=self.port))
+        with reserve_timestamps(2, source=source) as block:
+            reserved = list(block)
+            first = Account.objects.create(user=User.objects.create_user(username='first'))
+            second = Account.objects.create(user=User.objects.create_user(username='second'))
+            self.assertIsNone(take_reserved_timestamp())
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.created_at, reserved[0])
+        self.assertEqual(second.created_at, reserved[1])
+        self.assertIsNone(take_reserved_timestamp())
+
+
+class BinaryTimestampTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.port = start_test_server()
+
+    def test_concurrent_callers_get_unique_increasing_timestamps(self):
+        """
+        Test that timestamps handed out to concurrent callers never collide and follow the sequence order
+        """
+        handler = TimestampHandler()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            timestamps = list(executor.map(lambda _: handler.getTimestamp(), range(2000)))
+        timestamps.sort(key=lambda timestamp: timestamp.sequence)
+        micros = [timestamp.epochMicros for timestamp in timestamps]
+        self.assertEqual(len(set(micros)), 2000)
+        self.assertEqual(micros, sorted(micros))
+        self.assertEqual([timestamp.sequence for timestamp in timestamps], list(range(1, 2001)))
+
+    def test_block_continues_after_single_timestamps(self):
+        handler = TimestampHandler()
+        single = handler.getTimestamp()
+        block = handler.getTimestampBlock(3)
+        self.assertEqual([timestamp.sequence for timestamp in block], [2, 3, 4])
+        self.assertGreater(block[0].epochMicros, single.epochMicros)
+
+    def test_timestamp_to_datetime(self):
+        self.assertEqual(timestamp_to_datetime(Timestamp(epochMicros=1700000000123456, sequence=1)),
+                         datetime(2023, 11, 14, 22, 13, 20, 123456, tzinfo=timezone.utc))
+
+    def test_client_returns_aware_datetimes(self):
+        """
+        Test that the binary mode client returns aware datetimes with microsecond precision
+        """
+        client = ThriftTimestampClient(port=self.port, mode='binary')
+        current = client.get_current_datetime()
+        self.assertIsNotNone(current.tzinfo)
+        block = client.get_datetimes(3)
+        self.assertEqual(len(set(block)), 3)
+        self.assertGreater(block[0], current)
+
+    def test_string_mode_client(self):
+        client = ThriftTimestampClient(port=self.port, mode='string')
+        self.assertIsNotNone(client.get_current_datetime().tzinfo)
+        self.assertEqual(len(client.get_datetimes(2)), 2)
+
+
+class FakeTimestampClient:
+    """Stands in for ThriftTimestampClient with a server clock a fixed offset ahead of the local clock."""
+    def __init__(self, offset=timedelta(0), available=True):
+        self.offset = offset
+        self.available = available
+        self.calls = 0
+
+    def get_current_datetime(self):
+        self.calls += 1
+        if not self.available:
+            return None
+        return datetime.now(timezone.utc) + self.offset
+
+    def get_datetimes(self, count):
+        if not self.available:
+            return None
+        return [self.get_current_datetime() for _ in range(count)]
+
+
+class TimestampSourceTests(TestCase):
+    def test_local_source_is_monotonic(self):
+        """
+        Test that the local clock never repeats or goes back, and counts what it served
+        """
+        source = LocalClockTimestampSource()
+        timestamps = [source.now() for _ in range(1000)] + source.reserve(10)
+        self.assertEqual(len(set(timestamps)), 1010)
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(source.get_metrics(), {'local': 1010})
+
+    def test_strict_source_raises_when_server_is_down(self):
+        source = ThriftTimestampSource(FakeTimestampClient(available=False))
+        with self.assertRaises(TimestampUnavailableError):
+            source.now()
+        self.assertEqual(source.get_metrics(), {'thrift_failures': 1})
+
+    def test_hybrid_source_applies_server_offset(self):
+        """
+        Test that the hybrid source serves local timestamps corrected by the server's offset without an RPC each
+        """
+        client = FakeTimestampClient(offset=timedelta(hours=1))
+        source = HybridTimestampSource(client, sync_interval=3600, drift_bound=3600)
+        self.addCleanup(source.stop)
+        self.assertTrue(source.sync())
+        calls = client.calls
+        timestamps = [source.now() for _ in range(100)]
+        # Only the background thread's first sync may have called the server
+        self.assertLessEqual(client.calls - calls, 1)
+        self.assertAlmostEqual((timestamps[0] - datetime.now(timezone.utc)).total_seconds(), 3600, delta=1)
+        self.assertEqual(source.get_metrics()['hybrid'], 100)
+
+    def test_hybrid_source_falls_back_to_local_clock(self):
+        """
+        Test that the hybrid source keeps serving timestamps when the server has never been reachable
+        """
+        source = HybridTimestampSource(FakeTimestampClient(available=False), sync_interval=3600, drift_bound=60)
+        self.addCleanup(source.stop)
+        self.assertAlmostEqual((source.now() - datetime.now(timezone.utc)).total_seconds(), 0, delta=1)
+        self.assertEqual(source.get_metrics()['local'], 1)
+
+    async def test_async_now(self):
+        """
+        Test that anow serves a fresh hybrid offset from the local clock, and only calls the server in a thread
+        """
+        client = FakeTimestampClient(offset=timedelta(hours=1))
+        source = HybridTimestampSource(client, sync_interval=3600, drift_bound=3600)
+        self.addCleanup(source.stop)
+        self.assertFalse(source.is_offset_fresh())
+        # The stale offset is synced with the server in a worker thread
+        first = await source.anow()
+        self.assertTrue(source.is_offset_fresh())
+        calls = client.calls
+        second = await source.anow()
+        self.assertGreater(second, first)
+        self.assertLessEqual(client.calls - calls, 1)
+        self.assertAlmostEqual((second - datetime.now(timezone.utc)).total_seconds(), 3600, delta=1)
+
+        with self.assertRaises(TimestampUnavailableError):
+            await ThriftTimestampSource(FakeTimestampClient(available=False)).anow()
+
+    def test_nested_exhausted_reservations_unwind_in_order(self):
+        """
+        Test that leaving an inner block restores the outer one, even when both are used up and so compare equal
+        """
+        source = LocalClockTimestampSource()
+        with reserve_timestamps(1, source=source) as outer:
+            take_reserved_timestamp()
+            with reserve_timestamps(1, source=source):
+                take_reserved_timestamp()
+            self.assertIs(_reserved.blocks[-1], outer)
+        self.assertEqual(_reserved.blocks, [])
+
+    def test_unknown_source_mode(self):
+        with self.assertRaises(ValueError):
+            build_timestamp_source('unknown')
+
+    def test_field_uses_configured_source(self):
+        """
+        Test that ThriftTimestampField takes its value from the process-wide source
+        """
+        source = LocalClockTimestampSource()
+        previous = set_timestamp_source(source)
+        self.addCleanup(set_timestamp_source, previous)
+        self.assertIs(get_timestamp_source(), source)
+        account = Account.objects.create(user=User.objects.create_user(username='sourced'))
+        self.assertIsNotNone(account.created_at)
+        self.assertEqual(source.get_metrics(), {'local': 1})
+
+
+def wait_for(condition, timeout=10):
+    """Poll condition until it is true or timeout seconds have passed."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class EndpointBalancerTests(SimpleTestCase):
+    def make_pool(self, port):
+        pool = ThriftConnectionPool('localhost', port, min_size=0, timeout=500)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_calls_are_spread_over_servers(self):
+        """
+        Test that consecutive calls go to each server in turn
+        """
+        pools = [self.make_pool(start_test_server()), self.make_pool(start_test_server())]
+        balancer = EndpointBalancer(pools)
+        for _ in range(4):
+            balancer.call(lambda client: client.getTimestamp())
+        self.assertEqual([pool.connections_opened for pool in pools], [1, 1])
+
+    def test_unreachable_server_is_skipped(self):
+        """
+        Test that calls fail over to a live server and the dead one is skipped during its cooldown
+        """
+        dead, live = self.make_pool(get_free_port()), self.make_pool(start_test_server())
+        balancer = EndpointBalancer([dead, live], cooldown=60)
+        for _ in range(3):
+            self.assertIsNotNone(balancer.call(lambda client: client.getTimestamp()))
+        # Only the first call tried the dead server
+        self.assertEqual(dead.size, 0)
+        self.assertGreater(balancer._down_until[0], time.monotonic())
+
+    def test_error_when_no_server_is_reachable(self):
+        balancer = EndpointBalancer([self.make_pool(get_free_port())])
+        with self.assertRaises(Exception):
+            balancer.call(lambda client: client.getTimestamp())
+
+    def test_parse_endpoint(self):
+        self.assertEqual(parse_endpoint('time.internal:9091'), ('time.internal', 9091))
+        self.assertEqual(parse_endpoint(('localhost', '9090')), ('localhost', 9090))
+        with self.assertRaises(ValueError):
+            parse_endpoint('localhost')
+
+
+class ManagedServerTests(SimpleTestCase):
+    def test_graceful_stop(self):
+        """
+        Test that start_thrift_server signals readiness, serves, and stops accepting connections when stopped
+        """
+        port = get_free_port()
+        ready = []
+        thread = Thread(target=server.start_thrift_server,
+                        kwargs={'mode': 'threaded', 'host': 'localhost', 'port': port, 'grace_period': 1,
+                                'on_ready': lambda: ready.append(True)},
+                        daemon=True)
+        thread.start()
+        self.assertTrue(wait_for(lambda: ready))
+        pool = ThriftConnectionPool('localhost', port, min_size=0)
+        self.addCleanup(pool.close)
+        self.assertIsNotNone(pool.call(lambda client: client.getTimestamp()))
+
+        server.stop_thrift_server()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        with self.assertRaises(OSError):
+            socket.create_connection(('localhost', port), timeout=0.5).close()
+
+    def test_run_timestamp_server_command(self):
+        """
+        Test that the management command writes its ready file, serves, and exits cleanly on SIGTERM
+        """
+        port = get_free_port()
+        ready_file = os.path.join(tempfile.mkdtemp(), 'ready')
+        process = subprocess.Popen([sys.executable, 'manage.py', 'run_timestamp_server', '--host', 'localhost',
+                                    '--port', str(port), '--ready-file', ready_file],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(process.kill)
+        self.assertTrue(wait_for(lambda: os.path.exists(ready_file)))
+        pool = ThriftConnectionPool('localhost', port, min_size=0)
+        self.addCleanup(pool.close)
+        self.assertIsNotNone(pool.call(lambda client: client.getTimestamp()))
+
+        process.send_signal(signal.SIGTERM)
+        self.assertEqual(process.wait(10), 0)
+        self.assertFalse(os.path.exists(ready_file))
@@ -1,5 +1,25 @@
 namespace py timestamp_service
 
+exception InvalidRequest {
+    1: string message
+}
+
+// A point in time as microseconds since the Unix epoch (UTC). sequence increases by one for every timestamp the
+// server hands out, so (epochMicros, sequence) is unique and ordered across concurrent callers.
+struct Timestamp {
+    1: i64 epochMicros
+    2: i64 sequence
+}
+
 service TimestampService {
     string getCurrentTimestamp()
+
+    // Returns count unique, strictly increasing timestamps in the format 'YYYY-MM-DD HH:MM:SS.ffffff'
+    list<string> getTimestamps(1: i32 count) throws (1: InvalidRequest error)
+
+    // Returns a unique timestamp later than every timestamp handed out before it
+    Timestamp getTimestamp()
+
+    // Returns count unique, strictly increasing binary timestamps
+    list<Timestamp> getTimestampBlock(1: i32 count) throws (1: InvalidRequest error)
 }
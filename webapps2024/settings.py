@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -58,6 +60,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'payapp.middleware.AccountMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -79,6 +82,7 @@ TEMPLATES = [
                 'payapp.context_processors.get_unread_notifications',
                 'payapp.context_processors.user_currency',
                 'payapp.context_processors.user_balance',
+                'payapp.context_processors.live_updates',
             ],
         },
     },
@@ -92,12 +96,59 @@ WSGI_APPLICATION = 'webapps2024.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'webapps.db',
+# The database profile is chosen with the DATABASE_PROFILE environment variable:
+# - sqlite (default): the webapps.db file, tuned for concurrent writes
+# - postgres: PostgreSQL, configured with the POSTGRES_* environment variables, for concurrent payments, through the
+#   psycopg driver in requirements.txt
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+
+if DATABASE_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'webapps2024'),
+            'USER': os.environ.get('POSTGRES_USER', 'webapps2024'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Seconds a connection is kept open and reused by later requests on the same worker thread, rather than
+            # connecting for every request. Django 5.0 has no connection pool of its own, so for more worker threads
+            # than the server allows connections, put PgBouncer in transaction mode in front of the database.
+            'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 60)),
+            # Checks a kept connection still works before a request reuses it, reconnecting if it does not
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'connect_timeout': 5,
+                'application_name': 'webapps2024',
+            },
+        }
     }
-}
+elif DATABASE_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            # Django's SQLite backend with the pragmas and transaction mode options below
+            'ENGINE': 'webapps2024.sqlite3',
+            'NAME': BASE_DIR / 'webapps.db',
+            'OPTIONS': {
+                # Run on every new connection
+                'pragmas': {
+                    # Readers no longer block the writer nor the writer readers, kept in the database file
+                    'journal_mode': 'WAL',
+                    # Milliseconds a writer waits for the write lock before failing with "database is locked"
+                    'busy_timeout': 5000,
+                    # Only syncs at WAL checkpoints, which cannot corrupt the database in WAL mode
+                    'synchronous': 'NORMAL',
+                },
+                # Transactions only take the write lock when they first write, so readers never wait for it
+                'transaction_mode': 'DEFERRED',
+                # Payments, which read the balances and then write them, take the write lock when they begin, so
+                # concurrent payments wait for each other rather than failing when one which has read tries to write
+                'write_transaction_mode': 'IMMEDIATE',
+            },
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unknown DATABASE_PROFILE '{DATABASE_PROFILE}', expected 'sqlite' or 'postgres'")
 
 LOGIN_URL = '/webapps2024/register/login'
 
@@ -144,4 +195,93 @@ STATICFILES_DIRS = [
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-BASE_URL = 'https://localhost:8000'
\ No newline at end of file
+BASE_URL = 'https://localhost:8000'
+
+# Rows per page of the transfers, requests and notifications lists and their JSON API, which clients can lower or
+# raise up to PAYAPP_MAX_PAGE_SIZE with the page_size query parameter
+PAYAPP_PAGE_SIZE = 25
+PAYAPP_MAX_PAGE_SIZE = 100
+
+# Largest number of payouts the bulk payout API makes in one request
+PAYAPP_BULK_PAYOUT_MAX_ITEMS = 1000
+
+# Background worker making notifications from the outbox, run with `manage.py process_outbox`
+PAYAPP_OUTBOX = {
+    'BATCH_SIZE': 500,  # Events processed per transaction
+    'POLL_INTERVAL': 1,  # Seconds between polls when the outbox is empty
+}
+
+# Retention of old rows, deleted by `manage.py purge_notifications`
+PAYAPP_RETENTION = {
+    'NOTIFICATION_DAYS': 90,  # Days read notifications are kept, unread ones are never deleted
+    'OUTBOX_DAYS': 7,  # Days processed outbox events are kept
+    'BATCH_SIZE': 1000,  # Rows deleted per statement
+}
+
+# Live updates of the navigation bar streamed by payapp:live, which needs an ASGI server such as uvicorn or daphne
+PAYAPP_LIVE = {
+    # Whether pages load the script which opens the stream, set PAYAPP_LIVE_ENABLED=1 when served by an ASGI server
+    'ENABLED': os.environ.get('PAYAPP_LIVE_ENABLED') == '1',
+    'POLL_INTERVAL': 2,  # Seconds between polls for changes made by other processes, None for in-process changes only
+    'KEEPALIVE': 15,  # Seconds between keepalive comments on an idle stream
+    'RETRY': 3000,  # Milliseconds the browser waits before reconnecting a dropped stream
+}
+
+# Rows the admin export fetches from the database, and writes to the client, at a time
+CUSTOM_ADMIN_EXPORT_CHUNK_SIZE = 2000
+
+# Seconds each process caches the exchange-rate matrix before reloading it from the database
+CONVERSION_RATES_TTL = 300
+
+# Largest number of amounts the batch conversion endpoint converts in one request, enough for a back-office job
+# revaluing every balance
+CONVERSION_BATCH_MAX_ITEMS = 100000
+
+REST_FRAMEWORK = {
+    # Requests per user allowed to the APIs with these throttle scopes
+    'DEFAULT_THROTTLE_RATES': {
+        'conversion_batch': '60/minute',
+    },
+}
+
+# 'local' converts currencies in process, 'remote' calls the conversion service configured in CONVERSION_REMOTE
+CONVERSION_BACKEND = 'local'
+CONVERSION_REMOTE = {
+    'BASE_URL': BASE_URL,
+    'CONNECT_TIMEOUT': 1,  # Seconds to wait for the TCP/TLS connection
+    'READ_TIMEOUT': 2,  # Seconds to wait for the response once connected
+    'RETRIES': 2,  # Extra attempts after a connection error, timeout or 5xx response
+    'BACKOFF': 0.1,  # Base delay in seconds; attempt n waits a random time up to BACKOFF * 2**n
+    'FAILURE_THRESHOLD': 5,  # Consecutive failed calls before the circuit opens and calls fail fast
+    'RESET_TIMEOUT': 30,  # Seconds the circuit stays open before a trial call is let through
+    'POOL_SIZE': 10,  # Keep-alive connections kept open to the conversion service
+    'VERIFY': True,  # TLS verification, or the path of a CA bundle for a self-signed certificate
+}
+
+# Thrift timestamp service used by ThriftTimestampField and the home page, run with `manage.py run_timestamp_server`
+THRIFT_TIMESTAMP_SERVER = {
+    'MODE': 'threaded',  # One of 'simple', 'threaded', 'nonblocking' or 'forking'
+    'HOST': None,  # Listen on all interfaces
+    'PORT': 9090,
+    'WORKERS': 32,  # Worker threads; in threaded mode each open client connection holds one
+    'BACKLOG': 128,  # Size of the socket accept queue
+}
+THRIFT_TIMESTAMP_SOURCE = {
+    'MODE': 'hybrid',  # 'thrift' (strict), 'local' (monotonic local clock) or 'hybrid' (local clock synced to Thrift)
+    'SYNC_INTERVAL': 10,  # Seconds between background offset syncs in hybrid mode
+    'DRIFT_BOUND': 60,  # Seconds a synced offset is trusted before hybrid mode asks the server directly
+}
+# 'binary' builds timestamps from epoch microseconds, 'string' parses formatted timestamps
+THRIFT_TIMESTAMP_MODE = 'binary'
+# Servers started with `manage.py run_timestamp_server` that the web app connects to as 'host:port'. Calls are spread
+# over them round-robin and a server that cannot be reached is skipped for ENDPOINT_COOLDOWN seconds
+THRIFT_TIMESTAMP_ENDPOINTS = ['localhost:9090']
+THRIFT_TIMESTAMP_ENDPOINT_COOLDOWN = 5
+THRIFT_TIMESTAMP_POOL = {
+    'MIN_SIZE': 1,
+    'MAX_SIZE': 10,
+    'TIMEOUT': 2000,  # Socket timeout in milliseconds
+    'ACQUIRE_TIMEOUT': 5,  # Seconds to wait for a free connection when the pool is full
+    'IDLE_TIMEOUT': 300,  # Seconds before an idle connection above MIN_SIZE is closed
+    'HEALTH_CHECK_INTERVAL': 30,  # Seconds of idleness before a connection is checked on checkout
+}
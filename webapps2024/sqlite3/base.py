@@ -0,0 +1,37 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite backend tuned for concurrent payments, taking two extra OPTIONS:
+    - pragmas: dict of PRAGMA statements run on every new connection, e.g. {'journal_mode': 'WAL'}
+    - transaction_mode: how transactions begin, DEFERRED (SQLite's default), IMMEDIATE or EXCLUSIVE
+    - write_transaction_mode: how transactions opened with payapp.utils.write_atomic begin, defaulting to
+      transaction_mode
+
+    A deferred transaction which reads and then writes, as Transfer.execute does, fails at once with "database is
+    locked" if another connection has written in between, without waiting for busy_timeout. An IMMEDIATE transaction
+    takes the write lock when it begins, so it waits its turn instead, but it also holds off every other writer until
+    it ends, so only the transactions which read and then write should begin that way. Django 5.1 adds pragmas and
+    transaction_mode as built-in options (init_command and transaction_mode), but not a mode per transaction.
+    """
+    # Set by write_atomic while it begins a transaction
+    beginning_write = False
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        # Taken out of the parameters, which are passed on to sqlite3.connect
+        self.pragmas = params.pop('pragmas', {})
+        self.transaction_mode = params.pop('transaction_mode', None)
+        self.write_transaction_mode = params.pop('write_transaction_mode', self.transaction_mode)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.write_transaction_mode if self.beginning_write else self.transaction_mode
+        self.cursor().execute(f'BEGIN {mode}' if mode else 'BEGIN')